@@ -0,0 +1,420 @@
+"""In-memory Cloud Director for the benchmarks.
+
+Serves the subset of the vCD API used by the kvcd handlers: API versions,
+login and logout, organization, Org VDCs, vApps (creation, power, metadata,
+owner, leases, deletion), tasks, and the paged `vApp`, `vm` and `orgVdc`
+queries. Every task completes at once.
+
+The fake is plugged in the vCD sessions like a traffic replay: `transport()`
+returns the HTTP adapter serving its responses, mounted by the kvcd adapter
+of each HTTP session of the pyvcloud client. No network access is needed.
+
+It also counts what a leak would accumulate on the vCloud side: the vCD
+sessions logged in and never logged out, and the HTTP transports opened and
+never closed (one by HTTP session of the client).
+"""
+
+import itertools
+import re
+import threading
+import urllib.parse
+import uuid
+from xml.sax.saxutils import escape, quoteattr
+
+import requests
+from lxml import etree
+from requests.structures import CaseInsensitiveDict
+from pyvcloud.vcd.client import EntityType, NSMAP
+
+
+API_VERSION = '36.0'
+VCD_NS = NSMAP['vcloud']
+XSI_NS = NSMAP['xsi']
+
+# vApp status codes, as in pyvcloud.vcd.client.VCLOUD_STATUS_MAP
+POWERED_ON = 4
+POWERED_OFF = 8
+
+
+class FakeVapp:
+    """State of a vApp of the fake vCD.
+    """
+
+    def __init__(self, name: str, vdc_id: str, owner: str, vms: int = 2):
+        self.id = str(uuid.uuid4())
+        self.name = name
+        self.vdc_id = vdc_id
+        self.owner = owner
+        self.status = POWERED_OFF
+        self.deployment_lease = 0
+        self.storage_lease = 0
+        self.metadata = {}
+        self.vms = [f"{name}-vm{i}" for i in range(vms)]
+
+
+class FakeVcd:
+    """In-memory Cloud Director with one organization and its Org VDCs.
+    """
+
+    def __init__(self, host: str = 'vcd.invalid', org: str = 'soak', user: str = 'kvcd', vdcs: int = 2,
+                 port: int = 443):
+        """Define the fake vCD
+
+        Args:
+            host (str, optional): Hostname of the vCloud instance. Defaults to 'vcd.invalid'.
+            org (str, optional): Name of the organization. Defaults to 'soak'.
+            user (str, optional): Name of the user. Defaults to 'kvcd'.
+            vdcs (int, optional): Number of Org VDCs. Defaults to 2.
+            port (int, optional): Port of the vCloud instance. Defaults to 443.
+        """
+        self.base = f"https://{host}:{port}"
+        self.org = org
+        self.org_id = str(uuid.uuid4())
+        self.user = user
+        self.vdcs = {str(uuid.uuid4()): f"vdc{i}" for i in range(vdcs)}
+        self.vapps = {}  # vApp id -> FakeVapp
+        self.sessions = set()  # access tokens of the vCD sessions not logged out
+        self.requests = 0
+        self._transports = 0
+        self._closed_transports = 0
+        self._tasks = itertools.count(1)
+        self._lock = threading.RLock()
+
+    # --- Leak indicators ---
+
+    @property
+    def open_transports(self):
+        """Number of HTTP transports not closed yet.
+
+        Returns:
+            int: Number of transports
+        """
+        with self._lock:
+            return self._transports - self._closed_transports
+
+    # --- Simulation helpers ---
+
+    def add_vapp(self, name: str, vdc_name: str, powered_on: bool = False):
+        """Create a vApp out of the API, like another tenant would.
+
+        Args:
+            name (str): Name of the vApp
+            vdc_name (str): Name of its Org VDC
+            powered_on (bool, optional): Power state. Defaults to False.
+
+        Returns:
+            str: href of the vApp
+        """
+        vdc_id = next(vdc_id for vdc_id, name_ in self.vdcs.items() if name_ == vdc_name)
+        with self._lock:
+            vapp = FakeVapp(name, vdc_id, self.user)
+            vapp.status = POWERED_ON if powered_on else POWERED_OFF
+            self.vapps[vapp.id] = vapp
+        return self._vapp_href(vapp)
+
+    def vapp(self, href: str):
+        """vApp from its href.
+
+        Args:
+            href (str): href of the vApp
+
+        Returns:
+            FakeVapp: vApp, or None
+        """
+        return self.vapps.get(href.rsplit('/vapp-', 1)[-1])
+
+    def vdc_href(self, vdc_name: str):
+        """href of an Org VDC.
+
+        Args:
+            vdc_name (str): Name of the Org VDC
+
+        Returns:
+            str: href
+        """
+        return next(f"{self.base}/api/vdc/{vdc_id}" for vdc_id, name in self.vdcs.items() if name == vdc_name)
+
+    def transport(self):
+        """New HTTP adapter serving the fake vCD, as a traffic replay would.
+
+        Returns:
+            FakeVcdTransport: HTTP adapter
+        """
+        with self._lock:
+            self._transports += 1
+        return FakeVcdTransport(self)
+
+    def _transport_closed(self):
+        with self._lock:
+            self._closed_transports += 1
+
+    # --- Resources ---
+
+    def _vapp_href(self, vapp: FakeVapp):
+        return f"{self.base}/api/vApp/vapp-{vapp.id}"
+
+    def _task(self, operation: str, owner_href: str = ''):
+        task_id = next(self._tasks)
+        return (f'<Task xmlns="{VCD_NS}" href="{self.base}/api/task/{task_id}" id="urn:vcloud:task:{task_id}" '
+                f'name="task" operationName={quoteattr(operation)} status="success" '
+                f'type="{EntityType.TASK.value}"><Owner href="{owner_href}"/></Task>')
+
+    def _session(self):
+        return (f'<Session xmlns="{VCD_NS}" org="{self.org}" user="{self.user}" href="{self.base}/api/session">'
+                f'<Link rel="down" type="{EntityType.ORG_LIST.value}" href="{self.base}/api/org"/>'
+                f'<Link rel="down" type="{EntityType.ORG.value}" name="{self.org}" '
+                f'href="{self.base}/api/org/{self.org_id}"/>'
+                f'<Link rel="down" type="{EntityType.QUERY_LIST.value}" href="{self.base}/api/query"/>'
+                f'</Session>')
+
+    def _org(self):
+        links = ''.join(f'<Link rel="down" type="{EntityType.VDC.value}" name="{name}" '
+                        f'href="{self.base}/api/vdc/{vdc_id}"/>' for vdc_id, name in self.vdcs.items())
+        # API v33+ clients list the Org VDCs from a query
+        links += (f'<Link rel="down" type="{EntityType.RECORDS.value}" '
+                  f'href="{self.base}/api/query?type=orgVdc&amp;format=records"/>')
+        return (f'<Org xmlns="{VCD_NS}" name="{self.org}" id="urn:vcloud:org:{self.org_id}" '
+                f'href="{self.base}/api/org/{self.org_id}" type="{EntityType.ORG.value}">{links}</Org>')
+
+    def _vdc(self, vdc_id: str):
+        href = f"{self.base}/api/vdc/{vdc_id}"
+        return (f'<Vdc xmlns="{VCD_NS}" name="{self.vdcs[vdc_id]}" id="urn:vcloud:vdc:{vdc_id}" href="{href}" '
+                f'type="{EntityType.VDC.value}">'
+                f'<Link rel="add" type="{EntityType.COMPOSE_VAPP_PARAMS.value}" href="{href}/action/composeVApp"/>'
+                f'</Vdc>')
+
+    def _vapp(self, vapp: FakeVapp, tasks: str = ''):
+        href = self._vapp_href(vapp)
+        deployed = 'true' if vapp.status == POWERED_ON else 'false'
+        return (f'<VApp xmlns="{VCD_NS}" name={quoteattr(vapp.name)} id="urn:vcloud:vapp:{vapp.id}" href="{href}" '
+                f'type="{EntityType.VAPP.value}" status="{vapp.status}" deployed="{deployed}">'
+                f'<Link rel="deploy" type="{EntityType.DEPLOY.value}" href="{href}/action/deploy"/>'
+                f'<Link rel="undeploy" type="{EntityType.UNDEPLOY.value}" href="{href}/action/undeploy"/>'
+                f'<Link rel="down" type="{EntityType.METADATA.value}" href="{href}/metadata"/>'
+                f'<Link rel="remove" href="{href}"/>'
+                f'{tasks}'
+                f'<LeaseSettingsSection href="{href}/leaseSettingsSection/" '
+                f'type="{EntityType.LEASE_SETTINGS.value}">'
+                f'<DeploymentLeaseInSeconds>{vapp.deployment_lease}</DeploymentLeaseInSeconds>'
+                f'<StorageLeaseInSeconds>{vapp.storage_lease}</StorageLeaseInSeconds>'
+                f'</LeaseSettingsSection>'
+                f'<Owner type="{EntityType.OWNER.value}">'
+                f'<User type="{EntityType.USER.value}" name={quoteattr(vapp.owner)} '
+                f'href="{self.base}/api/admin/user/{vapp.owner}"/></Owner>'
+                f'</VApp>')
+
+    def _metadata(self, vapp: FakeVapp):
+        href = f"{self._vapp_href(vapp)}/metadata"
+        entries = ''.join(
+            f'<MetadataEntry><Domain visibility="READWRITE">GENERAL</Domain><Key>{escape(key)}</Key>'
+            f'<TypedValue xsi:type="MetadataStringValue"><Value>{escape(value)}</Value></TypedValue>'
+            f'</MetadataEntry>' for key, value in vapp.metadata.items())
+        return (f'<Metadata xmlns="{VCD_NS}" xmlns:xsi="{XSI_NS}" href="{href}" type="{EntityType.METADATA.value}">'
+                f'<Link rel="add" type="{EntityType.METADATA.value}" href="{href}"/>{entries}</Metadata>')
+
+    def _query_list(self):
+        links = ''.join(f'<Link rel="down" type="{EntityType.RECORDS.value}" name="{name}" '
+                        f'href="{self.base}/api/query?type={name}&amp;format=records"/>'
+                        for name in ('vApp', 'vm', 'orgVdc'))
+        return f'<QueryList xmlns="{VCD_NS}" href="{self.base}/api/query">{links}</QueryList>'
+
+    def _query(self, params: dict):
+        query_type = params.get('type', [''])[0]
+        page = int(params.get('page', ['1'])[0])
+        page_size = int(params.get('pageSize', ['25'])[0])
+        # Equality conditions only, like `vdc==<href>;(name==<a>,name==<b>)`, with `\;` escaped in the values
+        qfilter = urllib.parse.unquote(params.get('filter', [''])[0])
+        conditions = [
+            [alternative.replace('\\', '').split('==', 1)
+             for alternative in re.split(r'(?<!\\),', re.sub(r'^\((.*)\)$', r'\1', condition))]
+            for condition in re.split(r'(?<!\\);', qfilter) if '==' in condition]
+
+        def _matches(attributes):
+            return all(any(attributes.get(key) == value for key, value in alternatives)
+                       for alternatives in conditions)
+
+        if query_type == 'vApp':
+            records = []
+            for vapp in self.vapps.values():
+                attributes = {
+                    'name': vapp.name,
+                    'href': self._vapp_href(vapp),
+                    'vdc': f"{self.base}/api/vdc/{vapp.vdc_id}",
+                    'status': 'POWERED_ON' if vapp.status == POWERED_ON else 'POWERED_OFF',
+                    'isDeployed': 'true' if vapp.status == POWERED_ON else 'false',
+                    'ownerName': vapp.owner,
+                    'isExpired': 'false',
+                }
+                # Filtered on their id too, not in the records
+                if _matches(dict(attributes, id=f'urn:vcloud:vapp:{vapp.id}')):
+                    records.append('<VAppRecord ' + ' '.join(f'{key}={quoteattr(value)}'
+                                                             for key, value in attributes.items()) + '/>')
+        elif query_type == 'vm':
+            records = [
+                f'<VMRecord name={quoteattr(vm)} href="{self.base}/api/vApp/vm-{vapp.id}-{i}" '
+                f'container="{self._vapp_href(vapp)}" '
+                f'status="{"POWERED_ON" if vapp.status == POWERED_ON else "POWERED_OFF"}" '
+                f'ipAddress="10.0.{i}.1" numberOfCpus="2" memoryMB="2048" guestOs="Ubuntu Linux (64-bit)"/>'
+                for vapp in self.vapps.values() for i, vm in enumerate(vapp.vms)
+                if _matches({'container': self._vapp_href(vapp), 'isVAppTemplate': 'false'})]
+        elif query_type == 'orgVdc':
+            records = [
+                f'<OrgVdcRecord name="{name}" orgName="{self.org}" href="{self.base}/api/vdc/{vdc_id}" '
+                f'isEnabled="true" cpuUsedMhz="{1000 * sum(1 for v in self.vapps.values() if v.vdc_id == vdc_id)}" '
+                f'cpuLimitMhz="100000000" memoryUsedMB="0" memoryLimitMB="0" memoryAllocationMB="0" '
+                f'storageUsedMB="0" storageLimitMB="0"/>'
+                for vdc_id, name in self.vdcs.items()]
+        else:
+            return 400, self._error(400, f'Unknown query type {query_type}')
+        total = len(records)
+        records = records[(page - 1) * page_size:page * page_size]
+        next_page = ''
+        if page * page_size < total:
+            next_params = {k: v[0] for k, v in params.items()}
+            next_params['page'] = str(page + 1)
+            next_href = f"{self.base}/api/query?{urllib.parse.urlencode(next_params)}"
+            next_page = f'<Link rel="nextPage" href={quoteattr(next_href)}/>'
+        return 200, (f'<QueryResultRecords xmlns="{VCD_NS}" total="{total}" page="{page}" '
+                     f'pageSize="{page_size}">{next_page}{"".join(records)}</QueryResultRecords>')
+
+    def _error(self, status: int, message: str, minor_code: str = 'BAD_REQUEST'):
+        return (f'<Error xmlns="{VCD_NS}" majorErrorCode="{status}" minorErrorCode="{minor_code}" '
+                f'message={quoteattr(message)}/>')
+
+    # --- Requests ---
+
+    def handle(self, method: str, url: str, headers, body: bytes):
+        """Serve a request.
+
+        Args:
+            method (str): HTTP method
+            url (str): URL of the request
+            headers: Request headers
+            body (bytes): Request body
+
+        Returns:
+            tuple: (status code, response headers, response body)
+        """
+        parsed = urllib.parse.urlparse(url)
+        path, params = parsed.path.rstrip('/'), urllib.parse.parse_qs(parsed.query)
+        response_headers = {'Content-Type': 'application/*+xml;version=' + API_VERSION}
+        with self._lock:
+            self.requests += 1
+            if path == '/api/versions':
+                return 200, response_headers, (
+                    f'<SupportedVersions xmlns="http://www.vmware.com/vcloud/versions">'
+                    f'<VersionInfo deprecated="false"><Version>{API_VERSION}</Version>'
+                    f'<LoginUrl>{self.base}/api/sessions</LoginUrl></VersionInfo></SupportedVersions>')
+            if path == '/cloudapi/1.0.0/sessions' and method == 'POST':
+                token = uuid.uuid4().hex
+                self.sessions.add(token)
+                return 200, dict(response_headers, **{
+                    'Content-Type': 'application/json', 'X-VMware-VCloud-Access-Token': token}), '{}'
+            token = (headers.get('Authorization') or '').replace('Bearer ', '')
+            if token not in self.sessions:
+                return 401, response_headers, self._error(401, 'Not authenticated', 'UNAUTHORIZED')
+            if path == '/api/session':
+                if method == 'DELETE':
+                    self.sessions.discard(token)
+                    return 204, response_headers, ''
+                return 200, response_headers, self._session()
+            if path == '/api/org':
+                return 200, response_headers, (
+                    f'<OrgList xmlns="{VCD_NS}" href="{self.base}/api/org">'
+                    f'<Org type="{EntityType.ORG.value}" name="{self.org}" href="{self.base}/api/org/{self.org_id}"/>'
+                    f'</OrgList>')
+            if path == f'/api/org/{self.org_id}':
+                return 200, response_headers, self._org()
+            if path == '/api/query':
+                if 'type' not in params:
+                    return 200, response_headers, self._query_list()
+                status, content = self._query(params)
+                return status, response_headers, content
+            if path.startswith('/api/task/'):
+                return 200, response_headers, self._task('task')
+            if path.startswith('/api/vdc/'):
+                return self._handle_vdc(method, path, body, response_headers)
+            if path.startswith('/api/vApp/vapp-'):
+                return self._handle_vapp(method, path, body, response_headers)
+            return 404, response_headers, self._error(404, f'No resource at {path}', 'RESOURCE_NOT_FOUND')
+
+    def _handle_vdc(self, method: str, path: str, body: bytes, headers: dict):
+        vdc_id = path.split('/')[3]
+        if vdc_id not in self.vdcs:
+            return 404, headers, self._error(404, f'No Org VDC {vdc_id}', 'RESOURCE_NOT_FOUND')
+        if method == 'GET':
+            return 200, headers, self._vdc(vdc_id)
+        if method == 'POST' and path.endswith('/action/composeVApp'):
+            name = etree.fromstring(body).get('name')
+            if any(vapp.name == name and vapp.vdc_id == vdc_id for vapp in self.vapps.values()):
+                return 400, headers, self._error(400, f'Duplicate name {name}', 'DUPLICATE_NAME')
+            vapp = FakeVapp(name, vdc_id, self.user)
+            self.vapps[vapp.id] = vapp
+            href = self._vapp_href(vapp)
+            return 201, headers, self._vapp(vapp, tasks=f'<Tasks>{self._task("vdcComposeVapp", href)}</Tasks>')
+        return 405, headers, self._error(405, f'{method} not allowed', 'METHOD_NOT_ALLOWED')
+
+    def _handle_vapp(self, method: str, path: str, body: bytes, headers: dict):
+        parts = path.split('/')
+        vapp = self.vapps.get(parts[3][len('vapp-'):])
+        if vapp is None:
+            return 403, headers, self._error(403, 'No access to entity', 'ACCESS_TO_RESOURCE_IS_FORBIDDEN')
+        href, action = self._vapp_href(vapp), '/'.join(parts[4:])
+        if action == '':
+            if method == 'GET':
+                return 200, headers, self._vapp(vapp)
+            if method == 'DELETE':
+                if vapp.status == POWERED_ON:
+                    return 400, headers, self._error(400, 'The vApp is running', 'BAD_REQUEST')
+                del self.vapps[vapp.id]
+                return 202, headers, self._task('vdcDeleteVapp', href)
+        elif action == 'metadata':
+            if method == 'GET':
+                return 200, headers, self._metadata(vapp)
+            if method == 'POST':
+                for entry in etree.fromstring(body).iter(f'{{{VCD_NS}}}MetadataEntry'):
+                    vapp.metadata[entry.findtext(f'{{{VCD_NS}}}Key')] = entry.findtext(f'.//{{{VCD_NS}}}Value')
+                return 202, headers, self._task('metadataUpdate', href)
+        elif action == 'action/deploy' and method == 'POST':
+            vapp.status = POWERED_ON
+            return 202, headers, self._task('vappDeploy', href)
+        elif action == 'action/undeploy' and method == 'POST':
+            vapp.status = POWERED_OFF
+            return 202, headers, self._task('vappUndeploy', href)
+        elif action == 'owner' and method == 'PUT':
+            user = etree.fromstring(body).find(f'{{{VCD_NS}}}User')
+            vapp.owner = user.get('href').rstrip('/').rsplit('/', 1)[-1]
+            return 204, headers, ''
+        elif action == 'leaseSettingsSection' and method == 'PUT':
+            section = etree.fromstring(body)
+            vapp.deployment_lease = int(section.findtext(f'{{{VCD_NS}}}DeploymentLeaseInSeconds') or 0)
+            vapp.storage_lease = int(section.findtext(f'{{{VCD_NS}}}StorageLeaseInSeconds') or 0)
+            return 202, headers, self._task('vappUpdateVApp', href)
+        return 405, headers, self._error(405, f'{method} {action} not allowed', 'METHOD_NOT_ALLOWED')
+
+
+class FakeVcdTransport(requests.adapters.BaseAdapter):
+    """HTTP adapter serving the fake vCD, without any network access.
+    """
+
+    def __init__(self, vcd: FakeVcd):
+        self.vcd = vcd
+        self._closed = False
+        super().__init__()
+
+    def send(self, request, *args, **kwargs):
+        body = request.body.encode() if isinstance(request.body, str) else request.body
+        status, headers, content = self.vcd.handle(request.method, request.url, request.headers, body or b'')
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(headers)
+        response._content = content.encode()
+        response.encoding = 'utf-8'
+        return response
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self.vcd._transport_closed()
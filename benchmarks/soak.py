@@ -0,0 +1,388 @@
+"""Soak benchmark of the operator: thread, memory and session leaks.
+
+Runs the vcdvapp handlers for hours of simulated time against an in-memory
+fake vCD (`fake_vcd.py`), without waiting for the real intervals: each cycle
+stands for one `KVCD_REFRESH_INTERVAL` and runs what the operator runs in that
+time, on the same event loop and executor all along, as kopf does:
+
+* the refresh timer of every vcdvapp,
+* the refresh of the VM inventory, of the vApp index and of the Org VDCs capacity,
+* the reconciliation of the vcdvapps drifting in vCloud (power state) or in
+  Kubernetes (annotations to copy as metadata),
+* the deletion of some vcdvapps and the creation of new ones,
+* the refresh of the vCD session, every `refresh_session_interval`.
+
+The status updates go through the status writer, to in-memory objects. The
+thread count, the atexit handlers, the RSS, the live lxml elements and Python
+objects, the vCD sessions not logged out and the HTTP transports not closed are
+sampled along the run. Their growth since the end of the warm-up must stay within the
+bounds: the benchmark exits with 1 otherwise.
+
+No vCloud nor Kubernetes access is needed. The default run, a simulated day
+of 100 vcdvapps, takes about a quarter of an hour.
+
+Usage: python benchmarks/soak.py [--hours 24] [--vapps 100] [--churn 0.02] [--drift 0.05]
+"""
+
+import argparse
+import asyncio
+import atexit
+import gc
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fake_vcd import FakeVcd, POWERED_OFF
+
+
+SITE = 'default'
+NAMESPACE = 'soak'
+
+# Environment of the operator, set before the import of kvcd.main
+ENV = {
+    'KVCD_VCD_HOST': 'vcd.invalid',
+    'KVCD_VCD_ORG': 'soak',
+    'KVCD_VCD_USERNAME': 'kvcd',
+    'KVCD_VCD_PASSWORD': 'benchmark',
+    'KVCD_ENABLED_MODULES': 'kvcdvapps',
+    'KVCD_STATUS_WRITER_QPS': '0',
+}
+
+
+def rss_mb():
+    """Resident memory of the process.
+
+    Returns:
+        float: RSS (in MB)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:  # not Linux: peak RSS instead
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def sample(vcd: FakeVcd):
+    """Measure the leak indicators.
+
+    Args:
+        vcd (FakeVcd): Fake vCD
+
+    Returns:
+        dict: Value of each indicator
+    """
+    from lxml import etree
+    gc.collect()
+    objects = gc.get_objects()
+    return {
+        'threads': threading.active_count(),
+        'atexit': atexit._ncallbacks(),  # no public API to count the handlers
+        'rss_mb': round(rss_mb(), 1),
+        'lxml': sum(1 for obj in objects if isinstance(obj, etree._Element)),
+        'objects': len(objects),
+        'vcd_sessions': len(vcd.sessions),
+        'transports': vcd.open_transports,
+    }
+
+
+class Soak:
+    """Simulated operator, driving the vcdvapp handlers against a fake vCD.
+    """
+
+    def __init__(self, vcd: FakeVcd, vapps: int, churn: float, drift: float, seed: int = 0):
+        """Define the simulation
+
+        Args:
+            vcd (FakeVcd): Fake vCD
+            vapps (int): Number of vcdvapps
+            churn (float): Share of the vcdvapps deleted and created again at each cycle
+            drift (float): Share of the vcdvapps drifting at each cycle
+            seed (int, optional): Seed of the random choices. Defaults to 0.
+        """
+        import kopf
+        import kvcd.main
+        from kvcd.status_writer import deep_merge
+        from kvcd.vmware import vcloud_vapp
+        self.kopf = kopf
+        self.main = kvcd.main
+        self.handlers = vcloud_vapp
+        self.deep_merge = deep_merge
+        self.vcd = vcd
+        self.vapps = vapps
+        self.churn = churn
+        self.drift = drift
+        self.random = random.Random(seed)
+        self.logger = logging.getLogger('soak')
+        self.objects = {}  # name -> vcdvapp
+        self._next_name = 0
+        self._lock = threading.Lock()
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=kvcd.main.kvcd_config.max_workers)
+        self.loop.set_default_executor(self.executor)
+        self.vcd_session = None
+
+    def start(self):
+        """Open the vCD session and start the status writer.
+        """
+        import kvcd.status_writer
+        kvcd.status_writer.patch_custom_object = self._patch_status
+        self.main.vcd_traffic[SITE] = self.vcd
+        self.main.refresh_sessions()
+        self.vcd_session = self.main.get_vcd_session(SITE)
+        self.main.status_writer.start()
+        # Start all the workers of the executor: they are not leaked threads
+        workers = self.main.kvcd_config.max_workers
+        for future in [self.executor.submit(time.sleep, 0.05) for _ in range(workers)]:
+            future.result()
+
+    def stop(self):
+        """Stop the status writer and the event loop.
+        """
+        self.main.status_writer.stop(timeout=30)
+        self.loop.run_until_complete(self.loop.shutdown_default_executor())
+        self.loop.close()
+
+    def _patch_status(self, plural: str, namespace: str, name: str, body: dict):
+        with self._lock:
+            obj = self.objects.get(name)
+            if obj is None:
+                return
+            self.deep_merge(obj['status'], body['status'])
+            _prune_nulls(obj['status'])
+
+    def _apply(self, obj: dict, patch):
+        with self._lock:
+            self.deep_merge(obj['status'], dict(patch.get('status', {})))
+            obj['metadata']['annotations'].update(patch.get('metadata', {}).get('annotations', {}))
+
+    def _kwargs(self, obj: dict, **kwargs):
+        return dict(spec=obj['spec'], status=obj['status'], name=obj['metadata']['name'], namespace=NAMESPACE,
+                    annotations=obj['metadata']['annotations'], logger=self.logger, patch=self.kopf.Patch(),
+                    retry=0, **kwargs)
+
+    async def _run(self, handler, obj: dict, **kwargs):
+        kwargs = self._kwargs(obj, **kwargs)
+        try:
+            if asyncio.iscoroutinefunction(handler):
+                await handler(**kwargs)
+            else:
+                await self.loop.run_in_executor(None, lambda: handler(**kwargs))
+        except self.kopf.TemporaryError as e:
+            self.logger.info(f"{handler.__name__} of {obj['metadata']['name']} to retry: {e}")
+            return
+        self._apply(obj, kwargs['patch'])
+
+    def _new_object(self):
+        name = f"soak-{self._next_name}"
+        self._next_name += 1
+        return {
+            'metadata': {'name': name, 'annotations': {'team': 'soak'}},
+            'spec': {
+                'site': SITE,
+                'org': self.vcd.org,
+                'vdc': self.random.choice(sorted(self.vcd.vdcs.values())),
+                'description': f"Soak vApp {name}",
+                'powered_on': self.random.random() < 0.5,
+            },
+            'status': {},
+        }
+
+    def _run_all(self, *coroutines):
+        async def gather():
+            await asyncio.gather(*coroutines)
+        self.loop.run_until_complete(gather())
+
+    def create(self, count: int):
+        """Create new vcdvapps.
+
+        Args:
+            count (int): Number of vcdvapps
+        """
+        objs = [self._new_object() for _ in range(count)]
+        with self._lock:
+            self.objects.update({obj['metadata']['name']: obj for obj in objs})
+        self._run_all(*(self._run(self.handlers.create_vcdvapp, obj) for obj in objs))
+        # The field handlers run at the creation too
+        self._run_all(*(
+            [self._run(self.handlers.update_vcdvapp_power_state, obj, old=None, new=None) for obj in objs] +
+            [self._run(self.handlers.update_vcdvapp_metadata, obj, old=None, new=None) for obj in objs]))
+
+    def delete(self, count: int):
+        """Delete some vcdvapps.
+
+        Args:
+            count (int): Number of vcdvapps
+        """
+        objs = self.random.sample(list(self.objects.values()), min(count, len(self.objects)))
+        self._run_all(*(self._run(self.handlers.delete_vcdvapp, obj) for obj in objs))
+        with self._lock:
+            for obj in objs:
+                del self.objects[obj['metadata']['name']]
+
+    def cycle(self):
+        """Run one refresh interval of the operator.
+        """
+        vcd_session = self.vcd_session
+        objs = list(self.objects.values())
+        drifting = self.random.sample(objs, int(len(objs) * self.drift))
+        # Drift in vCloud: vApps powered off behind the operator
+        for obj in drifting[::2]:
+            vapp = self.vcd.vapp(obj['status'].get('backing', {}).get('vcd_vapp_href', ''))
+            if vapp is not None:
+                vapp.status = POWERED_OFF
+        # Drift in Kubernetes: annotations to copy as metadata
+        for obj in drifting[1::2]:
+            obj['metadata']['annotations']['revision'] = str(self.random.getrandbits(32))
+
+        vcd_session.vm_inventory.refresh(force=True)
+        vcd_session.vdc_capacity.refresh(force=True)
+        for vdc_name in self.vcd.vdcs.values():
+            vcd_session.vapp_index.refresh(self.vcd.vdc_href(vdc_name))
+        self._run_all(*(self._run(self.handlers.refresh_vcdvapp, obj) for obj in objs))
+        self.wait_for_status()
+
+        self._run_all(*(
+            [self._run(self.handlers.update_vcdvapp_power_state, obj, old=None, new=None)
+             for obj in drifting[::2]] +
+            [self._run(self.handlers.update_vcdvapp_metadata, obj, old=None, new=None)
+             for obj in drifting[1::2]]))
+
+        churn = int(self.vapps * self.churn)
+        if churn:
+            self.delete(churn)
+            self.create(churn)
+        self.wait_for_status()
+
+    def refresh_session(self):
+        """Refresh the vCD session, as the operator does every `refresh_session_interval`.
+        """
+        self.main.refresh_sessions()
+
+    def wait_for_status(self, timeout: float = 30):
+        """Wait for the status writer to flush the pending updates.
+
+        Args:
+            timeout (float, optional): Maximum wait (in secs). Defaults to 30.
+        """
+        deadline = time.monotonic() + timeout
+        while self.main.status_writer.depth() and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+
+def _prune_nulls(status: dict):
+    """Remove the fields set to None, as a merge patch does.
+    """
+    for key, value in list(status.items()):
+        if value is None:
+            del status[key]
+        elif isinstance(value, dict):
+            _prune_nulls(value)
+
+
+def check_growth(baseline: dict, final: dict, bounds: dict):
+    """Compare the growth of the indicators to their bounds.
+
+    Args:
+        baseline (dict): Indicators at the end of the warm-up
+        final (dict): Indicators at the end of the run
+        bounds (dict): Maximum growth of each bounded indicator
+
+    Returns:
+        list: Indicators beyond their bound, with their growth
+    """
+    return [f"{name}: +{final[name] - baseline[name]:g} (max +{bound:g})"
+            for name, bound in bounds.items() if final[name] - baseline[name] > bound]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hours", type=float, default=24, help="Simulated duration (in hours)")
+    parser.add_argument("--vapps", type=int, default=100, help="Number of vcdvapps")
+    parser.add_argument("--vdcs", type=int, default=2, help="Number of Org VDCs")
+    parser.add_argument("--churn", type=float, default=0.02,
+                        help="Share of the vcdvapps deleted and created again at each refresh interval")
+    parser.add_argument("--drift", type=float, default=0.05,
+                        help="Share of the vcdvapps drifting at each refresh interval")
+    parser.add_argument("--warmup", type=float, default=0.1,
+                        help="Share of the run before the baseline of the indicators")
+    parser.add_argument("--samples", type=int, default=10, help="Number of samples after the warm-up")
+    parser.add_argument("--max-threads", type=int, default=0, help="Maximum growth of the thread count")
+    parser.add_argument("--max-atexit", type=int, default=0, help="Maximum growth of the atexit handlers")
+    parser.add_argument("--max-rss-mb", type=float, default=32, help="Maximum growth of the RSS (in MB)")
+    parser.add_argument("--max-lxml", type=int, default=1000, help="Maximum growth of the live lxml elements")
+    parser.add_argument("--max-objects", type=int, default=50000, help="Maximum growth of the Python objects")
+    parser.add_argument("--max-vcd-sessions", type=int, default=0,
+                        help="Maximum growth of the vCD sessions not logged out")
+    parser.add_argument("--max-transports", type=int, default=0,
+                        help="Maximum growth of the HTTP transports not closed")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random choices")
+    args = parser.parse_args()
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, root)
+    for key, value in ENV.items():
+        os.environ.setdefault(key, value)
+    os.chdir(tempfile.mkdtemp())  # keep the pyvcloud log file away
+    logging.basicConfig()
+    logging.disable(logging.WARNING)  # pyvcloud logs every request
+
+    import kvcd.main
+    interval = kvcd.main.kvcd_config.refresh_interval
+    session_interval = kvcd.main.SESSION_REFRESH_INTERVAL
+    cycles = max(1, int(args.hours * 3600 / interval))
+    warmup = int(cycles * args.warmup)
+    sample_every = max(1, (cycles - warmup) // args.samples)
+
+    vcd = FakeVcd(host=os.environ['KVCD_VCD_HOST'], org=os.environ['KVCD_VCD_ORG'],
+                  user=os.environ['KVCD_VCD_USERNAME'], vdcs=args.vdcs)
+    soak = Soak(vcd, vapps=args.vapps, churn=args.churn, drift=args.drift, seed=args.seed)
+    soak.start()
+    soak.create(args.vapps)
+
+    print(f"Soak of {args.vapps} vcdvapps for {args.hours:g}h: {cycles} refresh intervals of {interval}s, "
+          f"session refreshed every {session_interval}s")
+    header = (f"{'hours':>6} {'threads':>8} {'atexit':>7} {'rss_mb':>8} {'lxml':>8} {'objects':>9} "
+              f"{'vcd_sessions':>13} {'transports':>11}")
+    baseline = None
+    start = time.perf_counter()
+    for cycle in range(1, cycles + 1):
+        soak.cycle()
+        if (cycle * interval) // session_interval != ((cycle - 1) * interval) // session_interval:
+            soak.refresh_session()
+        if cycle == warmup or (cycle > warmup and (cycle - warmup) % sample_every == 0) or cycle == cycles:
+            indicators = sample(vcd)
+            if baseline is None:
+                baseline = indicators
+                print(header)
+            print(f"{cycle * interval / 3600:>6.1f} {indicators['threads']:>8} {indicators['atexit']:>7} "
+                  f"{indicators['rss_mb']:>8} {indicators['lxml']:>8} {indicators['objects']:>9} "
+                  f"{indicators['vcd_sessions']:>13} "
+                  f"{indicators['transports']:>11}")
+    duration = time.perf_counter() - start
+    soak.stop()
+    print(f"{cycles} intervals in {duration:.1f}s ({duration / cycles * 1000:.1f}ms per interval), "
+          f"{vcd.requests} vCD requests")
+
+    failures = check_growth(baseline, indicators, {
+        'threads': args.max_threads,
+        'atexit': args.max_atexit,
+        'rss_mb': args.max_rss_mb,
+        'lxml': args.max_lxml,
+        'objects': args.max_objects,
+        'vcd_sessions': args.max_vcd_sessions,
+        'transports': args.max_transports,
+    })
+    if failures:
+        print("Growth beyond the bounds:\n  " + "\n  ".join(failures))
+        sys.exit(1)
+    print("No growth beyond the bounds")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Startup time benchmark of the operator.
+
+Measures, in fresh interpreters:
+
+* the import of `kvcd.main` (configuration and handlers registration) for
+  several sets of enabled modules,
+* the time to open the vCD sessions of several sites, with a simulated
+  latency of the session creation.
+
+No vCloud nor Kubernetes access is needed.
+
+Usage: python benchmarks/startup.py [--runs 5] [--sites 6] [--session-latency 2]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+
+MODULE_SETS = [
+    "kvcdvapps",
+    "kvcdusers",
+    "kvcdpowerschedules",
+    "kvcdvapps,kvcdusers,kvcdpowerschedules",
+]
+
+IMPORT_SCRIPT = """
+import time
+start = time.perf_counter()
+import kvcd.main
+print(time.perf_counter() - start)
+"""
+
+SESSIONS_SCRIPT = """
+import time
+import kvcd.main
+def create_vcdsession(site, site_config):
+    time.sleep({latency})
+    return object()
+kvcd.main.create_vcdsession = create_vcdsession
+start = time.perf_counter()
+kvcd.main.refresh_sessions()
+print(time.perf_counter() - start)
+"""
+
+
+def run(script: str, env: dict, runs: int):
+    """Run a timing script in fresh interpreters.
+
+    Args:
+        script (str): Python script printing a duration
+        env (dict): Environment variables of the interpreters
+        runs (int): Number of runs
+
+    Returns:
+        float: Median duration (in secs)
+    """
+    durations = []
+    with tempfile.TemporaryDirectory() as cwd:  # keep the pyvcloud log file away
+        for _ in range(runs):
+            output = subprocess.run(
+                [sys.executable, "-c", script], env=env, cwd=cwd,
+                check=True, capture_output=True, text=True).stdout
+            durations.append(float(output.strip().splitlines()[-1]))
+    return statistics.median(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="Number of runs of each measure")
+    parser.add_argument("--sites", type=int, default=6, help="Number of simulated sites")
+    parser.add_argument("--session-latency", type=float, default=2.0,
+                        help="Simulated duration (in secs) of a session creation")
+    args = parser.parse_args()
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ,
+               PYTHONPATH=root,
+               KVCD_VCD_HOST="vcd.invalid",
+               KVCD_VCD_PASSWORD="benchmark")
+
+    print(f"Import of kvcd.main (median of {args.runs} runs):")
+    for modules in MODULE_SETS:
+        duration = run(IMPORT_SCRIPT, dict(env, KVCD_ENABLED_MODULES=modules), args.runs)
+        print(f"  {modules:<45} {duration:.3f}s")
+
+    with tempfile.NamedTemporaryFile("w", suffix=".yaml") as sites_file:
+        for i in range(1, args.sites):
+            sites_file.write(f"- name: site{i}\n  host: vcd{i}.invalid\n  password: benchmark\n")
+        sites_file.flush()
+        script = SESSIONS_SCRIPT.format(latency=args.session_latency)
+        duration = run(script, dict(env, KVCD_SITES_FILE=sites_file.name), args.runs)
+    print(f"Opening {args.sites} sessions of {args.session_latency}s each: {duration:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,4 +5,12 @@ __version__ = '0.1.0'
 
 
 # Global configurations
-_available_modules = ["kvcdvapps", "kvcdusers"]
+# kvcd module -> python modules registering its handlers
+_handler_modules = {
+    "kvcdvapps": ["kvcd.vmware.vcloud_vapp", "kvcd.vmware.vcloud_sweep", "kvcd.vmware.vcloud_pool",
+                  "kvcd.vmware.vcloud_webhook"],
+    "kvcdusers": ["kvcd.vmware.vcloud_user"],
+    # The bulk power operations drive the vcdvapps, indexed by the vApp module
+    "kvcdpowerschedules": ["kvcd.vmware.vcloud_vapp", "kvcd.vmware.vcloud_power"],
+}
+_available_modules = list(_handler_modules)
@@ -4,8 +4,10 @@ to setup to use kvcd.
 The main configuration is handled by `environ-config` module.
 """
 
+import os
 import environ
 import logging
+import yaml
 from kvcd import _available_modules
 
 logger = logging.getLogger(__name__)
@@ -40,9 +42,246 @@ class KvcdConfig:
             help="Interval (in secs) between to refresh of the authentication session",
             converter=int)
 
+    @environ.config
+    class SchedulerConfig:
+        """vCD calls scheduler configuration
+        """
+        slots = environ.var(
+            default=32,
+            help="Number of handlers talking to the vCloud instance at the same time",
+            converter=int)
+        lifecycle_share = environ.var(
+            default=1.0,
+            help="Maximum share of the slots used by vApp creations and deletions",
+            converter=float)
+        reconcile_share = environ.var(
+            default=0.75,
+            help="Maximum share of the slots used by spec changes",
+            converter=float)
+        refresh_share = environ.var(
+            default=0.5,
+            help="Maximum share of the slots used by background refreshes",
+            converter=float)
+        starvation_timeout = environ.var(
+            default=30,
+            help="Waiting duration (in secs) after which a lower priority work is run first",
+            converter=int)
+        handler_wait = environ.var(
+            default=10,
+            help="Maximum waiting duration (in secs) of a handler for a slot or for its vApp, before it is retried",
+            converter=int)
+
+    @environ.config
+    class BreakerConfig:
+        """vCD circuit breaker configuration
+        """
+        window = environ.var(
+            default=60,
+            help="Duration (in secs) of the observation window of the vCD requests",
+            converter=int)
+        min_calls = environ.var(
+            default=20,
+            help="Minimum number of requests in the window to evaluate the error rate",
+            converter=int)
+        degraded_error_rate = environ.var(
+            default=0.2,
+            help="Error rate from which background refreshes are shed",
+            converter=float)
+        open_error_rate = environ.var(
+            default=0.5,
+            help="Error rate from which all the work is shed",
+            converter=float)
+        slow_call_duration = environ.var(
+            default=10.0,
+            help="Duration (in secs) after which a vCD request counts as an error",
+            converter=float)
+        open_duration = environ.var(
+            default=30,
+            help="Duration (in secs) of the open state before probing the vCloud instance",
+            converter=int)
+        half_open_probes = environ.var(
+            default=3,
+            help="Number of pieces of work let through as probes, to complete without error to close the circuit",
+            converter=int)
+        state_configmap = environ.var(
+            default="kvcd-endpoints",
+            help="ConfigMap of the operator namespace with the state of the breaker of each site: empty to disable")
+
+    @environ.config
+    class StatusWriterConfig:
+        """Kubernetes status writer configuration
+        """
+        qps = environ.var(
+            default=5.0,
+            help="Sustained number of status writes per second to the Kubernetes API: 0 for no limit",
+            converter=float)
+        burst = environ.var(
+            default=10,
+            help="Number of status writes that can be sent at once to the Kubernetes API",
+            converter=int)
+        max_attempts = environ.var(
+            default=5,
+            help="Number of failed writes of a status update before dropping it",
+            converter=int)
+
+    @environ.config
+    class TracingConfig:
+        """Tracing configuration
+        """
+        file = environ.var(
+            default="",
+            help="JSON lines file where the tracing spans are written")
+        otlp_endpoint = environ.var(
+            default="",
+            help="Base URL of an OTLP/HTTP collector receiving the tracing spans")
+        sample_rate = environ.var(
+            default=0.1,
+            help="Fraction of the handler runs to trace",
+            converter=float)
+
+    @environ.config
+    class PoolConfig:
+        """Warm pools of pre-instantiated vApps
+        """
+        file = environ.var(
+            default="",
+            help="YAML file listing the warm pools of pre-instantiated vApps")
+        concurrency = environ.var(
+            default=2,
+            help="Maximum number of vApps instantiated at the same time to refill the warm pools",
+            converter=int)
+        refill_interval = environ.var(
+            default=300,
+            help="Maximum interval (in secs) between two checks of the warm pools",
+            converter=int)
+
+    @environ.config
+    class TrafficConfig:
+        """Recording and replay of the vCD traffic
+        """
+        record_file = environ.var(
+            default="",
+            help="JSON lines file where the vCD traffic is recorded, {site} being replaced by the site name")
+        replay_file = environ.var(
+            default="",
+            help="Recording served instead of the real vCD traffic, {site} being replaced by the site name")
+        replay_speed = environ.var(
+            default=1.0,
+            help="Acceleration of the replayed response times: 0 to serve them without delay",
+            converter=float)
+
+    @environ.config
+    class ProfilingConfig:
+        """On-demand profiling configuration
+        """
+        port = environ.var(
+            default=0,
+            help="Listening port of the local profiling control endpoint: 0 to disable it",
+            converter=int)
+        host = environ.var(
+            default="127.0.0.1",
+            help="Listening address of the profiling control endpoint")
+        signal = environ.var(
+            default="",
+            help="Name of the signal toggling the profiling, like SIGUSR2: empty to disable it")
+        dir = environ.var(
+            default="/tmp",
+            help="Directory where the profiling data is dumped")
+        sample_interval = environ.var(
+            default=0.01,
+            help="Interval (in secs) between two stack samples while profiling",
+            converter=float)
+
+    @environ.config
+    class LeaderConfig:
+        """Leader election of the operator replicas
+        """
+        enabled = environ.bool_var(
+            default=False,
+            help="Run as a leader or a hot standby, elected with a Kubernetes Lease")
+        lease_name = environ.var(
+            default="kvcd-operator",
+            help="Name of the Lease used for the leader election")
+        namespace = environ.var(
+            default="",
+            help="Namespace of the Lease: the namespace of the operator pod by default")
+        identity = environ.var(
+            default="",
+            help="Identity of this replica in the Lease: the hostname (pod name) by default")
+        lease_duration = environ.var(
+            default=15,
+            help="Duration (in secs) after which a Lease that is not renewed is taken over",
+            converter=int)
+        renew_interval = environ.var(
+            default=2,
+            help="Interval (in secs) between two renewals, or two attempts to acquire the Lease",
+            converter=float)
+        warm_interval = environ.var(
+            default=60,
+            help="Interval (in secs) between two warm-ups of the caches of a standby replica",
+            converter=int)
+        pod_label = environ.var(
+            default="",
+            help="Label set to `true` on the pod of the leader, named after the identity: empty to disable it")
+
+    @environ.config
+    class WebhookConfig:
+        """Validating admission webhook configuration
+        """
+        port = environ.var(
+            default=0,
+            help="Listening port of the validating webhook of the vcdvapps: 0 to disable it",
+            converter=int)
+        addr = environ.var(
+            default="0.0.0.0",
+            help="Listening address of the validating webhook")
+        host = environ.var(
+            default="",
+            help="Hostname of the webhook for the Kubernetes API, like the operator service name")
+        certfile = environ.var(
+            default="",
+            help="TLS certificate of the webhook: a self-signed one is generated by default")
+        pkeyfile = environ.var(
+            default="",
+            help="TLS private key of the webhook")
+        cafile = environ.var(
+            default="",
+            help="CA bundle of the webhook certificate, given to the Kubernetes API: "
+                 "the certificate itself by default")
+
+    @environ.config
+    class RetryConfig:
+        """Retry policy of the handlers
+        """
+        budget = environ.var(
+            default=10,
+            help="Maximum number of handler retries scheduled in the same second: 0 for no limit",
+            converter=int)
+        max_delay = environ.var(
+            default=1800,
+            help="Maximum delay (in secs) before the retry of a handler",
+            converter=int)
+
     vcd = environ.group(
         VcloudConfig,
-        optional=False)
+        optional=True)
+    sites_file = environ.var(
+        default="",
+        help="YAML file listing the vCloud instances (sites) to manage, in addition to the KVCD_VCD_* one")
+    scheduler = environ.group(SchedulerConfig)
+    breaker = environ.group(BreakerConfig)
+    status_writer = environ.group(StatusWriterConfig)
+    tracing = environ.group(TracingConfig)
+    profiling = environ.group(ProfilingConfig)
+    traffic = environ.group(TrafficConfig)
+    pool = environ.group(PoolConfig)
+    leader = environ.group(LeaderConfig)
+    webhook = environ.group(WebhookConfig)
+    retry = environ.group(RetryConfig)
+    metrics_port = environ.var(
+        default=0,
+        help="Listening port of the Prometheus metrics endpoint: 0 to disable it",
+        converter=int)
     refresh_interval = environ.var(
         default=60,
         help="Refresh interval of the vCloud instance data for each object",
@@ -51,12 +290,96 @@ class KvcdConfig:
         default=60,
         help="Warming up duration",
         converter=int)
+    refresh_full_interval = environ.var(
+        default=3600,
+        help="Maximum interval (in secs) between two full reads of an unchanged object",
+        converter=int)
     refresh_idle_delay = environ.var(
         default=60,
         help="Reduce the number of timer checks when the ressource is changed",
         converter=int)
+    max_workers = environ.var(
+        default=32,
+        help="Maximum number of handlers running at the same time",
+        converter=int)
+    delete_concurrency = environ.var(
+        default=10,
+        help="Maximum number of vApp deletions running at the same time",
+        converter=int)
+    task_poll_frequency = environ.var(
+        default=2,
+        help="Interval (in secs) between two checks of a running vCD task",
+        converter=int)
+    power_task_timeout = environ.var(
+        default=600,
+        help="Maximum duration (in secs) of a vApp power operation",
+        converter=int)
+    power_concurrency = environ.var(
+        default=20,
+        help="Maximum number of power operations running at the same time in a bulk power operation",
+        converter=int)
+    power_vdc_concurrency = environ.var(
+        default=5,
+        help="Maximum number of power operations running at the same time in one Org VDC",
+        converter=int)
+    placement_min_free = environ.var(
+        default=0.1,
+        help="Minimum free share of CPU, memory and storage of an Org VDC to place a new vApp in it",
+        converter=float)
+    sweep_interval = environ.var(
+        default=3600,
+        help="Interval (in secs) between two sweeps of the vApps managed by kvcd: 0 to disable it",
+        converter=int)
+    sweep_cleanup = environ.bool_var(
+        default=False,
+        help="Delete the managed vApps without a vcdvapp found by two consecutive sweeps: needs an instance_id")
+    instance_id = environ.var(
+        default="",
+        help="Identifier of this operator deployment, written in the metadata of the vApps it manages")
     enabled_modules = environ.var(
         default=",".join(_available_modules),
         help="Enable a sublist of modules: all by default",
         converter=lambda x: [m.strip() for m in x.split(',')]
     )
+
+
+DEFAULT_SITE = "default"
+
+
+def load_sites(config: KvcdConfig):
+    """Build the configuration of each vCloud instance (site) to manage.
+
+    The site described by the `KVCD_VCD_*` variables is named `default`. The
+    other ones are read from the `KVCD_SITES_FILE` YAML file, as a list of
+    entries with a `name` and the same keys as `KvcdConfig.VcloudConfig`.
+    A `password_env` key can be used instead of `password` to read the
+    password from an environment variable (like a mounted secret).
+
+    Args:
+        config (KvcdConfig): kvcd configuration
+
+    Raises:
+        ValueError: Invalid or empty sites configuration
+
+    Returns:
+        dict: `KvcdConfig.VcloudConfig` by site name
+    """
+    sites = {}
+    if config.vcd is not None:
+        sites[DEFAULT_SITE] = config.vcd
+    if config.sites_file:
+        with open(config.sites_file) as f:
+            entries = yaml.safe_load(f) or []
+        for entry in entries:
+            entry = dict(entry)
+            name = entry.pop('name', None)
+            if not name or name in sites:
+                raise ValueError(f"Missing or duplicated site name in {config.sites_file}: {name}")
+            password_env = entry.pop('password_env', None)
+            if password_env:
+                entry['password'] = os.environ[password_env]
+            sites[name] = KvcdConfig.VcloudConfig(**entry)
+            logger.debug(f"Site {name} loaded from {config.sites_file}")
+    if not sites:
+        raise ValueError("No vCloud instance configured: set KVCD_VCD_HOST or KVCD_SITES_FILE")
+    return sites
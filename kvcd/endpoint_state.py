@@ -0,0 +1,109 @@
+"""Operator level view of the state of the vCD circuit breakers.
+
+The state of the circuit breaker of each site is written to a single ConfigMap,
+at each transition: one write per transition of a site, whatever the number of
+objects. Only the leading replica writes it.
+
+For each site, the ConfigMap holds the state (`<site>`: closed, degraded,
+half-open or open) and the time of the transition (`<site>.since`).
+"""
+
+import logging
+import threading
+from datetime import datetime, timezone
+
+from kvcd.kube_helper import set_config_map_data
+
+
+logger = logging.getLogger(__name__)
+
+# Delay (in secs) before the retry of a failed write, doubled at each attempt up to the maximum
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 60
+
+
+class EndpointStatePublisher:
+    """Writer of the circuit breakers state to a ConfigMap, from a worker thread.
+    """
+
+    def __init__(self, name: str):
+        """Define the publisher
+
+        Args:
+            name (str): Name of the ConfigMap
+        """
+        self.name = name
+        self.namespace = None
+        self._cond = threading.Condition()
+        self._pending = {}  # ConfigMap entries not written yet
+        self._thread = None
+        self._stopping = False
+
+    def notify(self, endpoint: str, state):
+        """Record a transition of the breaker of an endpoint.
+
+        Called under the lock of the breaker: it only queues the new state.
+
+        Args:
+            endpoint (str): Name of the site
+            state (BreakerState): New state of the breaker
+        """
+        since = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        with self._cond:
+            self._pending[endpoint] = state.value
+            self._pending[f'{endpoint}.since'] = since
+            self._cond.notify()
+
+    def start(self, namespace: str):
+        """Start writing the states, the ones recorded so far first.
+
+        Args:
+            namespace (str): Namespace of the ConfigMap
+        """
+        with self._cond:
+            if self._thread is not None:
+                return
+            self.namespace = namespace
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='kvcd-endpoint-state', daemon=True)
+            self._thread.start()
+        logger.debug(f"Publishing the vCD endpoints state in ConfigMap {namespace}/{self.name}")
+
+    def stop(self, timeout: float = None):
+        """Write the pending states and stop the worker thread.
+
+        Args:
+            timeout (float, optional): Maximum duration (in secs) of the flush. Defaults to None.
+        """
+        with self._cond:
+            thread = self._thread
+            self._stopping = True
+            self._cond.notify()
+        if thread is not None:
+            thread.join(timeout)
+        with self._cond:
+            self._thread = None
+
+    def _run(self):
+        delay = RETRY_DELAY
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopping:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                data, self._pending = self._pending, {}
+            try:
+                set_config_map_data(self.namespace, self.name, data)
+                delay = RETRY_DELAY
+                continue
+            except Exception as e:
+                logger.warning(f"Failed to write the vCD endpoints state in ConfigMap "
+                               f"{self.namespace}/{self.name}: {e}")
+            with self._cond:
+                # The states recorded meanwhile are newer
+                self._pending = dict(data, **self._pending)
+                if self._stopping:
+                    return
+                self._cond.wait(delay)
+            delay = min(MAX_RETRY_DELAY, delay * 2)
@@ -0,0 +1,242 @@
+"""Set of helpers to call the Kubernetes API outside of the kopf handlers patches.
+"""
+
+import base64
+import logging
+import threading
+from datetime import datetime, timezone
+import kubernetes
+
+
+logger = logging.getLogger(__name__)
+
+GROUP = 'kvcd.lrivallain.dev'
+VERSION = 'v1'
+
+_api_client = None
+_api_client_lock = threading.Lock()
+
+
+def micro_time(when: datetime):
+    """Format a time as a Kubernetes MicroTime, like the times of a Lease.
+
+    Args:
+        when (datetime): Time, timezone aware
+
+    Returns:
+        str: UTC time with microseconds, like `2021-01-01T00:00:00.000000Z`
+    """
+    return when.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class MicroTimeApiClient(kubernetes.client.ApiClient):
+    """Kubernetes API client sending the times as MicroTimes.
+
+    The generated client sends them with `isoformat`, without any microseconds
+    when they are 0: the MicroTime fields, like the times of a Lease, reject
+    that. The Time fields accept a MicroTime.
+    """
+
+    def sanitize_for_serialization(self, obj):
+        if isinstance(obj, datetime):
+            return micro_time(obj)
+        return super().sanitize_for_serialization(obj)
+
+
+def get_api_client():
+    """Get a Kubernetes API client, loading the configuration on first use.
+
+    The in-cluster configuration is used when running in a pod, the local
+    kubeconfig otherwise.
+
+    Returns:
+        kubernetes.client.ApiClient: Kubernetes API client
+    """
+    global _api_client
+    with _api_client_lock:
+        if _api_client is None:
+            try:
+                kubernetes.config.load_incluster_config()
+                logger.debug("Kubernetes in-cluster configuration loaded")
+            except kubernetes.config.ConfigException:
+                kubernetes.config.load_kube_config()
+                logger.debug("Kubernetes kubeconfig configuration loaded")
+            _api_client = MicroTimeApiClient()
+    return _api_client
+
+
+def patch_custom_object(plural: str, namespace: str, name: str, body: dict):
+    """Apply a merge patch to a kvcd custom object.
+
+    Args:
+        plural (str): Plural name of the custom resource
+        namespace (str): Namespace of the object
+        name (str): Name of the object
+        body (dict): Patch to apply
+
+    Returns:
+        dict: Patched object
+    """
+    api = kubernetes.client.CustomObjectsApi(get_api_client())
+    return api.patch_namespaced_custom_object(
+        group=GROUP, version=VERSION, namespace=namespace,
+        plural=plural, name=name, body=body)
+
+
+def post_event(kind: str, namespace: str, name: str, uid: str,
+               event_type: str, reason: str, message: str):
+    """Post a Kubernetes event about a kvcd custom object.
+
+    Unlike `kopf.event`, this can be called from any thread.
+
+    Args:
+        kind (str): Kind of the custom resource
+        namespace (str): Namespace of the object
+        name (str): Name of the object
+        uid (str): UID of the object
+        event_type (str): `Normal` or `Warning`
+        reason (str): Short reason of the event
+        message (str): Message of the event
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    body = {
+        'metadata': {'generateName': f'{name}.', 'namespace': namespace},
+        'involvedObject': {
+            'apiVersion': f'{GROUP}/{VERSION}',
+            'kind': kind,
+            'name': name,
+            'namespace': namespace,
+            'uid': uid,
+        },
+        'type': event_type,
+        'reason': reason,
+        'message': message[:1024],
+        'source': {'component': 'kvcd'},
+        'firstTimestamp': now,
+        'lastTimestamp': now,
+        'count': 1,
+    }
+    api = kubernetes.client.CoreV1Api(get_api_client())
+    api.create_namespaced_event(namespace=namespace, body=body)
+
+
+def read_secret_value(namespace: str, name: str, key: str):
+    """Read a value of a Kubernetes secret.
+
+    Args:
+        namespace (str): Namespace of the secret
+        name (str): Name of the secret
+        key (str): Key of the value in the secret
+
+    Returns:
+        str: Decoded value
+    """
+    api = kubernetes.client.CoreV1Api(get_api_client())
+    secret = api.read_namespaced_secret(name=name, namespace=namespace)
+    return base64.b64decode(secret.data[key]).decode()
+
+
+def list_custom_objects(plural: str):
+    """List the kvcd custom objects of a kind, in all the namespaces.
+
+    Args:
+        plural (str): Plural name of the custom resource
+
+    Returns:
+        list: Objects
+    """
+    api = kubernetes.client.CustomObjectsApi(get_api_client())
+    return api.list_cluster_custom_object(group=GROUP, version=VERSION, plural=plural).get('items', [])
+
+
+def read_lease(namespace: str, name: str):
+    """Read a coordination lease.
+
+    Args:
+        namespace (str): Namespace of the lease
+        name (str): Name of the lease
+
+    Returns:
+        kubernetes.client.V1Lease: Lease
+    """
+    api = kubernetes.client.CoordinationV1Api(get_api_client())
+    return api.read_namespaced_lease(name=name, namespace=namespace)
+
+
+def create_lease(namespace: str, name: str, spec: dict):
+    """Create a coordination lease.
+
+    Args:
+        namespace (str): Namespace of the lease
+        name (str): Name of the lease
+        spec (dict): Lease specs
+
+    Returns:
+        kubernetes.client.V1Lease: Created lease
+    """
+    api = kubernetes.client.CoordinationV1Api(get_api_client())
+    body = {'metadata': {'name': name, 'namespace': namespace}, 'spec': spec}
+    return api.create_namespaced_lease(namespace=namespace, body=body)
+
+
+def replace_lease(lease):
+    """Replace a coordination lease, if it was not changed since it was read.
+
+    Args:
+        lease (kubernetes.client.V1Lease): Lease, with the resource version it was read with
+
+    Raises:
+        kubernetes.client.rest.ApiException: 409 if the lease changed meanwhile
+
+    Returns:
+        kubernetes.client.V1Lease: Replaced lease
+    """
+    api = kubernetes.client.CoordinationV1Api(get_api_client())
+    return api.replace_namespaced_lease(name=lease.metadata.name, namespace=lease.metadata.namespace, body=lease)
+
+
+def patch_pod_labels(namespace: str, name: str, labels: dict):
+    """Set or remove (with a None value) labels of a pod.
+
+    Args:
+        namespace (str): Namespace of the pod
+        name (str): Name of the pod
+        labels (dict): Labels to set, or to remove
+
+    Returns:
+        kubernetes.client.V1Pod: Patched pod
+    """
+    api = kubernetes.client.CoreV1Api(get_api_client())
+    return api.patch_namespaced_pod(name=name, namespace=namespace, body={'metadata': {'labels': labels}})
+
+
+def delete_lease(namespace: str, name: str):
+    """Delete a coordination lease.
+
+    Args:
+        namespace (str): Namespace of the lease
+        name (str): Name of the lease
+    """
+    api = kubernetes.client.CoordinationV1Api(get_api_client())
+    api.delete_namespaced_lease(name=name, namespace=namespace)
+
+
+def set_config_map_data(namespace: str, name: str, data: dict):
+    """Set entries of a ConfigMap, creating it if missing.
+
+    Args:
+        namespace (str): Namespace of the ConfigMap
+        name (str): Name of the ConfigMap
+        data (dict): Entries to set
+
+    Returns:
+        kubernetes.client.V1ConfigMap: Patched or created ConfigMap
+    """
+    api = kubernetes.client.CoreV1Api(get_api_client())
+    try:
+        return api.patch_namespaced_config_map(name=name, namespace=namespace, body={'data': data})
+    except kubernetes.client.rest.ApiException as e:
+        if e.status != 404:
+            raise
+    body = {'metadata': {'name': name, 'namespace': namespace}, 'data': data}
+    return api.create_namespaced_config_map(namespace=namespace, body=body)
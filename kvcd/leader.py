@@ -0,0 +1,213 @@
+"""Leader election of the operator replicas, based on a Kubernetes Lease.
+
+Only the leader handles the objects. The other replicas are hot standbys: they
+keep their vCD sessions and caches warm, and take over as soon as the lease is
+released (graceful shutdown of the leader) or expires (loss of its node).
+
+A standby does not watch the objects: kopf starts its watchers only once the
+startup handlers are done, and a standby waits for the leadership in one of
+them. It lists the objects from time to time to warm its vCD caches instead,
+and kopf lists them again when the replica takes over.
+
+The leader can label its own pod, so that a Service selecting this label (the
+admission webhook) only routes to the leader.
+"""
+
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from kubernetes.client.rest import ApiException
+from kvcd.kube_helper import micro_time, read_lease, create_lease, replace_lease, patch_pod_labels
+from kvcd.metrics import gauge
+
+
+logger = logging.getLogger(__name__)
+
+SERVICE_ACCOUNT_NAMESPACE_FILE = '/var/run/secrets/kubernetes.io/serviceaccount/namespace'
+
+_LEADER = gauge(
+    'kvcd_leader',
+    'Whether this replica is the leader: 1 for the leader, 0 for a standby')
+
+
+def current_namespace(default: str = 'kvcd-system'):
+    """Namespace of the operator pod.
+
+    Args:
+        default (str, optional): Namespace outside of a pod. Defaults to 'kvcd-system'.
+
+    Returns:
+        str: Namespace
+    """
+    try:
+        with open(SERVICE_ACCOUNT_NAMESPACE_FILE) as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+
+def _on_leadership_lost():
+    """Stop the operator gracefully: it restarts as a standby.
+    """
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+class LeaderElector:
+    """Acquire and renew a Kubernetes Lease in a background thread.
+    """
+
+    def __init__(self, lease_name: str, namespace: str = None, identity: str = None,
+                 lease_duration: int = 15, renew_interval: float = 2, on_lost=_on_leadership_lost,
+                 pod_label: str = None):
+        """Define the elector
+
+        Args:
+            lease_name (str): Name of the lease
+            namespace (str, optional): Namespace of the lease. Defaults to the namespace of the pod.
+            identity (str, optional): Identity of this replica. Defaults to the hostname (pod name).
+            lease_duration (int, optional): Duration (in secs) after which a lease that is not
+                renewed can be taken over. Defaults to 15.
+            renew_interval (float, optional): Interval (in secs) between two renewals, or two
+                attempts to acquire the lease. Defaults to 2.
+            on_lost (callable, optional): Called when the leadership is lost. Defaults to a
+                graceful stop of the operator.
+            pod_label (str, optional): Label set to `true` on the pod of the leader, named
+                after the identity, while it leads. Defaults to None (no label).
+        """
+        self.lease_name = lease_name
+        self.namespace = namespace or current_namespace()
+        self.identity = identity or socket.gethostname()
+        self.lease_duration = lease_duration
+        self.renew_interval = renew_interval
+        self.on_lost = on_lost
+        self.pod_label = pod_label
+        self._labeled = False
+        self.is_leader = threading.Event()
+        self._renewed_at = 0
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the election in the background.
+        """
+        logger.info(f"Waiting for the leadership of lease {self.namespace}/{self.lease_name} as {self.identity}")
+        self._thread = threading.Thread(target=self._run, name='kvcd-leader-election', daemon=True)
+        self._thread.start()
+
+    def stop(self, release: bool = True):
+        """Stop the election, and release the lease to let a standby take over at once.
+
+        Args:
+            release (bool, optional): Release the lease if held. Defaults to True.
+        """
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._label_pod(False)
+        if release and self.is_leader.is_set():
+            try:
+                self._release()
+                logger.info(f"Lease {self.namespace}/{self.lease_name} released")
+            except Exception as e:
+                logger.warning(f"Failed to release the lease {self.namespace}/{self.lease_name}: {e}")
+        self.is_leader.clear()
+
+    def _label_pod(self, leader: bool):
+        """Set the leader label of the pod, or remove it.
+
+        Args:
+            leader (bool): Whether this replica leads
+        """
+        if not self.pod_label or leader == self._labeled:
+            return
+        try:
+            patch_pod_labels(self.namespace, self.identity, {self.pod_label: 'true' if leader else None})
+            self._labeled = leader
+        except Exception as e:
+            logger.warning(f"Failed to {'set' if leader else 'remove'} the label {self.pod_label} "
+                           f"of the pod {self.namespace}/{self.identity}: {e}")
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                leader = self._try_acquire_or_renew()
+                if leader:
+                    self._renewed_at = time.monotonic()
+            except Exception as e:
+                logger.warning(f"Failed to acquire or renew the lease {self.namespace}/{self.lease_name}: {e}")
+                # Keep the leadership until the lease may have been taken over
+                leader = (self.is_leader.is_set() and
+                          time.monotonic() - self._renewed_at < self.lease_duration - self.renew_interval)
+            if leader and not self.is_leader.is_set():
+                logger.warning(f"{self.identity} is now the leader")
+                self.is_leader.set()
+                _LEADER.set(1)
+                self._label_pod(True)
+            elif not leader and self.is_leader.is_set():
+                logger.error(f"{self.identity} lost the leadership")
+                self.is_leader.clear()
+                _LEADER.set(0)
+                self._label_pod(False)
+                self.on_lost()
+                return
+            elif not leader:
+                _LEADER.set(0)
+            self._stopping.wait(self.renew_interval)
+
+    def _try_acquire_or_renew(self):
+        """Acquire the lease if it is free or expired, or renew it if it is held.
+
+        Returns:
+            bool: Whether this replica holds the lease
+        """
+        now = datetime.now(timezone.utc)
+        try:
+            lease = read_lease(self.namespace, self.lease_name)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            try:
+                create_lease(self.namespace, self.lease_name, {
+                    'holderIdentity': self.identity,
+                    'leaseDurationSeconds': self.lease_duration,
+                    'acquireTime': micro_time(now),
+                    'renewTime': micro_time(now),
+                    'leaseTransitions': 0,
+                })
+            except ApiException as e:
+                if e.status == 409:  # created by another replica meanwhile
+                    return False
+                raise
+            return True
+
+        spec = lease.spec
+        if spec.holder_identity != self.identity:
+            renew_time = spec.renew_time or spec.acquire_time
+            duration = spec.lease_duration_seconds or self.lease_duration
+            if spec.holder_identity and renew_time and renew_time + timedelta(seconds=duration) > now:
+                return False  # held by another replica
+            spec.holder_identity = self.identity
+            spec.acquire_time = now
+            spec.lease_transitions = (spec.lease_transitions or 0) + 1
+        spec.lease_duration_seconds = self.lease_duration
+        spec.renew_time = now
+        try:
+            replace_lease(lease)
+        except ApiException as e:
+            if e.status == 409:  # changed by another replica meanwhile
+                return False
+            raise
+        return True
+
+    def _release(self):
+        lease = read_lease(self.namespace, self.lease_name)
+        if lease.spec.holder_identity != self.identity:
+            return
+        lease.spec.holder_identity = None
+        lease.spec.renew_time = None
+        replace_lease(lease)
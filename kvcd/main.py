@@ -1,31 +1,85 @@
 """This module is the one to run with `kopf run` command to start the operator.
 
-Warning: It contains a global named `get_vcd_session`, populated after the project is started.
+Warning: It contains a global named `vcd_sessions`, populated after the project is started.
 This is probably something to cleanup in the future.
 """
 
 import kopf
+import os
 import time
+import asyncio
+import importlib
 import logging
-import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv, find_dotenv
-from kvcd.vmware.vcloud_helper import VcdSession
+from kvcd.metrics import start_metrics_server
+from kvcd.status_writer import StatusWriter
+from kvcd.endpoint_state import EndpointStatePublisher
+from kvcd.tracing import configure_tracing
 from kvcd.utils import setInterval
-from kvcd.config import KvcdConfig
-from kvcd import _available_modules
+from kvcd.config import KvcdConfig, load_sites, DEFAULT_SITE
+from kvcd import _available_modules, _handler_modules
 
 
 logger = logging.getLogger(__name__)
 
 
-vcd_session = None
-def get_vcd_session():
-    """Return the current version of `vcd_session`
+vcd_sessions = {}
+
+
+def resolve_site(site: str = None):
+    """Return the name of a configured site
+
+    Args:
+        site (str, optional): Name of the site. Defaults to the `default` site,
+            or to the only configured one.
+
+    Raises:
+        kopf.PermanentError: Unknown site
+
+    Returns:
+        str: Name of the site
+    """
+    if site is None:
+        if DEFAULT_SITE in vcd_sites:
+            return DEFAULT_SITE
+        if len(vcd_sites) == 1:
+            return next(iter(vcd_sites))
+        raise kopf.PermanentError(f"A site must be selected in: {', '.join(vcd_sites)}")
+    if site not in vcd_sites:
+        raise kopf.PermanentError(f"Unknown site: {site}")
+    return site
+
+
+def get_vcd_session(site: str = None):
+    """Return the current version of the `VcdSession` of a site
+
+    The sessions are opened in the background at startup: outside of the event
+    loop, the caller waits for a while for the session to be ready.
+
+    Args:
+        site (str, optional): Name of the site. Defaults to the `default` site,
+            or to the only configured one.
+
+    Raises:
+        kopf.PermanentError: Unknown site
+        kopf.TemporaryError: The session of the site is not ready yet
 
     Returns:
-        VcdSession: current version of `vcd_session`
+        VcdSession: current version of the site `VcdSession`
     """
-    return vcd_session
+    site = resolve_site(site)
+    ready = _sessions_ready[site]
+    if not ready.is_set():
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # Handler thread: it is fine to block
+            ready.wait(SESSION_WAIT_TIMEOUT)
+        if not ready.is_set():
+            raise kopf.TemporaryError(f"The vCD session of site {site} is not ready yet", delay=10)
+    return vcd_sessions[site]
 
 
 # load dotenv file
@@ -37,60 +91,303 @@ except IOError:
     pass
 # parse configuration from env
 kvcd_config = KvcdConfig.from_environ()
-logger.info("Configuration is loaded")
+vcd_sites = load_sites(kvcd_config)
+logger.info(f"Configuration is loaded with sites: {', '.join(vcd_sites)}")
+_sessions_ready = {site: threading.Event() for site in vcd_sites}
+SESSION_WAIT_TIMEOUT = 30
+SESSION_REFRESH_INTERVAL = min(site.refresh_session_interval for site in vcd_sites.values())
+
+configure_tracing(
+    file=kvcd_config.tracing.file,
+    otlp_endpoint=kvcd_config.tracing.otlp_endpoint,
+    sample_rate=kvcd_config.tracing.sample_rate)
+
+# Shared writer of the objects status
+status_writer = StatusWriter(
+    qps=kvcd_config.status_writer.qps,
+    burst=kvcd_config.status_writer.burst,
+    max_attempts=kvcd_config.status_writer.max_attempts)
+
+# State of the circuit breaker of each site, written by the leader
+endpoint_states = None
+if kvcd_config.breaker.state_configmap:
+    endpoint_states = EndpointStatePublisher(kvcd_config.breaker.state_configmap)
+
+# On-demand profiler, toggled by a signal or through a local endpoint: only when one of them is configured
+profiler = None
+if kvcd_config.profiling.signal or kvcd_config.profiling.port:
+    from kvcd.profiling import Profiler, install_profiling_signal
+    profiler = Profiler(
+        output_dir=kvcd_config.profiling.dir,
+        sample_interval=kvcd_config.profiling.sample_interval)
+    if kvcd_config.profiling.signal and threading.current_thread() is threading.main_thread():
+        install_profiling_signal(profiler, kvcd_config.profiling.signal)
+
+# Set once this replica leads: at once without leader election
+leadership = threading.Event()
+leader_elector = None
+if kvcd_config.leader.enabled:
+    from kvcd.leader import LeaderElector
+    leader_elector = LeaderElector(
+        lease_name=kvcd_config.leader.lease_name,
+        namespace=kvcd_config.leader.namespace or None,
+        identity=kvcd_config.leader.identity or None,
+        lease_duration=kvcd_config.leader.lease_duration,
+        renew_interval=kvcd_config.leader.renew_interval,
+        pod_label=kvcd_config.leader.pod_label or None)
+else:
+    leadership.set()
+
+
+def publish_endpoint_states():
+    """Start writing the state of the circuit breakers, once this replica leads.
+    """
+    if endpoint_states is None:
+        return
+    from kvcd.leader import current_namespace
+
+    endpoint_states.start(kvcd_config.leader.namespace or current_namespace())
+
+
+def wait_for_leadership(stopping: threading.Event):
+    """Block a background thread until this replica leads
+
+    Args:
+        stopping (threading.Event): Stop flag of the background thread
+
+    Returns:
+        bool: False if the thread was stopped meanwhile
+    """
+    while not leadership.wait(1):
+        if stopping.is_set():
+            return False
+    return True
+
+
+@kopf.on.startup()
+def startup_kvcd(logger, settings: kopf.OperatorSettings, **kwargs):
+    """Startup function: open the vCD sessions in the background
+    """
+    settings.execution.max_workers = kvcd_config.max_workers
+    if kvcd_config.webhook.port:
+        certfile = kvcd_config.webhook.certfile or None
+        pkeyfile = kvcd_config.webhook.pkeyfile or None
+        if certfile and not os.path.exists(certfile):
+            # The secret of the certificate is optional in the deployment
+            logger.warning(f"Webhook certificate {certfile} not found: using a self-signed one")
+            certfile = pkeyfile = None
+        settings.admission.server = kopf.WebhookServer(
+            addr=kvcd_config.webhook.addr,
+            port=kvcd_config.webhook.port,
+            host=kvcd_config.webhook.host or None,
+            certfile=certfile,
+            pkeyfile=pkeyfile,
+            cafile=kvcd_config.webhook.cafile or None)
+        settings.admission.managed = 'kvcd.lrivallain.dev'
+        if leader_elector is not None and not certfile:
+            logger.warning("Each replica generates its own webhook certificate: the Kubernetes API only trusts "
+                           "the last registered one. Set KVCD_WEBHOOK_CERTFILE to share one certificate")
+    if kvcd_config.metrics_port:
+        start_metrics_server(kvcd_config.metrics_port)
+    if kvcd_config.profiling.port:
+        from kvcd.profiling import start_profiling_server
+        start_profiling_server(profiler, kvcd_config.profiling.host, kvcd_config.profiling.port)
+    status_writer.start()
+    if leader_elector is None:
+        publish_endpoint_states()
+    # Do not wait for vCD: kopf starts its initial listing meanwhile
+    threading.Thread(target=open_vcdsessions, name='kvcd-vcd-sessions', daemon=True).start()
 
 
 @kopf.on.startup()
-def startup_kvcd(logger, **kwargs):
-    """Startup function: create the vCD session
+async def elect_leader(logger, **kwargs):
+    """Startup function: wait for the leadership, if enabled
+
+    kopf only starts to watch and handle the objects once the startup functions
+    are done: meanwhile, a standby replica keeps its caches warm in the
+    background, from a periodic listing of the objects.
+    """
+    if leader_elector is None:
+        return
+    leader_elector.start()
+    threading.Thread(target=warm_standby_caches, name='kvcd-standby-warmup', daemon=True).start()
+    while not leader_elector.is_leader.is_set():
+        await asyncio.sleep(0.5)
+    leadership.set()
+    publish_endpoint_states()
+    logger.info("Leading: handling the objects")
+
+
+def warm_standby_caches():
+    """Keep the caches of the vCD sessions warm until this replica leads.
     """
-    refresh_vcdsession()
-    logger.info("vCD session is now ready")
+    from kvcd.vmware.vcloud_standby import warm_caches
 
+    for ready in _sessions_ready.values():
+        if leader_elector.is_leader.is_set():
+            return
+        ready.wait(SESSION_WAIT_TIMEOUT)
+    while True:
+        try:
+            warm_caches(vcd_sessions, resolve_site)
+        except Exception as e:
+            logger.warning(f"Failed to warm up the standby caches: {e}")
+        if leader_elector.is_leader.wait(kvcd_config.leader.warm_interval):
+            return
 
-@setInterval(sec=kvcd_config.vcd.refresh_session_interval)
+
+@kopf.on.cleanup()
+def cleanup_kvcd(logger, **kwargs):
+    """Cleanup function: flush the pending status updates and the running profiling,
+    then release the leadership
+    """
+    status_writer.stop(timeout=30)
+    if endpoint_states is not None:
+        endpoint_states.stop(timeout=5)
+    if profiler is not None:
+        profiler.stop()
+    if leader_elector is not None:
+        leader_elector.stop(release=True)
+
+
+def open_vcdsessions():
+    """Open the vCD sessions of all the sites, retrying the failed ones, then
+    keep them refreshed.
+    """
+    delay = 5
+    while not refresh_sessions():
+        logger.warning(f"Some vCD sessions are not opened: retrying in {delay}s")
+        time.sleep(delay)
+        delay = min(delay * 2, 300)
+    logger.info("vCD sessions are now ready")
+    # Daemon timer: the exit must not wait for the next refresh
+    timer = threading.Timer(SESSION_REFRESH_INTERVAL, refresh_vcdsession)
+    timer.daemon = True
+    timer.start()
+
+
+@setInterval(sec=SESSION_REFRESH_INTERVAL)
 def refresh_vcdsession():
-    """Refresh the vCD session
+    """Refresh the vCD sessions
 
-    This function is run on a regular basis to update `vcd_session` with
-    a working pyvcloud client.
+    This function is run on a regular basis to update `vcd_sessions` with
+    a working pyvcloud client for each site.
     """
-    # create the vcd session
-    global vcd_session
-    if isinstance(vcd_session, VcdSession):
-        logger.debug("Refreshing the vCD session")
-        vcd_session.rehydrate()
-    else:
-        logger.debug("Creating a fresh new vCD session")
-        vcd_session = VcdSession(
-            hostname=kvcd_config.vcd.host,
-            port=kvcd_config.vcd.port,
-            username=kvcd_config.vcd.username,
-            password=kvcd_config.vcd.password,
-            organisation=kvcd_config.vcd.org,
-            verify_ssl=kvcd_config.vcd.verify_ssl,
-        )
-
-
-# Import the resources management functions according to the configuration
+    refresh_sessions()
+
+
+def refresh_sessions():
+    """Create or refresh the vCD session of each site, in parallel
+
+    Returns:
+        bool: Whether every site has a session
+    """
+    with ThreadPoolExecutor(max_workers=len(vcd_sites)) as executor:
+        return all(executor.map(refresh_site_session, vcd_sites))
+
+
+def refresh_site_session(site: str):
+    """Create or refresh the vCD session of a site
+
+    Args:
+        site (str): Name of the site
+
+    Returns:
+        bool: Whether the site has a session
+    """
+    vcd_session = vcd_sessions.get(site)
+    try:
+        if vcd_session is not None:
+            logger.debug(f"Refreshing the vCD session of site {site}")
+            vcd_session.rehydrate()
+        else:
+            logger.debug(f"Creating a fresh new vCD session for site {site}")
+            vcd_sessions[site] = create_vcdsession(site, vcd_sites[site])
+            _sessions_ready[site].set()
+            logger.info(f"vCD session of site {site} is ready")
+    except Exception as e:
+        logger.error(f"Cannot open the vCD session of site {site}: {e}")
+    return site in vcd_sessions
+
+
+def create_traffic(site: str):
+    """Create the recording or the replay of the vCD traffic of a site, if configured
+
+    Args:
+        site (str): Name of the site
+
+    Returns:
+        TrafficRecorder|TrafficReplay: Recording or replay of the traffic, or None
+    """
+    if kvcd_config.traffic.replay_file:
+        from kvcd.vmware.vcloud_traffic import TrafficReplay
+        return TrafficReplay(
+            kvcd_config.traffic.replay_file.format(site=site),
+            speed=kvcd_config.traffic.replay_speed)
+    if kvcd_config.traffic.record_file:
+        from kvcd.vmware.vcloud_traffic import TrafficRecorder
+        return TrafficRecorder(kvcd_config.traffic.record_file.format(site=site))
+    return None
+
+
+# Recording or replay of the vCD traffic, by site
+vcd_traffic = {site: create_traffic(site) for site in vcd_sites}
+
+
+def create_vcdsession(site: str, site_config: KvcdConfig.VcloudConfig):
+    """Create the vCD session of a site, with its own scheduler and circuit breaker
+
+    Args:
+        site (str): Name of the site
+        site_config (KvcdConfig.VcloudConfig): Configuration of the site
+
+    Returns:
+        VcdSession: vCD session of the site
+    """
+    from kvcd.vmware.vcloud_breaker import CircuitBreaker
+    from kvcd.vmware.vcloud_helper import VcdSession
+    from kvcd.vmware.vcloud_scheduler import PriorityScheduler, Priority
+
+    breaker = CircuitBreaker(
+        endpoint=site,
+        window=kvcd_config.breaker.window,
+        min_calls=kvcd_config.breaker.min_calls,
+        degraded_error_rate=kvcd_config.breaker.degraded_error_rate,
+        open_error_rate=kvcd_config.breaker.open_error_rate,
+        slow_call_duration=kvcd_config.breaker.slow_call_duration,
+        open_duration=kvcd_config.breaker.open_duration,
+        half_open_probes=kvcd_config.breaker.half_open_probes,
+        on_transition=endpoint_states.notify if endpoint_states is not None else None)
+    return VcdSession(
+        hostname=site_config.host,
+        port=site_config.port,
+        username=site_config.username,
+        password=site_config.password,
+        organisation=site_config.org,
+        verify_ssl=site_config.verify_ssl,
+        scheduler=PriorityScheduler(
+            slots=kvcd_config.scheduler.slots,
+            shares={
+                Priority.LIFECYCLE: kvcd_config.scheduler.lifecycle_share,
+                Priority.RECONCILE: kvcd_config.scheduler.reconcile_share,
+                Priority.REFRESH: kvcd_config.scheduler.refresh_share,
+            },
+            starvation_timeout=kvcd_config.scheduler.starvation_timeout,
+            breaker=breaker,
+            handler_wait=kvcd_config.scheduler.handler_wait),
+        breaker=breaker,
+        inventory_max_age=kvcd_config.refresh_interval,
+        traffic=vcd_traffic.get(site),
+    )
+
+
+# Import the handlers of the enabled modules only: importing a module registers its handlers
 logger.debug(f"Available modules: {_available_modules}")
 logger.debug(f"Enabled modules: {kvcd_config.enabled_modules}")
 for kvcd_module in _available_modules:
     if kvcd_module in kvcd_config.enabled_modules:
         logger.debug(f"Importing {kvcd_module} components")
-        if kvcd_module == "kvcdvapps":
-            from kvcd.vmware.vcdvapps import create_vcdvapp
-            from kvcd.vmware.vcdvapps import delete_vcdvapp
-            from kvcd.vmware.vcdvapps import update_vcdvapp_description
-            from kvcd.vmware.vcdvapps import update_vcdvapp_power_state
-            from kvcd.vmware.vcdvapps import update_vcdvapp_owner
-            from kvcd.vmware.vcdvapps import update_vcdvapp_lease_info
-            from kvcd.vmware.vcdvapps import update_vcdvapp_metadata
-            from kvcd.vmware.vcdvapps import refresh_vcdvapp
-        # elif kvcd_module == "kvcdusers":
-        #     from kvcd.vmware.vcdusers import create_vcduser
-        #     from kvcd.vmware.vcdusers import delete_vcduser
-        #     from kvcd.vmware.vcdusers import update_vcduser
-        #     from kvcd.vmware.vcdusers import refresh_vcduser
+        for handler_module in _handler_modules[kvcd_module]:
+            importlib.import_module(handler_module)
     else:
         logger.debug(f"Module {kvcd_module} is not enabled")
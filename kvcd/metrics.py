@@ -0,0 +1,93 @@
+"""Prometheus metrics of the operator.
+
+`prometheus_client` is an optional dependency (`pip install kvcd[metrics]`):
+without it, the metrics are no-op objects and nothing is exposed.
+"""
+
+import logging
+
+try:
+    import prometheus_client
+except ImportError:  # pragma: no cover
+    prometheus_client = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class _NoopMetric:
+    """Metric placeholder used when `prometheus_client` is not installed.
+    """
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def set(self, *args, **kwargs):
+        pass
+
+    def inc(self, *args, **kwargs):
+        pass
+
+    def observe(self, *args, **kwargs):
+        pass
+
+
+def gauge(name: str, documentation: str, labelnames: tuple = ()):
+    """Define a gauge metric.
+
+    Args:
+        name (str): Name of the metric
+        documentation (str): Help of the metric
+        labelnames (tuple, optional): Names of the labels. Defaults to ().
+
+    Returns:
+        prometheus_client.Gauge: Gauge, or a no-op metric
+    """
+    if prometheus_client is None:
+        return _NoopMetric()
+    return prometheus_client.Gauge(name, documentation, labelnames)
+
+
+def counter(name: str, documentation: str, labelnames: tuple = ()):
+    """Define a counter metric.
+
+    Args:
+        name (str): Name of the metric
+        documentation (str): Help of the metric
+        labelnames (tuple, optional): Names of the labels. Defaults to ().
+
+    Returns:
+        prometheus_client.Counter: Counter, or a no-op metric
+    """
+    if prometheus_client is None:
+        return _NoopMetric()
+    return prometheus_client.Counter(name, documentation, labelnames)
+
+
+def histogram(name: str, documentation: str, labelnames: tuple = ()):
+    """Define a histogram metric.
+
+    Args:
+        name (str): Name of the metric
+        documentation (str): Help of the metric
+        labelnames (tuple, optional): Names of the labels. Defaults to ().
+
+    Returns:
+        prometheus_client.Histogram: Histogram, or a no-op metric
+    """
+    if prometheus_client is None:
+        return _NoopMetric()
+    return prometheus_client.Histogram(name, documentation, labelnames)
+
+
+def start_metrics_server(port: int):
+    """Expose the metrics over HTTP.
+
+    Args:
+        port (int): Listening port of the metrics endpoint
+    """
+    if prometheus_client is None:
+        logger.warning("prometheus_client is not installed: metrics are not exposed")
+        return
+    prometheus_client.start_http_server(port)
+    logger.info(f"Metrics exposed on port {port}")
@@ -0,0 +1,301 @@
+"""On-demand profiling of a running operator.
+
+A profiling session is started and stopped at runtime, without a restart:
+
+* through a local HTTP endpoint (`KVCD_PROFILING_PORT`): `POST /start`,
+  `POST /stop` (stop and dump), `POST /dump` (dump and keep going), `GET /status`,
+* or by sending a signal (`KVCD_PROFILING_SIGNAL`, e.g. `SIGUSR2`) that toggles it.
+
+While a session runs, it collects:
+
+* a sampling profile of all the threads stacks, dumped in the folded format
+  of the flame graph tools (`kvcd-stacks-<time>.folded`),
+* the cumulative timings of each traced handler (`kvcd-handlers-<time>.json`),
+* the memory allocations with `tracemalloc` (`kvcd-allocations-<time>.txt`).
+"""
+
+import collections
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from kvcd.tracing import handler_listeners
+
+
+logger = logging.getLogger(__name__)
+
+
+class StackSampler:
+    """Sample the stacks of all the threads at a regular interval.
+    """
+
+    def __init__(self, interval: float = 0.01):
+        """Define the sampler
+
+        Args:
+            interval (float, optional): Interval (in secs) between two samples. Defaults to 0.01.
+        """
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _frame_label(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _sample(self):
+        thread_names = {t.ident: t.name for t in threading.enumerate()}
+        own_ident = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(self._frame_label(frame))
+                frame = frame.f_back
+            labels.append(thread_names.get(ident, str(ident)))
+            self.stacks[';'.join(reversed(labels))] += 1
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='kvcd-stack-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class HandlerTimings:
+    """Cumulative timings of the handler runs, by handler.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timings = {}
+
+    def record(self, name: str, duration: float, failed: bool):
+        """Record the end of a handler run.
+
+        Args:
+            name (str): Name of the handler
+            duration (float): Duration (in secs) of the run
+            failed (bool): Whether the run failed
+        """
+        with self._lock:
+            timing = self._timings.setdefault(name, {'count': 0, 'failed': 0, 'total': 0.0, 'max': 0.0})
+            timing['count'] += 1
+            timing['failed'] += int(failed)
+            timing['total'] += duration
+            timing['max'] = max(timing['max'], duration)
+
+    def as_dict(self):
+        """Timings by handler, slowest cumulative time first.
+
+        Returns:
+            dict: Timings by handler name
+        """
+        with self._lock:
+            timings = sorted(self._timings.items(), key=lambda item: item[1]['total'], reverse=True)
+            return {
+                name: dict(timing, mean=timing['total'] / timing['count'])
+                for name, timing in timings
+            }
+
+
+class Profiler:
+    """A profiling session, that can be started and stopped at runtime.
+    """
+
+    def __init__(self, output_dir: str, sample_interval: float = 0.01, allocation_frames: int = 10):
+        """Define the profiler
+
+        Args:
+            output_dir (str): Directory of the dump files
+            sample_interval (float, optional): Interval (in secs) between two stack samples. Defaults to 0.01.
+            allocation_frames (int, optional): Number of frames kept for each allocation. Defaults to 10.
+        """
+        self.output_dir = output_dir
+        self.sample_interval = sample_interval
+        self.allocation_frames = allocation_frames
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._timings = None
+        self._started_at = None
+
+    @property
+    def running(self):
+        return self._sampler is not None
+
+    def start(self):
+        """Start a profiling session.
+
+        Returns:
+            bool: False if a session was already running
+        """
+        with self._lock:
+            if self.running:
+                return False
+            self._timings = HandlerTimings()
+            handler_listeners.append(self._timings.record)
+            tracemalloc.start(self.allocation_frames)
+            self._sampler = StackSampler(self.sample_interval)
+            self._sampler.start()
+            self._started_at = time.time()
+        logger.warning("Profiling started")
+        return True
+
+    def stop(self):
+        """Stop the profiling session and dump its data.
+
+        Returns:
+            list: Paths of the dump files, empty if no session was running
+        """
+        with self._lock:
+            if not self.running:
+                return []
+            files = self._dump()
+            self._sampler.stop()
+            self._sampler = None
+            handler_listeners.remove(self._timings.record)
+            tracemalloc.stop()
+        logger.warning(f"Profiling stopped: {', '.join(files)}")
+        return files
+
+    def dump(self):
+        """Dump the data of the running session, without stopping it.
+
+        Returns:
+            list: Paths of the dump files, empty if no session is running
+        """
+        with self._lock:
+            if not self.running:
+                return []
+            return self._dump()
+
+    def toggle(self):
+        """Start a session, or stop the running one.
+        """
+        if not self.start():
+            self.stop()
+
+    def status(self):
+        """Current state of the profiler.
+
+        Returns:
+            dict: State of the profiler
+        """
+        return {
+            'running': self.running,
+            'started_at': self._started_at if self.running else None,
+            'output_dir': self.output_dir,
+        }
+
+    def _dump(self):
+        """Write the profiling data to files (lock must be held).
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        suffix = time.strftime('%Y%m%d-%H%M%S')
+        stacks_file = os.path.join(self.output_dir, f'kvcd-stacks-{suffix}.folded')
+        with open(stacks_file, 'w') as f:
+            for stack, count in self._sampler.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        handlers_file = os.path.join(self.output_dir, f'kvcd-handlers-{suffix}.json')
+        with open(handlers_file, 'w') as f:
+            json.dump({
+                'started_at': self._started_at,
+                'duration': time.time() - self._started_at,
+                'handlers': self._timings.as_dict(),
+            }, f, indent=2)
+        allocations_file = os.path.join(self.output_dir, f'kvcd-allocations-{suffix}.txt')
+        snapshot = tracemalloc.take_snapshot()
+        with open(allocations_file, 'w') as f:
+            current, peak = tracemalloc.get_traced_memory()
+            f.write(f"Traced memory: current={current} B, peak={peak} B\n\n")
+            for stat in snapshot.statistics('traceback')[:50]:
+                f.write(f"{stat.size} B in {stat.count} blocks\n")
+                for line in stat.traceback.format():
+                    f.write(f"{line}\n")
+                f.write("\n")
+        return [stacks_file, handlers_file, allocations_file]
+
+
+class _ProfilingRequestHandler(BaseHTTPRequestHandler):
+    """Control the profiler over HTTP.
+    """
+    profiler = None
+
+    def _reply(self, code: int, body: dict):
+        payload = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self._reply(200, self.profiler.status())
+        else:
+            self._reply(404, {'error': f"Unknown path: {self.path}"})
+
+    def do_POST(self):
+        if self.path == '/start':
+            self._reply(200, {'started': self.profiler.start()})
+        elif self.path == '/stop':
+            self._reply(200, {'files': self.profiler.stop()})
+        elif self.path == '/dump':
+            self._reply(200, {'files': self.profiler.dump()})
+        else:
+            self._reply(404, {'error': f"Unknown path: {self.path}"})
+
+    def log_message(self, format, *args):
+        logger.debug(f"Profiling endpoint: {format % args}")
+
+
+def start_profiling_server(profiler: Profiler, host: str, port: int):
+    """Expose the profiler control endpoint over HTTP.
+
+    Args:
+        profiler (Profiler): Profiler to control
+        host (str): Listening address: keep it local
+        port (int): Listening port
+    """
+    handler = type('ProfilingRequestHandler', (_ProfilingRequestHandler,), {'profiler': profiler})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name='kvcd-profiling-server', daemon=True).start()
+    logger.info(f"Profiling endpoint listening on {host}:{port}")
+    return server
+
+
+def install_profiling_signal(profiler: Profiler, signal_name: str):
+    """Toggle the profiler when the process receives a signal.
+
+    Must be called from the main thread.
+
+    Args:
+        profiler (Profiler): Profiler to control
+        signal_name (str): Name of the signal, like `SIGUSR2`
+    """
+    signum = getattr(signal, signal_name)
+
+    def _handler(signum, frame):
+        # Do not block the main thread while dumping
+        threading.Thread(target=profiler.toggle, name='kvcd-profiling-toggle', daemon=True).start()
+
+    signal.signal(signum, _handler)
+    logger.info(f"Profiling toggled by signal {signal_name}")
@@ -0,0 +1,273 @@
+"""Batched and rate-limited writer of the kvcd objects status.
+
+The refresh handlers of a large fleet produce a steady stream of small status
+updates. Instead of one PATCH call per handler run, the updates are queued by
+object: repeated updates of the same object are merged while they wait, and a
+single worker thread flushes them under a QPS/burst budget. Updates flagged as
+urgent (user-visible transitions) are flushed first.
+
+A failed write is queued again behind the other objects, after a growing delay,
+and dropped after a few attempts: a rejected update never holds the queue.
+The updates the Kubernetes API will never accept (a bad patch, a missing
+permission, a deleted object) are dropped at once.
+"""
+
+import collections
+import copy
+import logging
+import threading
+import time
+
+from kubernetes.client.rest import ApiException
+from kvcd.kube_helper import patch_custom_object
+from kvcd.metrics import counter, gauge, histogram
+from kvcd.tracing import span
+
+
+logger = logging.getLogger(__name__)
+
+_QUEUE_DEPTH = gauge(
+    'kvcd_status_queue_depth',
+    'Number of objects with a pending status update')
+_MERGED = counter(
+    'kvcd_status_merged_total',
+    'Number of status updates merged into a pending one')
+_WRITE_DELAY = histogram(
+    'kvcd_status_write_delay_seconds',
+    'Delay between the first pending update of an object and its write')
+_WRITE_DURATION = histogram(
+    'kvcd_status_write_duration_seconds',
+    'Duration of the status PATCH calls')
+_DROPPED = counter(
+    'kvcd_status_dropped_total',
+    'Number of status updates dropped after a failed write')
+
+# Delay (in secs) before the first retry of a failed write, doubled at each attempt up to the maximum
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 60
+# Failures of the Kubernetes API worth a retry: the other 4xx reject the update itself
+RETRYABLE_STATUSES = (408, 429)
+
+
+def deep_merge(target: dict, update: dict):
+    """Merge `update` into `target`, recursively for the nested dictionaries.
+
+    Args:
+        target (dict): Dictionary to update in place
+        update (dict): Values to merge
+    """
+    for key, value in update.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            deep_merge(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+
+
+class _PendingWrite:
+    """Merged status update of one object, waiting to be written.
+    """
+
+    def __init__(self):
+        self.status = {}
+        self.urgent = False
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0  # failed writes so far
+        self.not_before = 0  # monotonic time of the next attempt
+
+
+class StatusWriter:
+    """Queue of status updates by object, flushed under a QPS/burst budget.
+    """
+
+    def __init__(self, qps: float, burst: int, max_attempts: int = 5):
+        """Define the status writer
+
+        Args:
+            qps (float): Sustained number of PATCH calls per second: 0 for no limit
+            burst (int): Number of PATCH calls that can be sent at once
+            max_attempts (int, optional): Number of failed writes before dropping an update. Defaults to 5.
+        """
+        self.qps = qps
+        self.burst = max(1, burst)
+        self.max_attempts = max(1, max_attempts)
+        self._tokens = float(self.burst)
+        self._last_refill = time.monotonic()
+        self._cond = threading.Condition()
+        self._pending = collections.OrderedDict()  # (plural, namespace, name) -> _PendingWrite
+        self._thread = None
+        self._stopping = False
+
+    def submit(self, plural: str, namespace: str, name: str, status: dict, urgent: bool = False):
+        """Queue a status update of an object.
+
+        Args:
+            plural (str): Plural name of the custom resource
+            namespace (str): Namespace of the object
+            name (str): Name of the object
+            status (dict): Status entries to merge
+            urgent (bool, optional): User-visible transition to write first. Defaults to False.
+        """
+        key = (plural, namespace, name)
+        with self._cond:
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = self._pending[key] = _PendingWrite()
+            else:
+                _MERGED.inc()
+            deep_merge(pending.status, status)
+            pending.urgent = pending.urgent or urgent
+            _QUEUE_DEPTH.set(len(self._pending))
+            self._cond.notify()
+
+    def depth(self):
+        """Number of objects with a pending status update.
+
+        Returns:
+            int: Queue depth
+        """
+        with self._cond:
+            return len(self._pending)
+
+    def start(self):
+        """Start the worker thread flushing the queue.
+        """
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='kvcd-status-writer', daemon=True)
+            self._thread.start()
+        logger.debug(f"Status writer started with {self.qps} QPS and a burst of {self.burst}")
+
+    def stop(self, timeout: float = None):
+        """Flush the pending updates and stop the worker thread.
+
+        Args:
+            timeout (float, optional): Maximum duration (in secs) of the flush. Defaults to None.
+        """
+        with self._cond:
+            thread = self._thread
+            self._stopping = True
+            self._cond.notify()
+        if thread is not None:
+            thread.join(timeout)
+        with self._cond:
+            self._thread = None
+        logger.debug(f"Status writer stopped with {self.depth()} pending updates")
+
+    def _take_token(self):
+        """Wait for a token of the QPS budget (worker thread only).
+        """
+        if self.qps <= 0:
+            return
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.qps)
+            self._last_refill = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            time.sleep((1 - self._tokens) / self.qps)
+
+    def _next_ready(self):
+        """Delay before the next update can be written (lock must be held).
+
+        Returns:
+            float: Delay (in secs), 0 if an update is ready
+        """
+        now = time.monotonic()
+        return max(0, min(p.not_before for p in self._pending.values()) - now)
+
+    def _pop(self):
+        """Take the next update ready to write, urgent ones first (lock must be held).
+
+        Returns:
+            tuple: Object key and its pending update
+        """
+        now = time.monotonic()
+        ready = [(k, p) for k, p in self._pending.items() if p.not_before <= now]
+        key = next((k for k, p in ready if p.urgent), ready[0][0])
+        pending = self._pending.pop(key)
+        _QUEUE_DEPTH.set(len(self._pending))
+        return key, pending
+
+    def _requeue(self, key: tuple, pending: _PendingWrite):
+        """Put back a failed update at the end of the queue, to retry after a delay.
+
+        The updates received meanwhile are merged over it. The update is dropped
+        once it failed `max_attempts` times.
+
+        Returns:
+            bool: False if the update is dropped
+        """
+        pending.attempts += 1
+        if pending.attempts >= self.max_attempts:
+            _DROPPED.inc()
+            return False
+        delay = min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** (pending.attempts - 1))
+        pending.not_before = time.monotonic() + delay
+        with self._cond:
+            newer = self._pending.pop(key, None)
+            if newer is not None:
+                deep_merge(pending.status, newer.status)
+                pending.urgent = pending.urgent or newer.urgent
+            self._pending[key] = pending
+            _QUEUE_DEPTH.set(len(self._pending))
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopping:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                delay = self._next_ready()
+                if delay > 0:
+                    if self._stopping:
+                        # Flushing: no more retries of the failed updates
+                        logger.warning(f"Dropping {len(self._pending)} failed status updates on stop")
+                        _DROPPED.inc(len(self._pending))
+                        self._pending.clear()
+                        _QUEUE_DEPTH.set(0)
+                        return
+                    self._cond.wait(delay)
+                    continue
+            self._take_token()
+            with self._cond:
+                if not self._pending or self._next_ready() > 0:
+                    continue
+                key, pending = self._pop()
+            self._write(key, pending)
+
+    def _write(self, key: tuple, pending: _PendingWrite):
+        plural, namespace, name = key
+        start = time.monotonic()
+        try:
+            with span('status.write', **{'k8s.plural': plural, 'k8s.namespace': namespace, 'k8s.name': name}):
+                patch_custom_object(plural, namespace, name, {'status': pending.status})
+        except ApiException as e:
+            if e.status == 404:
+                logger.debug(f"Dropping the status update of deleted {plural} {namespace}/{name}")
+                return
+            if 400 <= (e.status or 0) < 500 and e.status not in RETRYABLE_STATUSES:
+                _DROPPED.inc()
+                logger.error(f"Dropping the status update of {plural} {namespace}/{name}, "
+                             f"rejected with {e.status}: {e.reason}")
+                return
+            self._failed(key, pending, e.reason)
+            return
+        except Exception as e:
+            self._failed(key, pending, e)
+            return
+        _WRITE_DURATION.observe(time.monotonic() - start)
+        _WRITE_DELAY.observe(time.monotonic() - pending.enqueued_at)
+
+    def _failed(self, key: tuple, pending: _PendingWrite, error):
+        plural, namespace, name = key
+        if self._requeue(key, pending):
+            logger.warning(f"Failed to write the status of {plural} {namespace}/{name} "
+                           f"(attempt {pending.attempts}): {error}")
+        else:
+            logger.error(f"Dropping the status update of {plural} {namespace}/{name} "
+                         f"after {pending.attempts} failed attempts: {error}")
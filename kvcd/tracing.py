@@ -0,0 +1,314 @@
+"""Lightweight tracing of the handlers and of the vCD calls.
+
+A span measures one step of the work: a handler run, a vCD request, a task wait...
+The current span is kept in a context variable, so that the nested spans get
+their parent and trace without passing them around. The sampling decision is
+made once per trace, at its root span.
+
+Finished spans are exported in a background thread to:
+
+* a local JSON lines file (`KVCD_TRACING_FILE`), one span per line,
+* an OTLP/HTTP collector (`KVCD_TRACING_OTLP_ENDPOINT`), in the OTLP JSON encoding.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+import requests
+
+
+logger = logging.getLogger(__name__)
+
+_current_span = contextvars.ContextVar('kvcd_current_span', default=None)
+
+
+class Span:
+    """A timed step of the work, with its attributes.
+    """
+
+    def __init__(self, name: str, trace_id: str, parent_id: str, sampled: bool, attributes: dict):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = {k: v for k, v in attributes.items() if v is not None}
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    def set_attribute(self, key: str, value):
+        """Add an attribute to the span.
+
+        Args:
+            key (str): Name of the attribute
+            value: Value of the attribute
+        """
+        if value is not None:
+            self.attributes[key] = value
+
+    def as_dict(self):
+        """Span as a JSON serializable entry.
+
+        Returns:
+            dict: Span data
+        """
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start_ns': self.start_ns,
+            'end_ns': self.end_ns,
+            'duration_ms': round((self.end_ns - self.start_ns) / 1e6, 3),
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+class JsonLinesExporter:
+    """Append the spans to a local JSON lines file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, spans: list):
+        with open(self.path, 'a') as f:
+            for span in spans:
+                f.write(json.dumps(span.as_dict(), default=str) + '\n')
+
+
+class OtlpHttpExporter:
+    """Send the spans to an OTLP/HTTP collector, in the OTLP JSON encoding.
+    """
+
+    def __init__(self, endpoint: str, service_name: str = 'kvcd'):
+        self.url = endpoint.rstrip('/') + '/v1/traces'
+        self.service_name = service_name
+        self._session = requests.Session()
+
+    @staticmethod
+    def _attribute(key: str, value):
+        if isinstance(value, bool):
+            return {'key': key, 'value': {'boolValue': value}}
+        if isinstance(value, int):
+            return {'key': key, 'value': {'intValue': str(value)}}
+        if isinstance(value, float):
+            return {'key': key, 'value': {'doubleValue': value}}
+        return {'key': key, 'value': {'stringValue': str(value)}}
+
+    def _span(self, span: Span):
+        otlp_span = {
+            'traceId': span.trace_id,
+            'spanId': span.span_id,
+            'name': span.name,
+            'kind': 1,  # internal
+            'startTimeUnixNano': str(span.start_ns),
+            'endTimeUnixNano': str(span.end_ns),
+            'attributes': [self._attribute(k, v) for k, v in span.attributes.items()],
+            'status': {'code': 2, 'message': span.error} if span.error else {'code': 1},
+        }
+        if span.parent_id:
+            otlp_span['parentSpanId'] = span.parent_id
+        return otlp_span
+
+    def export(self, spans: list):
+        body = {'resourceSpans': [{
+            'resource': {'attributes': [self._attribute('service.name', self.service_name)]},
+            'scopeSpans': [{
+                'scope': {'name': 'kvcd'},
+                'spans': [self._span(span) for span in spans],
+            }],
+        }]}
+        response = self._session.post(self.url, json=body, timeout=10)
+        response.raise_for_status()
+
+
+class Tracer:
+    """Create the spans and export the sampled ones in the background.
+    """
+
+    def __init__(self, exporters: list = None, sample_rate: float = 1.0,
+                 batch_size: int = 256, flush_interval: float = 5.0):
+        """Define the tracer
+
+        Args:
+            exporters (list, optional): Span exporters. Defaults to None (tracing disabled).
+            sample_rate (float, optional): Fraction of the traces to export. Defaults to 1.0.
+            batch_size (int, optional): Maximum number of spans per export. Defaults to 256.
+            flush_interval (float, optional): Maximum delay (in secs) before an export. Defaults to 5.0.
+        """
+        self.exporters = exporters or []
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=10000)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.exporters) and self.sample_rate > 0
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        """Measure a step of the work as a child of the current span.
+
+        Args:
+            name (str): Name of the span
+            attributes: Attributes of the span
+
+        Yields:
+            Span: The new span, or None if the trace is not sampled
+        """
+        parent = _current_span.get()
+        if parent is None:
+            if not self.enabled or random.random() >= self.sample_rate:
+                yield None
+                return
+            new_span = Span(name, os.urandom(16).hex(), None, True, attributes)
+        elif not parent.sampled:
+            yield None
+            return
+        else:
+            new_span = Span(name, parent.trace_id, parent.span_id, True, attributes)
+        token = _current_span.set(new_span)
+        try:
+            yield new_span
+        except BaseException as e:
+            new_span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current_span.reset(token)
+            new_span.end_ns = time.time_ns()
+            self._submit(new_span)
+
+    def _submit(self, span: Span):
+        self._start()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            logger.debug(f"Tracing queue is full: dropping span {span.name}")
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='kvcd-tracing', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            for exporter in self.exporters:
+                try:
+                    exporter.export(batch)
+                except Exception as e:
+                    logger.warning(f"Failed to export {len(batch)} spans with {type(exporter).__name__}: {e}")
+
+
+tracer = Tracer()
+
+
+def configure_tracing(file: str = None, otlp_endpoint: str = None, sample_rate: float = 1.0):
+    """Set the exporters and the sampling of the module tracer.
+
+    Args:
+        file (str, optional): Path of the JSON lines file of the spans. Defaults to None.
+        otlp_endpoint (str, optional): Base URL of an OTLP/HTTP collector. Defaults to None.
+        sample_rate (float, optional): Fraction of the traces to export. Defaults to 1.0.
+    """
+    exporters = []
+    if file:
+        exporters.append(JsonLinesExporter(file))
+    if otlp_endpoint:
+        exporters.append(OtlpHttpExporter(otlp_endpoint))
+    tracer.exporters = exporters
+    tracer.sample_rate = sample_rate
+    if tracer.enabled:
+        logger.info(f"Tracing enabled with a sample rate of {sample_rate}")
+
+
+def span(name: str, **attributes):
+    """Measure a step of the work with the module tracer.
+
+    Args:
+        name (str): Name of the span
+        attributes: Attributes of the span
+    """
+    return tracer.span(name, **attributes)
+
+
+def current_span():
+    """Current span of the context.
+
+    Returns:
+        Span: Current span, or None
+    """
+    return _current_span.get()
+
+
+def _handler_attributes(kwargs: dict):
+    status = kwargs.get('status') or {}
+    return {
+        'k8s.name': kwargs.get('name'),
+        'k8s.namespace': kwargs.get('namespace'),
+        'vcd.vapp_href': status.get('backing', {}).get('vcd_vapp_href'),
+    }
+
+
+# Callables notified of the end of each traced handler run, with its name,
+# duration (in secs) and whether it failed
+handler_listeners = []
+
+
+@contextlib.contextmanager
+def _handler_run(name: str, kwargs: dict):
+    start = time.perf_counter()
+    failed = False
+    try:
+        with span(name, **_handler_attributes(kwargs)):
+            yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        for listener in handler_listeners:
+            listener(name, time.perf_counter() - start, failed)
+
+
+def traced(name: str):
+    """Decorate a kopf handler to run it in a root span with the object name and vApp href.
+
+    Args:
+        name (str): Name of the span
+    """
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with _handler_run(name, kwargs):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _handler_run(name, kwargs):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -4,7 +4,12 @@
 import yaml
 import functools
 import functools
+import logging
 import threading
+import time
+
+
+logger = logging.getLogger(__name__)
 
 
 def str2bool(v:str):
@@ -34,13 +39,23 @@ def lowercase_first_string_letter(v:str):
 def setInterval(sec: int):
     """Time-interval based decorator
 
+    The first call runs the function, then a single daemon thread runs it again
+    every `sec` seconds: no new thread by run, and no run left to block the exit.
+
     usage: @setInterval(sec=3)
     """
     def decorator(func):
+        def loop(argv, kw):
+            while True:
+                time.sleep(sec)
+                try:
+                    func(*argv, **kw)
+                except Exception as e:
+                    logger.error(f"Failed to run {func.__name__}: {e}")
+
         @functools.wraps(func)
         def wrapper(*argv, **kw):
             func(*argv, **kw)
-            t = threading.Timer(sec, wrapper, argv, kw)
-            t.start()
+            threading.Thread(target=loop, args=(argv, kw), name=f"kvcd-{func.__name__}", daemon=True).start()
         return wrapper
     return decorator
@@ -0,0 +1,297 @@
+"""Health-aware admission of the work sent to a Cloud Director endpoint.
+
+The circuit breaker follows the error rate and the latency of the requests sent
+to a vCloud instance:
+
+* `closed`: everything goes through.
+* `degraded`: the error rate crossed the first threshold, background refreshes are shed.
+* `open`: the error rate crossed the second threshold, all the work is shed.
+* `half-open`: after a cool down, a few probes are let through. The circuit
+  closes again once each of them completed without a failed request, and opens
+  again at the first failed request.
+
+A probe is a unit of work admitted by the scheduler (a handler, a refresh), not
+a single request: one piece of work sending several requests is one probe. The
+throttling responses (429, 503) count as failures, like the server errors.
+"""
+
+import collections
+import logging
+import threading
+import time
+from enum import Enum
+
+import kopf
+import requests
+from kvcd.metrics import gauge, histogram
+from kvcd.tracing import span
+from kvcd.vmware.vcloud_scheduler import Priority
+
+
+logger = logging.getLogger(__name__)
+
+_STATE_GAUGE = gauge(
+    'kvcd_vcd_circuit_state',
+    'State of the vCD circuit breaker: 0=closed, 1=degraded, 2=half-open, 3=open',
+    ('endpoint',))
+_ERROR_RATE_GAUGE = gauge(
+    'kvcd_vcd_error_rate',
+    'Error rate of the requests to vCD over the breaker window',
+    ('endpoint',))
+_REQUEST_DURATION = histogram(
+    'kvcd_vcd_request_duration_seconds',
+    'Duration of the requests to vCD',
+    ('endpoint',))
+
+
+class BreakerState(Enum):
+    CLOSED = 'closed'
+    DEGRADED = 'degraded'
+    HALF_OPEN = 'half-open'
+    OPEN = 'open'
+
+
+_STATE_LEVELS = {
+    BreakerState.CLOSED: 0,
+    BreakerState.DEGRADED: 1,
+    BreakerState.HALF_OPEN: 2,
+    BreakerState.OPEN: 3,
+}
+
+
+class CircuitOpenError(kopf.TemporaryError):
+    """The work was shed by the circuit breaker: retry after the given delay.
+    """
+
+
+class CircuitBreaker:
+    """Error rate and latency based circuit breaker for one vCloud instance.
+    """
+
+    def __init__(self, endpoint: str, window: int = 60, min_calls: int = 20,
+                 degraded_error_rate: float = 0.2, open_error_rate: float = 0.5,
+                 slow_call_duration: float = 10.0, open_duration: int = 30,
+                 half_open_probes: int = 3, on_transition=None):
+        """Define the circuit breaker
+
+        Args:
+            endpoint (str): Name of the vCloud instance (for logs and metrics)
+            window (int, optional): Duration (in secs) of the observation window. Defaults to 60.
+            min_calls (int, optional): Minimum number of requests in the window to
+                evaluate the error rate. Defaults to 20.
+            degraded_error_rate (float, optional): Error rate shedding background refreshes. Defaults to 0.2.
+            open_error_rate (float, optional): Error rate shedding all the work. Defaults to 0.5.
+            slow_call_duration (float, optional): Duration (in secs) after which a
+                request counts as an error. Defaults to 10.0.
+            open_duration (int, optional): Duration (in secs) of the open state before probing. Defaults to 30.
+            half_open_probes (int, optional): Number of probes in the half-open state. Defaults to 3.
+            on_transition (callable, optional): Called with the endpoint and the new
+                state, at creation and at each transition. It is called under the
+                lock of the breaker, and must not block. Defaults to None.
+        """
+        self.endpoint = endpoint
+        self.window = window
+        self.min_calls = min_calls
+        self.degraded_error_rate = degraded_error_rate
+        self.open_error_rate = open_error_rate
+        self.slow_call_duration = slow_call_duration
+        self.open_duration = open_duration
+        self.half_open_probes = half_open_probes
+        self.on_transition = on_transition
+        self._lock = threading.Lock()
+        self._calls = collections.deque()  # (timestamp, success)
+        self._state = BreakerState.CLOSED
+        self._state_since = time.monotonic()
+        self._probes_admitted = 0
+        self._probes_succeeded = 0
+        self._probe_round = 0  # the probes of a previous round are not counted
+        self._publish()
+
+    @property
+    def state(self):
+        """Current state of the breaker.
+
+        Returns:
+            BreakerState: Current state
+        """
+        with self._lock:
+            self._check_cool_down()
+            return self._state
+
+    def error_rate(self):
+        """Error rate over the observation window.
+
+        Returns:
+            float: Error rate, 0 if there are not enough requests to evaluate it.
+        """
+        with self._lock:
+            return self._error_rate()
+
+    def _error_rate(self):
+        cutoff = time.monotonic() - self.window
+        while self._calls and self._calls[0][0] < cutoff:
+            self._calls.popleft()
+        if len(self._calls) < self.min_calls:
+            return 0.0
+        return sum(1 for _, success in self._calls if not success) / len(self._calls)
+
+    def _set_state(self, state: BreakerState):
+        if state == self._state:
+            return
+        logger.warning(f"vCD circuit breaker of {self.endpoint}: {self._state.value} -> {state.value}")
+        self._state = state
+        self._state_since = time.monotonic()
+        self._probes_admitted = 0
+        self._probes_succeeded = 0
+        self._probe_round += 1
+        if state in (BreakerState.OPEN, BreakerState.CLOSED):
+            self._calls.clear()
+        self._publish()
+
+    def _publish(self):
+        _STATE_GAUGE.labels(self.endpoint).set(_STATE_LEVELS[self._state])
+        if self.on_transition:
+            self.on_transition(self.endpoint, self._state)
+
+    def _check_cool_down(self):
+        """Apply the time based transitions of the state (lock must be held).
+        """
+        elapsed = time.monotonic() - self._state_since
+        if self._state == BreakerState.OPEN and elapsed > self.open_duration:
+            self._set_state(BreakerState.HALF_OPEN)
+        elif self._state == BreakerState.HALF_OPEN and elapsed > self.open_duration:
+            # Probes did not conclude: let new ones through
+            self._state_since = time.monotonic()
+            self._probes_admitted = self._probes_succeeded
+            self._probe_round += 1
+        elif (self._state == BreakerState.DEGRADED and elapsed > self.window and
+              self._error_rate() < self.degraded_error_rate):
+            self._set_state(BreakerState.CLOSED)
+
+    def record(self, success: bool, duration: float):
+        """Record the outcome of a request.
+
+        Args:
+            success (bool): Whether the request succeeded
+            duration (float): Duration (in secs) of the request
+        """
+        _REQUEST_DURATION.labels(self.endpoint).observe(duration)
+        success = success and duration < self.slow_call_duration
+        with self._lock:
+            if self._state == BreakerState.OPEN:
+                return
+            if self._state == BreakerState.HALF_OPEN:
+                # The successful requests are counted by probe, in `probe_done`
+                if not success:
+                    self._set_state(BreakerState.OPEN)
+                return
+            self._calls.append((time.monotonic(), success))
+            error_rate = self._error_rate()
+            _ERROR_RATE_GAUGE.labels(self.endpoint).set(error_rate)
+            if error_rate >= self.open_error_rate:
+                self._set_state(BreakerState.OPEN)
+            elif error_rate >= self.degraded_error_rate:
+                self._set_state(BreakerState.DEGRADED)
+            elif len(self._calls) >= self.min_calls:
+                self._set_state(BreakerState.CLOSED)
+
+    def admit(self, priority: Priority):
+        """Check that a piece of work can be sent to the vCloud instance.
+
+        Args:
+            priority (Priority): Priority class of the work
+
+        Raises:
+            CircuitOpenError: The work is shed.
+
+        Returns:
+            int: Probe to report to `probe_done` once the work is over, None if
+                the work is not a probe.
+        """
+        with self._lock:
+            self._check_cool_down()
+            if self._state == BreakerState.CLOSED:
+                return None
+            if self._state == BreakerState.DEGRADED and priority != Priority.REFRESH:
+                return None
+            if (self._state == BreakerState.HALF_OPEN and
+                    self._probes_admitted < self.half_open_probes):
+                self._probes_admitted += 1
+                return self._probe_round
+            retry_after = max(1, int(self.open_duration - (time.monotonic() - self._state_since)))
+            state = self._state
+        raise CircuitOpenError(
+            f"vCD endpoint {self.endpoint} is {state.value}: {priority.name.lower()} work is shed",
+            delay=retry_after)
+
+    def probe_done(self, probe: int, success: bool):
+        """Record the end of a piece of work admitted as a probe.
+
+        A failed request already opened the circuit again: a probe whose work
+        failed otherwise (or never ran) frees its place for another probe.
+
+        Args:
+            probe (int): Probe returned by `admit`
+            success (bool): Whether the work completed
+        """
+        with self._lock:
+            if self._state != BreakerState.HALF_OPEN or probe != self._probe_round:
+                return
+            if not success:
+                self._probes_admitted -= 1
+                return
+            self._probes_succeeded += 1
+            if self._probes_succeeded >= self.half_open_probes:
+                self._set_state(BreakerState.CLOSED)
+
+
+def is_failure_status(status_code: int):
+    """Whether a vCD response counts as a failure for the circuit breaker.
+
+    Args:
+        status_code (int): HTTP status of the response
+
+    Returns:
+        bool: True for the server errors and the throttling responses
+    """
+    return status_code >= 500 or status_code == 429
+
+
+class MonitoredAdapter(requests.adapters.HTTPAdapter):
+    """HTTP adapter tracing each request and recording its outcome in a circuit breaker.
+
+    The requests are sent by an optional transport adapter (like a recording or
+    a replay of the traffic), or by the default HTTP adapter.
+    """
+
+    def __init__(self, breaker: CircuitBreaker = None, transport: requests.adapters.BaseAdapter = None,
+                 *args, **kwargs):
+        self.breaker = breaker
+        self.transport = transport
+        super().__init__(*args, **kwargs)
+
+    def _send(self, request, *args, **kwargs):
+        if self.transport is not None:
+            return self.transport.send(request, *args, **kwargs)
+        return super().send(request, *args, **kwargs)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+        super().close()
+
+    def send(self, request, *args, **kwargs):
+        path = requests.utils.urlparse(request.url).path
+        with span('vcd.request', **{'http.method': request.method, 'http.path': path}) as request_span:
+            start = time.monotonic()
+            try:
+                response = self._send(request, *args, **kwargs)
+            except requests.RequestException:
+                if self.breaker:
+                    self.breaker.record(False, time.monotonic() - start)
+                raise
+            if self.breaker:
+                self.breaker.record(not is_failure_status(response.status_code), time.monotonic() - start)
+            if request_span:
+                request_span.set_attribute('http.status_code', response.status_code)
+            return response
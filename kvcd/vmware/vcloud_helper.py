@@ -3,11 +3,12 @@
 
 import atexit
 import ssl
-import sys
 import logging
+import weakref
 from enum import Enum
 
 # Extra packages
+import kopf
 from pyvcloud.vcd.client import BasicLoginCredentials
 from pyvcloud.vcd.client import Client as vCDClient
 from pyvcloud.vcd.client import EntityType
@@ -21,12 +22,64 @@ from pyvcloud.vcd.org import Org
 from pyvcloud.vcd.vapp import VApp
 from pyvcloud.vcd.vdc import VDC
 from pyvcloud.vcd.vm import VM
+from pyvcloud.vcd.exceptions import EntityNotFoundException
 import requests
 from lxml.objectify import ObjectifiedElement
+from kvcd.vmware.vcloud_scheduler import PriorityScheduler
+from kvcd.vmware.vcloud_breaker import CircuitBreaker, MonitoredAdapter
+from kvcd.vmware.vcloud_inventory import VmInventory, VappIndex, VdcCapacity, OrgDirectory
+from kvcd.tracing import span
 
 
 logger = logging.getLogger(__name__)
 
+# Opened sessions, logged out at exit: weak references, to not keep the replaced ones alive
+_open_sessions = weakref.WeakSet()
+
+
+@atexit.register
+def _close_sessions():
+    for vcd_session in list(_open_sessions):
+        vcd_session.close()
+
+
+class MonitoredClient(vCDClient):
+    """pyvcloud client mounting the kvcd HTTP adapter on each of its HTTP sessions.
+
+    pyvcloud opens new HTTP sessions to negotiate the API version and at each
+    authentication: the login requests are monitored, recorded or replayed too.
+    """
+
+    def __init__(self, *args, adapter_factory=None, **kwargs):
+        self._adapter_factory = adapter_factory
+        super().__init__(*args, **kwargs)
+
+    def _do_request_prim(self, method, uri, session, *args, **kwargs):
+        if self._adapter_factory is not None and not getattr(session, 'kvcd_mounted', False):
+            session.mount('https://', self._adapter_factory())
+            session.kvcd_mounted = True
+        return super()._do_request_prim(method, uri, session, *args, **kwargs)
+
+    def set_credentials(self, creds):
+        """Authenticate to create a new session, then log out and close the previous one.
+
+        pyvcloud opens a new HTTP session at each authentication, without closing the
+        previous one: its vCD session and its connections would pile up at each refresh.
+
+        Args:
+            creds (BasicLoginCredentials): Credentials
+        """
+        previous = self._session
+        super().set_credentials(creds)
+        if previous is None or previous is self._session:
+            return
+        try:
+            previous.delete(self._api_base_uri + '/session', verify=self._verify_ssl_certs)
+        except Exception as e:
+            logger.debug(f"Failed to log out the previous Cloud Director session: {e}")
+        finally:
+            previous.close()
+
 
 class VcdSession:
     """Define VcdSession class to manage the Cloud Director connection and its related objects.
@@ -38,7 +91,11 @@ class VcdSession:
                  password: str,
                  organisation: str,
                  port: int = 443,
-                 verify_ssl: bool = True):
+                 verify_ssl: bool = True,
+                 scheduler: PriorityScheduler = None,
+                 breaker: CircuitBreaker = None,
+                 inventory_max_age: int = 60,
+                 traffic=None):
         """Define VcdSession class based on input parameters
 
         Args:
@@ -47,6 +104,14 @@ class VcdSession:
             password (str): User's password
             organisation (str): Name of the organisation
             verify_ssl (bool, optional): Verify the vCloud SSL certificate. Defaults to True.
+            scheduler (PriorityScheduler, optional): Admission of the work sent to this
+                vCloud instance. Defaults to a scheduler with a single shared slot.
+            breaker (CircuitBreaker, optional): Circuit breaker fed with the outcome of
+                the requests to this vCloud instance. Defaults to None.
+            inventory_max_age (int, optional): Maximum age (in secs) of the VM inventory, of
+                the vApp index, of the Org VDCs capacity and of the directory. Defaults to 60.
+            traffic (TrafficRecorder|TrafficReplay, optional): Recording, or replay instead of
+                the real requests, of the HTTP traffic. Defaults to None.
 
         Raises:
             VCDError: Any vCloud director related error.
@@ -54,33 +119,50 @@ class VcdSession:
         logger.info(f'Initializing a Cloud Director session to {hostname} in organisation {organisation}')
         self._creds = BasicLoginCredentials(username, organisation, password)
         try:
-            self.client = vCDClient(uri=f"https://{hostname}:{port}",
-                                    verify_ssl_certs=verify_ssl,
-                                    log_file=None,
-                                    log_requests=False,
-                                    log_headers=False,
-                                    log_bodies=False)
+            self.breaker = breaker
+            self.traffic = traffic
+            self.client = MonitoredClient(uri=f"https://{hostname}:{port}",
+                                          verify_ssl_certs=verify_ssl,
+                                          log_file=None,
+                                          log_requests=False,
+                                          log_headers=False,
+                                          log_bodies=False,
+                                          adapter_factory=self._new_adapter)
             self.client.set_credentials(self._creds)
-            atexit.register(self.__close)
         except Exception as err:
             raise VCDError(f'Unable to create the Cloud Director session: {err}')
         # shortcuts to usefull settings
         self.hostname = hostname
+        self.scheduler = scheduler or PriorityScheduler(slots=1, shares={}, starvation_timeout=0)
+        self.vm_inventory = VmInventory(self.client, max_age=inventory_max_age)
+        self.vapp_index = VappIndex(self.client, max_age=inventory_max_age)
+        self.vdc_hrefs = {}  # (org name, VDC name) -> VDC href
+        self.vdc_capacity = VdcCapacity(self.client, max_age=inventory_max_age)
+        self.directory = OrgDirectory(self.client, max_age=inventory_max_age)
         self.org = Org(self.client,
                        resource=self.client.get_org())
+        _open_sessions.add(self)
         logger.debug(f'Connected to {self.client.get_api_uri()})')
 
-
     def rehydrate(self):
         """Renew the authentication, based on stored credentials.
         """
         self.client.set_credentials(self._creds)
 
+    def _new_adapter(self):
+        """HTTP adapter of a new HTTP session of the client.
 
-    def __close(self):
+        Returns:
+            MonitoredAdapter: HTTP adapter
+        """
+        transport = self.traffic.transport() if self.traffic is not None else None
+        return MonitoredAdapter(self.breaker, transport=transport)
+
+    def close(self):
         """Exit method to cloture a connection
         """
         logger.info("Closing the Cloud Director session")
+        _open_sessions.discard(self)
         self.client.logout()
         logger.debug("Cloud Director session closed")
 
@@ -91,7 +173,8 @@ class VCDError(Exception):
     """
     def __init__(self, msg='', *args,**kwargs):
         logger.error(f"VCDError: {msg}")
-        sys.exit(msg)
+        self.msg = msg
+        super().__init__(msg, *args)
 
     def __str__(self):
         return self.msg
@@ -108,7 +191,8 @@ def get_org(vcd_session:VcdSession, org_name: str):
         Org: Org object
     """
     try:
-        org_resource = vcd_session.client.get_org_by_name(org_name)
+        with span('vcd.get_org', **{'vcd.org': org_name}):
+            org_resource = vcd_session.client.get_org_by_name(org_name)
     except EntityNotFoundException:
         raise kopf.PermanentError(f"No Org found with name: {org_name}")
     org = Org(vcd_session.client, resource=org_resource)
@@ -125,12 +209,36 @@ def get_vdc(vcd_session: VcdSession, org_name: str, vdc_name: str):
         vdc_name (str): Name of the VDC to get
 
     Returns:
-        VDC: VDC object
+        VDC: VDC object, loaded on first use if its href is already known
     """
+    vdc_href = vcd_session.vdc_hrefs.get((org_name, vdc_name))
+    if vdc_href is not None:
+        return VDC(vcd_session.client, name=vdc_name, href=vdc_href)
     org = get_org(vcd_session=vcd_session, org_name=org_name)
-    vdc_resource = org.get_vdc(vdc_name)
+    with span('vcd.get_vdc', **{'vcd.org': org_name, 'vcd.vdc': vdc_name}):
+        vdc_resource = org.get_vdc(vdc_name)
     if vdc_resource == None:  # Compare to None as record.__repr()__ return an empty str: ''
         raise kopf.PermanentError(f"No Org VDC found with name: {vdc_name}")
     vdc = VDC(vcd_session.client, resource=vdc_resource)
+    vcd_session.vdc_hrefs[(org_name, vdc_name)] = vdc.href
     logger.debug(f"Org VDC found: {vdc_resource.get('name')}")
-    return vdc
\ No newline at end of file
+    return vdc
+
+
+def wait_for_task(vcd_session: VcdSession, task: ObjectifiedElement, **kwargs):
+    """Wait for the end of a vCD task
+
+    Args:
+        vcd_session (VcdSession): VCD session
+        task (ObjectifiedElement): Task to wait for
+        kwargs: Extra arguments of `TaskMonitor.wait_for_status`
+
+    Returns:
+        ObjectifiedElement: Final task resource
+    """
+    with span('vcd.task_wait', **{'vcd.task': task.get('operationName'),
+                                  'vcd.task_href': task.get('href')}) as task_span:
+        result = vcd_session.client.get_task_monitor().wait_for_status(task=task, **kwargs)
+        if task_span:
+            task_span.set_attribute('vcd.task_status', result.get('status'))
+        return result
@@ -0,0 +1,706 @@
+"""Inventories of a Cloud Director instance, shared by all the vApps.
+
+Reading the details of the VMs vApp by vApp would cost one call per vApp (or
+per VM) at each refresh. Instead, paged `vm` queries, filtered on the vApps
+managed by the operator, gather their VMs at most once per interval, and the
+refresh of each vApp picks its VMs from this snapshot.
+
+In the same way, the existence of the vApps is checked against an index of the
+vApps of each Org VDC, filled from a paged `vApp` query and updated by the
+operator own mutations, instead of downloading the vApps. A vApp missing from
+the index is looked up alone, with a filtered query, before being reported as
+missing. The index also holds the state of each vApp found in its query record
+(status, owner, lease expiration dates): a vApp is only downloaded once this
+state changed.
+
+The capacity and usage of the Org VDCs are read periodically with a single
+paged `orgVdc` query too, to place the new vApps in memory, and the names of the
+organizations, users and catalog items with one query each, to validate the
+objects in memory.
+"""
+
+import collections
+import contextlib
+import fnmatch
+import logging
+import threading
+import time
+
+from pyvcloud.vcd.client import QueryResultFormat
+from pyvcloud.vcd.client import ResourceType
+
+
+logger = logging.getLogger(__name__)
+
+QUERY_PAGE_SIZE = 128
+# Number of vApps in the filter of one VM query, to keep its URL short
+CONTAINER_FILTER_SIZE = 20
+
+
+def vm_record_to_dict(record):
+    """Extract the exposed details of a VM from its query record.
+
+    Args:
+        record (ObjectifiedElement): `VMRecord` or `AdminVMRecord` from a query
+
+    Returns:
+        dict: VM details
+    """
+    def _int(value):
+        return int(value) if value not in (None, '') else None
+
+    return {
+        'name': record.get('name'),
+        'status': record.get('status'),
+        'ipAddress': record.get('ipAddress'),
+        'numberOfCpus': _int(record.get('numberOfCpus')),
+        'memoryMB': _int(record.get('memoryMB')),
+        'guestOs': record.get('guestOs'),
+        'vcd_vm_href': record.get('href'),
+    }
+
+
+class VmInventory:
+    """Snapshot of the VMs of the managed vApps, grouped by parent vApp href.
+
+    Only the vApps the operator asks for are queried: a vApp is watched from its
+    first `get` (or `watch`), and forgotten once it was not asked for during
+    `WATCH_EXPIRY` snapshots.
+    """
+
+    WATCH_EXPIRY = 3
+
+    def __init__(self, client, max_age: int = 60):
+        """Define the inventory
+
+        Args:
+            client (pyvcloud.vcd.client.Client): Client of the vCloud instance
+            max_age (int, optional): Maximum age (in secs) of the snapshot. Defaults to 60.
+        """
+        self.client = client
+        self.max_age = max_age
+        self._lock = threading.Lock()  # held to read or swap the snapshot only, never during a query
+        self._refresh_lock = threading.Lock()
+        self._vms = None  # vApp href -> list of VM details
+        self._taken_at = 0
+        self._watched = {}  # vApp href -> last time it was asked for
+
+    def _query(self, vapp_hrefs: list):
+        """Run the paged VM queries of some vApps.
+
+        Args:
+            vapp_hrefs (list): hrefs of the vApps
+
+        Returns:
+            dict: list of VM details by parent vApp href, for each vApp
+        """
+        query_type = ResourceType.ADMIN_VM.value if self.client.is_sysadmin() else ResourceType.VM.value
+        vms = {href: [] for href in vapp_hrefs}
+        for i in range(0, len(vapp_hrefs), CONTAINER_FILTER_SIZE):
+            containers = ','.join(f'container=={href}' for href in vapp_hrefs[i:i + CONTAINER_FILTER_SIZE])
+            query = self.client.get_typed_query(
+                query_type,
+                query_result_format=QueryResultFormat.RECORDS,
+                page_size=QUERY_PAGE_SIZE,
+                qfilter=f'isVAppTemplate==false;({containers})')
+            for record in query.execute():
+                vms.setdefault(record.get('container'), []).append(vm_record_to_dict(record))
+        for vapp_vms in vms.values():
+            vapp_vms.sort(key=lambda vm: vm['name'] or '')
+        return vms
+
+    def watch(self, vapp_hrefs: list):
+        """Add vApps to the next snapshots.
+
+        Args:
+            vapp_hrefs (list): hrefs of the vApps
+        """
+        now = time.monotonic()
+        with self._lock:
+            for href in vapp_hrefs:
+                self._watched[href] = now
+
+    def refresh(self, force: bool = False):
+        """Take a new snapshot if the current one is too old.
+
+        Only one caller runs the queries: the other ones wait for its result. The
+        current snapshot stays readable meanwhile.
+
+        Args:
+            force (bool, optional): Ignore the age of the snapshot. Defaults to False.
+        """
+        with self._refresh_lock:
+            with self._lock:
+                if not force and self._vms is not None and time.monotonic() - self._taken_at < self.max_age:
+                    return
+                start = time.monotonic()
+                expired = [href for href, asked_at in self._watched.items()
+                           if start - asked_at > self.WATCH_EXPIRY * self.max_age]
+                for href in expired:
+                    del self._watched[href]
+                watched = sorted(self._watched)
+            try:
+                vms = self._query(watched)
+            except Exception as e:
+                # Keep the previous snapshot, if any
+                logger.warning(f"Failed to query the VM inventory: {e}")
+                return
+            with self._lock:
+                self._vms = vms
+                self._taken_at = time.monotonic()
+            logger.debug(f"VM inventory of {sum(len(v) for v in vms.values())} VMs "
+                         f"in {len(vms)} vApps taken in {self._taken_at - start:.1f}s")
+
+    def get(self, vapp_href: str):
+        """Get the VMs of a vApp from the snapshot.
+
+        A vApp not watched yet is queried alone, and added to the snapshot.
+
+        Args:
+            vapp_href (str): href of the vApp
+
+        Returns:
+            list: VM details, or None if no snapshot is available
+        """
+        self.watch([vapp_href])
+        self.refresh()
+        with self._lock:
+            if self._vms is None:
+                return None
+            vms = self._vms.get(vapp_href)
+        if vms is not None:
+            return vms
+        try:
+            queried = self._query([vapp_href])
+        except Exception as e:
+            logger.warning(f"Failed to query the VMs of the vApp {vapp_href}: {e}")
+            return None
+        with self._lock:
+            # Swap in a new snapshot with this vApp, unless a newer snapshot has it already
+            if self._vms is not None and vapp_href not in self._vms:
+                self._vms = {**self._vms, **queried}
+        return queried[vapp_href]
+
+
+# Status of the vApps in the query records, by status code of the vApp resources (as in VCLOUD_STATUS_MAP)
+VAPP_RECORD_STATUSES = {
+    -1: 'FAILED_CREATION', 0: 'UNRESOLVED', 1: 'RESOLVED', 2: 'DEPLOYED', 3: 'SUSPENDED', 4: 'POWERED_ON',
+    5: 'WAITING_FOR_INPUT', 6: 'UNKNOWN', 7: 'UNRECOGNIZED', 8: 'POWERED_OFF', 9: 'INCONSISTENT_STATE',
+    10: 'MIXED', 11: 'DESCRIPTOR_PENDING', 12: 'COPYING_CONTENTS', 13: 'DISK_CONTENTS_PENDING',
+    14: 'QUARANTINED', 15: 'QUARANTINE_EXPIRED',
+}
+
+
+def vapp_record_to_entry(record):
+    """Extract the indexed state of a vApp from its query record.
+
+    Args:
+        record (ObjectifiedElement): `VAppRecord` or `AdminVAppRecord` from a query
+
+    Returns:
+        dict: vApp name, href and state
+    """
+    return {
+        'name': record.get('name'),
+        'href': record.get('href'),
+        'status': record.get('status'),
+        'deployed': record.get('isDeployed') == 'true',
+        'owner': record.get('ownerName'),
+        'expired': record.get('isExpired') == 'true',
+        'storage_expiration': record.get('autoDeleteDate'),
+        'deployment_expiration': record.get('autoUndeployDate'),
+    }
+
+
+class _VdcVapps:
+    """Snapshot of the vApps of an Org VDC, by name and by href.
+    """
+
+    def __init__(self, entries: list):
+        self.by_name = {entry['name']: entry for entry in entries}
+        self.by_href = {entry['href']: entry for entry in entries}
+        self.taken_at = time.monotonic()
+
+
+class VappIndex:
+    """Index of the vApps of each Org VDC: name -> href and basic state.
+    """
+
+    def __init__(self, client, max_age: int = 60):
+        """Define the index
+
+        Args:
+            client (pyvcloud.vcd.client.Client): Client of the vCloud instance
+            max_age (int, optional): Maximum age (in secs) of the snapshot of a VDC. Defaults to 60.
+        """
+        self.client = client
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._vdcs = {}  # VDC href -> _VdcVapps
+        self._vdc_locks = {}  # VDC href -> [lock, number of users], while in use
+
+    def _query(self, vdc_href: str, equality_filter: tuple = None):
+        """Run the paged vApp query of a VDC.
+
+        Args:
+            vdc_href (str): href of the Org VDC
+            equality_filter (tuple, optional): (attribute, value) the vApps must match. Defaults to None.
+
+        Returns:
+            list: Indexed entries of the vApps
+        """
+        query_type = ResourceType.ADMIN_VAPP.value if self.client.is_sysadmin() else ResourceType.VAPP.value
+        query = self.client.get_typed_query(
+            query_type,
+            query_result_format=QueryResultFormat.RECORDS,
+            page_size=QUERY_PAGE_SIZE,
+            qfilter=f'vdc=={vdc_href}',
+            equality_filter=equality_filter)
+        return [vapp_record_to_entry(record) for record in query.execute()]
+
+    @contextlib.contextmanager
+    def _vdc_lock(self, vdc_href: str):
+        """Hold the lock of a VDC, dropped once no caller uses it anymore.
+
+        Args:
+            vdc_href (str): href of the Org VDC
+        """
+        with self._lock:
+            vdc_lock = self._vdc_locks.setdefault(vdc_href, [threading.Lock(), 0])
+            vdc_lock[1] += 1
+        try:
+            with vdc_lock[0]:
+                yield
+        finally:
+            with self._lock:
+                vdc_lock[1] -= 1
+                if not vdc_lock[1]:
+                    del self._vdc_locks[vdc_href]
+
+    def _vdc(self, vdc_href: str, force: bool = False):
+        """Get the snapshot of a VDC, taking a new one if it is too old.
+
+        Only one caller runs the query of a VDC: the other ones wait for its result.
+        A failed query keeps the previous snapshot, and fails if there is none.
+
+        Args:
+            vdc_href (str): href of the Org VDC
+            force (bool, optional): Ignore the age of the snapshot. Defaults to False.
+
+        Returns:
+            _VdcVapps: Snapshot of the VDC
+        """
+        with self._vdc_lock(vdc_href):
+            with self._lock:
+                snapshot = self._vdcs.get(vdc_href)
+            if not force and snapshot is not None and time.monotonic() - snapshot.taken_at < self.max_age:
+                return snapshot
+            try:
+                entries = self._query(vdc_href)
+            except Exception as e:
+                if snapshot is None:
+                    raise
+                logger.warning(f"Failed to query the vApps of the VDC {vdc_href}: {e}")
+                return snapshot
+            snapshot = _VdcVapps(entries)
+            with self._lock:
+                self._vdcs[vdc_href] = snapshot
+            logger.debug(f"vApp index of the VDC {vdc_href}: {len(entries)} vApps")
+            return snapshot
+
+    def _lookup(self, vdc_href: str, attribute: str, value: str):
+        """Query a single vApp missing from the snapshot of its VDC, and index it if found.
+
+        vCD does not filter the queries on the href: a vApp is queried by name, or
+        by the id found in its href, and the records are matched on the attribute.
+
+        Args:
+            vdc_href (str): href of the Org VDC
+            attribute (str): Attribute of the vApp: `name` or `href`
+            value (str): Value of the attribute
+
+        Returns:
+            dict: Indexed entry of the vApp, or None if it does not exist
+        """
+        if attribute == 'href':
+            resource = value.rstrip('/').rsplit('/', 1)[-1]
+            # Not a vApp href: match the records of the whole VDC
+            equality_filter = (('id', f"urn:vcloud:vapp:{resource[len('vapp-'):]}")
+                               if resource.startswith('vapp-') else None)
+        else:
+            equality_filter = (attribute, value)
+        entry = next((entry for entry in self._query(vdc_href, equality_filter=equality_filter)
+                      if entry[attribute] == value), None)
+        if entry is not None:
+            self.add(vdc_href, **entry)
+        return entry
+
+    def refresh(self, vdc_href: str):
+        """Take a new snapshot of a VDC ahead of its use, like a standby replica warming up.
+
+        Args:
+            vdc_href (str): href of the Org VDC
+
+        Returns:
+            int: Number of vApps in the VDC
+        """
+        return len(self._vdc(vdc_href, force=True).by_href)
+
+    def get(self, vdc_href: str, name: str, refresh_missing: bool = False):
+        """Find a vApp of a VDC by name.
+
+        Args:
+            vdc_href (str): href of the Org VDC
+            name (str): Name of the vApp
+            refresh_missing (bool, optional): Query this vApp before reporting it as missing,
+                for the existence checks before a creation. Defaults to False.
+
+        Returns:
+            dict: Indexed entry of the vApp, or None if it does not exist
+        """
+        entry = self._vdc(vdc_href).by_name.get(name)
+        if entry is None and refresh_missing:
+            entry = self._lookup(vdc_href, 'name', name)
+        return dict(entry) if entry else None
+
+    def get_by_href(self, vdc_href: str, href: str, refresh_missing: bool = False):
+        """Find a vApp of a VDC by href.
+
+        Args:
+            vdc_href (str): href of the Org VDC
+            href (str): href of the vApp
+            refresh_missing (bool, optional): Query this vApp before reporting it as
+                missing. Defaults to False.
+
+        Returns:
+            dict: Indexed entry of the vApp, or None if it does not exist
+        """
+        entry = self._vdc(vdc_href).by_href.get(href)
+        if entry is None and refresh_missing:
+            entry = self._lookup(vdc_href, 'href', href)
+        return dict(entry) if entry else None
+
+    def add(self, vdc_href: str, name: str, href: str, status: str = None, deployed: bool = False, **state):
+        """Index a vApp created by the operator.
+
+        Args:
+            vdc_href (str): href of the Org VDC
+            name (str): Name of the vApp
+            href (str): href of the vApp
+            status (str, optional): Status of the vApp, as in the query records. Defaults to None.
+            deployed (bool, optional): Whether the vApp is deployed. Defaults to False.
+            state: Other indexed fields
+        """
+        entry = dict(state, name=name, href=href, status=status, deployed=deployed)
+        with self._lock:
+            snapshot = self._vdcs.get(vdc_href)
+            if snapshot is not None:
+                previous = snapshot.by_href.get(href)
+                if previous is not None:  # renamed, like a vApp claimed from a warm pool
+                    snapshot.by_name.pop(previous['name'], None)
+                snapshot.by_name[name] = entry
+                snapshot.by_href[href] = entry
+
+    def update(self, href: str, **state):
+        """Update the indexed state of a vApp changed by the operator.
+
+        Args:
+            href (str): href of the vApp
+            state: Indexed fields to update
+        """
+        with self._lock:
+            for snapshot in self._vdcs.values():
+                entry = snapshot.by_href.get(href)
+                if entry is not None:
+                    entry.update(state)
+
+    def remove(self, href: str):
+        """Remove a vApp deleted by the operator from the index.
+
+        Args:
+            href (str): href of the vApp
+        """
+        with self._lock:
+            for snapshot in self._vdcs.values():
+                entry = snapshot.by_href.pop(href, None)
+                if entry is not None:
+                    snapshot.by_name.pop(entry['name'], None)
+
+
+def vdc_record_to_stats(record):
+    """Extract the capacity and usage of an Org VDC from its query record.
+
+    The capacity of a resource is its limit, or its allocation if it has no
+    limit: None when it has neither (pay-as-you-go without limit).
+
+    Args:
+        record (ObjectifiedElement): `OrgVdcRecord` or `AdminVdcRecord` from a query
+
+    Returns:
+        dict: Org VDC name, href, state and (used, capacity) of each resource
+    """
+    def _int(name):
+        value = record.get(name) if name else None
+        return int(value) if value not in (None, '') else 0
+
+    def _resource(used, limit, allocation):
+        return (_int(used), _int(limit) or _int(allocation) or None)
+
+    return {
+        'name': record.get('name'),
+        'org': record.get('orgName'),
+        'href': record.get('href'),
+        'enabled': record.get('isEnabled') != 'false',
+        'cpu': _resource('cpuUsedMhz', 'cpuLimitMhz', 'cpuAllocationMhz'),
+        'memory': _resource('memoryUsedMB', 'memoryLimitMB', 'memoryAllocationMB'),
+        'storage': _resource('storageUsedMB', 'storageLimitMB', None),
+    }
+
+
+def vdc_free_share(stats: dict):
+    """Free share of the most used resource of an Org VDC.
+
+    Args:
+        stats (dict): Org VDC capacity and usage
+
+    Returns:
+        float: Free share, from 0 (full) to 1 (empty or unlimited)
+    """
+    shares = [1 - used / capacity for used, capacity in (stats['cpu'], stats['memory'], stats['storage'])
+              if capacity]
+    return max(0.0, min(shares, default=1.0))
+
+
+class VdcCapacity:
+    """Snapshot of the capacity and usage of the Org VDCs of a vCloud instance.
+    """
+
+    def __init__(self, client, max_age: int = 60):
+        """Define the snapshot
+
+        Args:
+            client (pyvcloud.vcd.client.Client): Client of the vCloud instance
+            max_age (int, optional): Maximum age (in secs) of the snapshot. Defaults to 60.
+        """
+        self.client = client
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._vdcs = None  # (org name, VDC name) -> capacity and usage
+        self._placed = collections.Counter()  # (org name, VDC name) -> placements since the snapshot
+        self._taken_at = 0
+
+    def _query(self):
+        """Run the paged Org VDC query.
+
+        Returns:
+            dict: Capacity and usage by (org name, VDC name)
+        """
+        query_type = ResourceType.ADMIN_ORG_VDC.value if self.client.is_sysadmin() else ResourceType.ORG_VDC.value
+        query = self.client.get_typed_query(
+            query_type,
+            query_result_format=QueryResultFormat.RECORDS,
+            page_size=QUERY_PAGE_SIZE)
+        vdcs = {}
+        for record in query.execute():
+            stats = vdc_record_to_stats(record)
+            vdcs[(stats['org'], stats['name'])] = stats
+        return vdcs
+
+    def refresh(self, force: bool = False):
+        """Take a new snapshot if the current one is too old.
+
+        Only one caller runs the query: the other ones wait for its result.
+
+        Args:
+            force (bool, optional): Ignore the age of the snapshot. Defaults to False.
+        """
+        with self._lock:
+            if not force and self._vdcs is not None and time.monotonic() - self._taken_at < self.max_age:
+                return
+            try:
+                vdcs = self._query()
+            except Exception as e:
+                # Keep the previous snapshot, if any
+                logger.warning(f"Failed to query the Org VDCs capacity: {e}")
+                return
+            self._vdcs = vdcs
+            self._placed.clear()
+            self._taken_at = time.monotonic()
+            logger.debug(f"Capacity of {len(vdcs)} Org VDCs taken")
+
+    def is_taken(self):
+        """Check if a snapshot is available.
+
+        Returns:
+            bool: Whether a snapshot was taken
+        """
+        with self._lock:
+            return self._vdcs is not None
+
+    def get(self, org_name: str, vdc_name: str):
+        """Get the capacity and usage of an Org VDC from the snapshot, without reading it again.
+
+        Args:
+            org_name (str): Name of the Organization
+            vdc_name (str): Name of the Org VDC
+
+        Returns:
+            dict: Capacity and usage, or None if the Org VDC is unknown
+        """
+        with self._lock:
+            return (self._vdcs or {}).get((org_name, vdc_name))
+
+    def place(self, org_name: str, candidates: list = None, pattern: str = None, min_free: float = 0.1):
+        """Pick the Org VDC of a new vApp among candidates, from the snapshot, without reading it again.
+
+        The snapshot is taken by the periodic `refresh` of the caller. The enabled
+        candidates with at least `min_free` of each resource free are eligible.
+        The one with the fewest placements since the snapshot is picked first, to
+        spread the creations until the usage is read again, then the one with the
+        most free resources.
+
+        Args:
+            org_name (str): Name of the Organization
+            candidates (list, optional): Names of the candidate Org VDCs. Defaults to all of them.
+            pattern (str, optional): Shell-style pattern of the candidate Org VDC names. Defaults to None.
+            min_free (float, optional): Minimum free share of each resource. Defaults to 0.1.
+
+        Returns:
+            str: Name of the picked Org VDC, or None if no candidate has enough capacity
+                (or no snapshot is available)
+        """
+        with self._lock:
+            eligible = [
+                stats for (org, name), stats in (self._vdcs or {}).items()
+                if org == org_name and stats['enabled']
+                and (not candidates or name in candidates)
+                and (not pattern or fnmatch.fnmatchcase(name, pattern))
+                and vdc_free_share(stats) >= min_free
+            ]
+            if not eligible:
+                return None
+            picked = min(eligible, key=lambda stats: (self._placed[(org_name, stats['name'])],
+                                                      -vdc_free_share(stats)))
+            self._placed[(org_name, picked['name'])] += 1
+            return picked['name']
+
+    def has_vdc(self, org_name: str, vdc_name: str):
+        """Check if an Org VDC exists in the snapshot, without reading it again.
+
+        Args:
+            org_name (str): Name of the Organization
+            vdc_name (str): Name of the Org VDC
+
+        Returns:
+            bool: Whether the Org VDC exists, or None if no snapshot is available
+        """
+        with self._lock:
+            if self._vdcs is None:
+                return None
+            return (org_name, vdc_name) in self._vdcs
+
+
+class OrgDirectory:
+    """Snapshot of the names of the organizations, users and catalog items of a vCloud instance.
+    """
+
+    def __init__(self, client, max_age: int = 60):
+        """Define the directory
+
+        Args:
+            client (pyvcloud.vcd.client.Client): Client of the vCloud instance
+            max_age (int, optional): Maximum age (in secs) of the snapshot. Defaults to 60.
+        """
+        self.client = client
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._orgs = None  # org names
+        self._users = None  # (org name, username)
+        self._catalog_items = None  # (catalog name, item name)
+        self._taken_at = 0
+
+    def _records(self, query_type: str, qfilter: str = None):
+        query = self.client.get_typed_query(
+            query_type,
+            query_result_format=QueryResultFormat.RECORDS,
+            page_size=QUERY_PAGE_SIZE,
+            qfilter=qfilter)
+        return query.execute()
+
+    def _query(self):
+        """Run the paged organization, user and catalog item queries.
+
+        Returns:
+            tuple: org names, (org name, username) and (catalog name, item name) sets
+        """
+        if self.client.is_sysadmin():
+            org_names = {record.get('href'): record.get('name')
+                         for record in self._records(ResourceType.ORGANIZATION.value)}
+        else:
+            org = self.client.get_org()
+            org_names = {org.get('href'): org.get('name')}
+        users = {(org_names.get(record.get('org')), record.get('name'))
+                 for record in self._records(ResourceType.ADMIN_USER.value)}
+        query_type = (ResourceType.ADMIN_CATALOG_ITEM.value if self.client.is_sysadmin()
+                      else ResourceType.CATALOG_ITEM.value)
+        catalog_items = {(record.get('catalogName'), record.get('name'))
+                         for record in self._records(query_type, qfilter='entityType==vapptemplate')}
+        return set(org_names.values()), users, catalog_items
+
+    def refresh(self, force: bool = False):
+        """Take a new snapshot if the current one is too old.
+
+        Args:
+            force (bool, optional): Ignore the age of the snapshot. Defaults to False.
+        """
+        with self._lock:
+            if not force and self._orgs is not None and time.monotonic() - self._taken_at < self.max_age:
+                return
+            try:
+                orgs, users, catalog_items = self._query()
+            except Exception as e:
+                # Keep the previous snapshot, if any
+                logger.warning(f"Failed to query the organizations, users and catalog items: {e}")
+                return
+            self._orgs, self._users, self._catalog_items = orgs, users, catalog_items
+            self._taken_at = time.monotonic()
+            logger.debug(f"Directory of {len(orgs)} orgs, {len(users)} users and "
+                         f"{len(catalog_items)} catalog items taken")
+
+    def has_org(self, org_name: str):
+        """Check if an organization exists in the snapshot, without reading it again.
+
+        Args:
+            org_name (str): Name of the Organization
+
+        Returns:
+            bool: Whether the organization exists, or None if no snapshot is available
+        """
+        with self._lock:
+            return None if self._orgs is None else org_name in self._orgs
+
+    def has_user(self, org_name: str, username: str):
+        """Check if a user exists in the snapshot, without reading it again.
+
+        Args:
+            org_name (str): Name of the Organization
+            username (str): Name of the user
+
+        Returns:
+            bool: Whether the user exists, or None if no snapshot is available
+        """
+        with self._lock:
+            return None if self._users is None else (org_name, username) in self._users
+
+    def has_catalog_item(self, catalog: str, name: str):
+        """Check if a vApp template exists in a catalog in the snapshot, without reading it again.
+
+        Args:
+            catalog (str): Name of the catalog
+            name (str): Name of the vApp template
+
+        Returns:
+            bool: Whether the vApp template exists, or None if no snapshot is available
+        """
+        with self._lock:
+            return None if self._catalog_items is None else (catalog, name) in self._catalog_items
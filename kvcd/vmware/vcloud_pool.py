@@ -0,0 +1,436 @@
+"""Warm pools of pre-instantiated vApps.
+
+Instantiating a vApp from a catalog takes minutes. A warm pool keeps a number
+of powered off vApps instantiated in advance from a (catalog, template) in an
+Org VDC. The creation of a matching vcdvapp claims one of them by renaming it,
+instead of instantiating a new one, and the pool is refilled in the background
+with a bounded number of instantiations at the same time.
+
+The pools are listed in the `KVCD_POOL_FILE` YAML file:
+
+.. code-block:: yaml
+
+    - org: orgX
+      vdc: vdcX
+      catalog: ci-catalog
+      template: ubuntu-runner
+      size: 10
+      site: paris  # optional
+
+The vApps of a pool are found by their name prefix (`kvcd-pool-<pool id>-`)
+with a paged vApp query. A claim is first recorded in a Kubernetes lease named
+after the vApp: the creation of a lease is atomic, so that two claimers (for
+example a replica that restarted, or a new leader while the previous one still
+finishes a claim) never rename the same vApp.
+"""
+
+import hashlib
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import kopf
+import yaml
+from kubernetes.client.rest import ApiException
+from pyvcloud.vcd.client import QueryResultFormat
+from pyvcloud.vcd.client import ResourceType
+from pyvcloud.vcd.client import TaskStatus
+from pyvcloud.vcd.vapp import VApp
+from pyvcloud.vcd.vdc import VDC
+from kvcd.kube_helper import micro_time, read_lease, create_lease, replace_lease, delete_lease
+from kvcd.leader import current_namespace
+from kvcd.metrics import counter, gauge
+from kvcd.vmware.vcloud_helper import VcdSession, get_vdc, wait_for_task
+from kvcd.vmware.vcloud_scheduler import Priority
+from kvcd.main import get_vcd_session, resolve_site, kvcd_config, wait_for_leadership
+
+
+logger = logging.getLogger(__name__)
+
+POOL_NAME_PREFIX = 'kvcd-pool-'
+QUERY_PAGE_SIZE = 128
+# Query record status of the vApps ready to be claimed
+READY_STATUSES = ('POWERED_OFF', 'RESOLVED')
+CLAIM_LEASE_PREFIX = 'kvcd-pool-claim-'
+# Duration (in secs) after which the claim of a claimer that did not finish it can be taken over
+CLAIM_DURATION = 600
+
+_READY = gauge(
+    'kvcd_pool_ready_vapps',
+    'Number of vApps ready to be claimed in a warm pool',
+    ('pool',))
+_CLAIMS = counter(
+    'kvcd_pool_claims_total',
+    'Number of vcdvapp creations served (hit) or not (miss) by a warm pool',
+    ('pool', 'result'))
+_INSTANTIATIONS = counter(
+    'kvcd_pool_instantiations_total',
+    'Number of vApps instantiated to refill a warm pool',
+    ('pool', 'result'))
+
+
+class VappPool:
+    """A warm pool of vApps instantiated from a template in an Org VDC.
+    """
+
+    def __init__(self, org: str, vdc: str, catalog: str, template: str, size: int, site: str = None):
+        """Define the pool
+
+        Args:
+            org (str): Name of the Organization
+            vdc (str): Name of the Org VDC
+            catalog (str): Name of the catalog
+            template (str): Name of the vApp template
+            size (int): Number of vApps to keep in the pool
+            site (str, optional): Name of the site. Defaults to the only or default site.
+        """
+        self.site = resolve_site(site)
+        self.org = org
+        self.vdc = vdc
+        self.catalog = catalog
+        self.template = template
+        self.size = int(size)
+        key = '/'.join([self.site, org, vdc, catalog, template])
+        self.id = hashlib.sha1(key.encode()).hexdigest()[:8]
+        self.name_prefix = f"{POOL_NAME_PREFIX}{self.id}-"
+        self.lock = threading.Lock()
+        self.claiming = set()  # hrefs of the vApps being claimed by this replica
+        self.instantiating = set()  # names of the vApps being instantiated
+
+    def __str__(self):
+        return f"{self.catalog}/{self.template}@{self.org}/{self.vdc} ({self.id})"
+
+    def matches(self, spec: kopf.Spec, vdc_name: str = None):
+        """Check if the vApp of a vcdvapp can be taken from this pool.
+
+        Args:
+            spec (kopf.Spec): vcdvapp specs
+            vdc_name (str, optional): Org VDC of the vcdvapp. Defaults to the `vdc` of its specs.
+
+        Returns:
+            bool: True if the vcdvapp matches the pool
+        """
+        try:
+            site = resolve_site(spec.get('site'))
+        except kopf.PermanentError:
+            return False
+        return (site == self.site and
+                spec.get('org') == self.org and
+                (vdc_name or spec.get('vdc')) == self.vdc and
+                spec.get('source_catalog') == self.catalog and
+                spec.get('source_template_name') == self.template)
+
+
+def load_pools(path: str):
+    """Read the warm pools from a YAML file.
+
+    Args:
+        path (str): Path of the YAML file: empty for no pool
+
+    Returns:
+        list: `VappPool` objects
+    """
+    if not path:
+        return []
+    with open(path) as f:
+        entries = yaml.safe_load(f) or []
+    pools = [VappPool(**entry) for entry in entries]
+    for pool in pools:
+        logger.debug(f"Warm pool {pool} of {pool.size} vApps loaded from {path}")
+    return pools
+
+
+def list_pool_vapps(vcd_session: VcdSession, pool: VappPool, vdc_href: str):
+    """List the vApps of a pool, with a name filtered query.
+
+    Args:
+        vcd_session (VcdSession): VCD session
+        pool (VappPool): Warm pool
+        vdc_href (str): href of the Org VDC of the pool
+
+    Returns:
+        list: Query records of the vApps of the pool
+    """
+    client = vcd_session.client
+    query_type = ResourceType.ADMIN_VAPP.value if client.is_sysadmin() else ResourceType.VAPP.value
+    query = client.get_typed_query(
+        query_type,
+        query_result_format=QueryResultFormat.RECORDS,
+        page_size=QUERY_PAGE_SIZE,
+        qfilter=f'name=={pool.name_prefix}*;vdc=={vdc_href}')
+    return [record for record in query.execute() if record.get('status') != 'FAILED_CREATION']
+
+
+def _claim_lease_name(href: str):
+    # vApp href ends with its `vapp-<uuid>` id, a valid lease name
+    return f"{CLAIM_LEASE_PREFIX}{href.rstrip('/').rsplit('/', 1)[-1]}"
+
+
+def acquire_claim(href: str, holder: str):
+    """Record the claim of a pool vApp in a lease, unless another claimer holds it.
+
+    A claim left by a claimer that did not finish it (crash of the replica) can
+    be taken over after `CLAIM_DURATION`.
+
+    Args:
+        href (str): href of the vApp
+        holder (str): Identity of the claimer
+
+    Returns:
+        bool: True if the claim is held by `holder`
+    """
+    namespace = kvcd_config.leader.namespace or current_namespace()
+    lease_name = _claim_lease_name(href)
+    now = datetime.now(timezone.utc)
+    try:
+        create_lease(namespace, lease_name, {
+            'holderIdentity': holder,
+            'leaseDurationSeconds': CLAIM_DURATION,
+            'acquireTime': micro_time(now),
+            'renewTime': micro_time(now),
+        })
+        return True
+    except ApiException as e:
+        if e.status != 409:
+            raise
+    lease = read_lease(namespace, lease_name)
+    spec = lease.spec
+    if spec.holder_identity == holder:
+        return True  # retry of the same claim
+    renew_time = spec.renew_time or spec.acquire_time
+    if renew_time and renew_time + timedelta(seconds=spec.lease_duration_seconds or CLAIM_DURATION) > now:
+        return False
+    logger.info(f"Taking over the stale claim of {spec.holder_identity} on the pool vApp {href}")
+    spec.holder_identity = holder
+    spec.acquire_time = now
+    spec.renew_time = now
+    try:
+        replace_lease(lease)
+    except ApiException as e:
+        if e.status == 409:  # taken over by another claimer meanwhile
+            return False
+        raise
+    return True
+
+
+def release_claim(href: str):
+    """Delete the claim lease of a pool vApp.
+
+    Args:
+        href (str): href of the vApp
+    """
+    namespace = kvcd_config.leader.namespace or current_namespace()
+    try:
+        delete_lease(namespace, _claim_lease_name(href))
+    except ApiException as e:
+        if e.status != 404:
+            logger.warning(f"Failed to delete the claim of the pool vApp {href}: {e}")
+
+
+def claim_pool_vapp(vcd_session: VcdSession, pool: VappPool, vdc: VDC, name: str, description: str,
+                    logger: kopf.Logger):
+    """Take a ready vApp from a pool, by renaming it.
+
+    Args:
+        vcd_session (VcdSession): VCD session
+        pool (VappPool): Warm pool
+        vdc (VDC): Org VDC of the pool
+        name (str): New name of the vApp
+        description (str): New description of the vApp
+        logger (kopf.Logger): Logger facility
+
+    Returns:
+        str: href of the claimed vApp, or None if no vApp is ready
+    """
+    holder = f"{vdc.href}/{name}"
+    with pool.lock:
+        ready = [record.get('href') for record in list_pool_vapps(vcd_session, pool, vdc.href)
+                 if record.get('status') in READY_STATUSES]
+    for href in ready:
+        with pool.lock:
+            if href in pool.claiming:
+                continue
+            pool.claiming.add(href)
+        try:
+            if not acquire_claim(href, holder):
+                continue
+            try:
+                vapp = VApp(vcd_session.client, href=href)
+                # Claimed and renamed by another claimer since the query
+                if not vapp.get_resource().get('name', '').startswith(pool.name_prefix):
+                    continue
+                task = wait_for_task(vcd_session, vapp.edit_name_and_description(name=name, description=description))
+            finally:
+                # Renamed or not, the vApp is only found by the name prefix of the pool from now on
+                release_claim(href)
+        finally:
+            with pool.lock:
+                pool.claiming.discard(href)
+        vapp_pools.wake_up()
+        if task.get('status') != TaskStatus.SUCCESS.value:
+            logger.warning(f"Failed to claim the vApp {href} from the warm pool {pool}: {task.get('status')}")
+            break
+        _CLAIMS.labels(pool.id, 'hit').inc()
+        logger.info(f"vApp {name} claimed from the warm pool {pool}")
+        return href
+    else:
+        logger.info(f"No vApp ready in the warm pool {pool}")
+    _CLAIMS.labels(pool.id, 'miss').inc()
+    return None
+
+
+def instantiate_pool_vapp(vcd_session: VcdSession, pool: VappPool, vdc: VDC, name: str):
+    """Instantiate a powered off vApp in a pool.
+
+    Args:
+        vcd_session (VcdSession): VCD session
+        pool (VappPool): Warm pool
+        vdc (VDC): Org VDC of the pool
+        name (str): Name of the vApp, with the name prefix of the pool
+    """
+    # Only hold a scheduler slot to send the request, not during the instantiation
+    with vcd_session.scheduler.slot(Priority.REFRESH):
+        create_result = vdc.instantiate_vapp(
+            name=name,
+            catalog=pool.catalog,
+            template=pool.template,
+            description="Warm pool vApp, managed by kvcd",
+            deploy=False,
+            power_on=False,
+            accept_all_eulas=True)
+    task = wait_for_task(vcd_session, create_result.Tasks.Task[0])
+    if task.get('status') != TaskStatus.SUCCESS.value:
+        raise kopf.PermanentError(f"Failed to instantiate the vApp {name}: {task.get('status')}")
+    logger.debug(f"vApp {name} added to the warm pool {pool}")
+
+
+class PoolManager:
+    """Background refill of the warm pools.
+    """
+
+    def __init__(self, pools: list, concurrency: int, interval: int):
+        """Define the pool manager
+
+        Args:
+            pools (list): `VappPool` objects
+            concurrency (int): Maximum number of instantiations at the same time, for all the pools
+            interval (int): Maximum interval (in secs) between two checks of the pools
+        """
+        self.pools = pools
+        self.concurrency = max(1, concurrency)
+        self.interval = interval
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._executor = None
+        self._thread = None
+
+    def find(self, spec: kopf.Spec, vdc_name: str = None):
+        """Find the pool of a vcdvapp.
+
+        Args:
+            spec (kopf.Spec): vcdvapp specs
+            vdc_name (str, optional): Org VDC of the vcdvapp. Defaults to the `vdc` of its specs.
+
+        Returns:
+            VappPool: Matching pool, or None
+        """
+        return next((pool for pool in self.pools if pool.matches(spec, vdc_name)), None)
+
+    def wake_up(self):
+        """Check the pools now, after a claim.
+        """
+        self._wakeup.set()
+
+    def start(self):
+        """Start the background refill.
+        """
+        if not self.pools:
+            return
+        self._stopping.clear()
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='kvcd-pool')
+        self._thread = threading.Thread(target=self._run, name='kvcd-pool-refill', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background refill, without waiting for the running instantiations.
+        """
+        self._stopping.set()
+        self._wakeup.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self):
+        if not wait_for_leadership(self._stopping):
+            return
+        while not self._stopping.is_set():
+            self._wakeup.clear()
+            for pool in self.pools:
+                try:
+                    self.refill(pool)
+                except Exception as e:
+                    logger.warning(f"Failed to refill the warm pool {pool}: {e}")
+            self._wakeup.wait(self.interval)
+
+    def refill(self, pool: VappPool):
+        """Start the instantiations missing in a pool.
+
+        Args:
+            pool (VappPool): Warm pool
+        """
+        vcd_session = get_vcd_session(pool.site)
+        with vcd_session.scheduler.slot(Priority.REFRESH):
+            vdc = get_vdc(vcd_session=vcd_session, org_name=pool.org, vdc_name=pool.vdc)
+            with pool.lock:
+                records = list_pool_vapps(vcd_session, pool, vdc.href)
+                ready = sum(1 for r in records if r.get('status') in READY_STATUSES)
+                # vCD lists a vApp as soon as its instantiation starts: only count the others
+                listed = set(r.get('name') for r in records)
+                missing = pool.size - len(records) - len(pool.instantiating - listed)
+                names = [f"{pool.name_prefix}{uuid.uuid4().hex[:8]}" for _ in range(max(0, missing))]
+                pool.instantiating.update(names)
+        _READY.labels(pool.id).set(ready)
+        if names:
+            logger.info(f"Refilling the warm pool {pool} with {len(names)} vApps")
+        for name in names:
+            self._executor.submit(self._instantiate, vcd_session, pool, vdc, name)
+
+    def _instantiate(self, vcd_session: VcdSession, pool: VappPool, vdc: VDC, name: str):
+        try:
+            instantiate_pool_vapp(vcd_session, pool, vdc, name)
+        except Exception as e:
+            # Retried at the next periodic check only
+            logger.warning(f"Failed to instantiate a vApp in the warm pool {pool}: {e}")
+            _INSTANTIATIONS.labels(pool.id, 'failure').inc()
+            return
+        finally:
+            with pool.lock:
+                pool.instantiating.discard(name)
+        _INSTANTIATIONS.labels(pool.id, 'success').inc()
+        self._wakeup.set()
+
+
+vapp_pools = PoolManager(
+    load_pools(kvcd_config.pool.file),
+    concurrency=kvcd_config.pool.concurrency,
+    interval=kvcd_config.pool.refill_interval)
+
+
+@kopf.on.startup()
+def start_vapp_pools(logger: kopf.Logger, **kwargs):
+    """Startup function: start the refill of the warm pools
+
+    Args:
+        logger (kopf.Logger): Logger facility
+    """
+    if vapp_pools.pools:
+        logger.info(f"Starting the refill of {len(vapp_pools.pools)} warm pools")
+    vapp_pools.start()
+
+
+@kopf.on.cleanup()
+def stop_vapp_pools(**kwargs):
+    """Cleanup function: stop the refill of the warm pools
+    """
+    vapp_pools.stop()
@@ -0,0 +1,191 @@
+"""Kopf based resource management for the bulk power operations on vApps
+
+A `VcdPowerSchedule` object selects vcdvapps by namespace and labels, and drives
+their power state in a bounded parallel window, with a per Org VDC throttling.
+"""
+
+import kopf
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from kvcd.kube_helper import patch_custom_object
+from kvcd.vmware.vcloud_queue import vapp_operations
+from kvcd.vmware.vcloud_scheduler import Priority
+from kvcd.vmware.vcloud_vapp import vapp_reconcile_power_state, bulk_power_hrefs
+from kvcd.main import get_vcd_session, kvcd_config, status_writer
+
+
+class BulkPowerProgress:
+    """Aggregated progress of a bulk power operation, shared by its workers.
+    """
+
+    def __init__(self, total: int):
+        self._lock = threading.Lock()
+        self.total = total
+        self.succeeded = 0
+        self.failed = 0
+        self.started_at = time.monotonic()
+
+    def done(self, success: bool):
+        """Record the end of the operation on one vApp.
+
+        Args:
+            success (bool): Whether the operation succeeded
+        """
+        with self._lock:
+            if success:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+
+    def as_dict(self):
+        """Current progress as a status entry.
+
+        Returns:
+            dict: Progress counters
+        """
+        with self._lock:
+            return {
+                'total': self.total,
+                'succeeded': self.succeeded,
+                'failed': self.failed,
+                'pending': self.total - self.succeeded - self.failed,
+                'elapsedSeconds': int(time.monotonic() - self.started_at),
+            }
+
+
+def select_vcdvapps(vcdvapp_index: kopf.Index, namespaces: list, match_labels: dict):
+    """Select the vcdvapps with a backing vApp from the in-memory index.
+
+    Args:
+        vcdvapp_index (kopf.Index): Index of the vcdvapps by namespace
+        namespaces (list): Namespaces to look in
+        match_labels (dict): Labels that the vcdvapps must have
+
+    Returns:
+        list: Indexed vcdvapps entries, with their namespace
+    """
+    selected = []
+    for namespace in namespaces:
+        for entry in vcdvapp_index.get(namespace, []):
+            if not entry.get('vcd_vapp_href'):
+                continue
+            if all(entry['labels'].get(k) == v for k, v in match_labels.items()):
+                selected.append(dict(entry, namespace=namespace))
+    return selected
+
+
+async def bulk_power(targets: list, powered_on: bool, logger: kopf.Logger,
+                     concurrency: int, vdc_concurrency: int, progress_callback=None):
+    """Drive the power state of several vApps in a bounded parallel window.
+
+    Each target vcdvapp gets its `spec.powered_on` updated, so that its own
+    handlers keep the same expected state, then its vApp is powered on or off.
+    Until the bulk operation has processed a vApp, the per-object power handler
+    stands back.
+
+    The vApps are processed by threads of the bulk operation itself: no thread
+    of the kopf executor is held while waiting for them. The failure on one
+    vApp, whatever its error, is counted and does not stop the others.
+
+    Args:
+        targets (list): Indexed vcdvapps entries to process
+        powered_on (bool): Expected power state
+        logger (kopf.Logger): Logger facility
+        concurrency (int): Maximum number of power operations at the same time
+        vdc_concurrency (int): Maximum number of power operations at the same time in one VDC
+        progress_callback (callable, optional): Called with the progress after each vApp.
+
+    Returns:
+        BulkPowerProgress: Final progress of the operation
+    """
+    progress = BulkPowerProgress(total=len(targets))
+    vdc_windows = {
+        vdc_href: threading.BoundedSemaphore(vdc_concurrency)
+        for vdc_href in set(t.get('vcd_vdc_href') for t in targets)
+    }
+    # Owned before any spec is patched: the per-object handler stands back from the start
+    owned = {}
+    owned_lock = threading.Lock()
+    for index, target in enumerate(targets):
+        bulk_power_hrefs.acquire(target['vcd_vapp_href'])
+        owned[index] = target['vcd_vapp_href']
+
+    def _release(index: int):
+        with owned_lock:
+            vapp_href = owned.pop(index, None)
+        if vapp_href is not None:
+            bulk_power_hrefs.release(vapp_href)
+
+    def _power(index: int, target: dict):
+        vapp_href = target['vcd_vapp_href']
+        try:
+            if target.get('powered_on') != powered_on:
+                patch_custom_object('vcdvapps', target['namespace'], target['name'],
+                                    {'spec': {'powered_on': powered_on}})
+            vcd_session = get_vcd_session(target.get('site'))
+            with vdc_windows[target.get('vcd_vdc_href')]:
+                vapp_operations.run(
+                    vapp_href, vcd_session.scheduler.run, Priority.RECONCILE,
+                    vapp_reconcile_power_state, merge_key='power_state',
+                    vcd_session=vcd_session,
+                    vapp_href=vapp_href,
+                    expected_power_state=powered_on,
+                    logger=logger)
+            progress.done(success=True)
+        except Exception as e:
+            logger.warning(f"Failed to power {'on' if powered_on else 'off'} vcdvapp "
+                           f"{target['namespace']}/{target['name']}: {e}")
+            progress.done(success=False)
+        finally:
+            _release(index)
+        if progress_callback:
+            progress_callback(progress)
+
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix='kvcd-bulk-power')
+    try:
+        await asyncio.gather(*(loop.run_in_executor(executor, _power, index, target)
+                               for index, target in enumerate(targets)))
+    finally:
+        executor.shutdown(wait=False)
+        for index in list(owned):
+            _release(index)
+    return progress
+
+
+@kopf.on.create('kvcd.lrivallain.dev', 'v1', 'vcdpowerschedules')
+@kopf.on.update('kvcd.lrivallain.dev', 'v1', 'vcdpowerschedules')
+async def apply_vcdpowerschedule(spec: kopf.Spec, name: str, namespace: str,
+                                 logger: kopf.Logger, vcdvapp_index: kopf.Index, **kwargs):
+    """Apply the expected power state to all the selected vcdvapps
+
+    Args:
+        spec (kopf.Spec): Object specs
+        name (str): Name of the object
+        namespace (str): Name of the namespace where object is declared
+        logger (kopf.Logger): Logger facility
+        vcdvapp_index (kopf.Index): Index of the vcdvapps by namespace
+    """
+    powered_on = spec.get('powered_on')
+    targets = select_vcdvapps(
+        vcdvapp_index,
+        namespaces=spec.get('namespaces') or [namespace],
+        match_labels=spec.get('selector', {}).get('matchLabels', {}))
+    logger.info(f"Powering {'on' if powered_on else 'off'} {len(targets)} vcdvapps")
+
+    def _report(progress: BulkPowerProgress):
+        # Merged with the previous progress if it is not written yet
+        status_writer.submit('vcdpowerschedules', namespace, name, {'progress': progress.as_dict()})
+
+    progress = await bulk_power(
+        targets, powered_on=powered_on, logger=logger,
+        concurrency=spec.get('parallelism') or kvcd_config.power_concurrency,
+        vdc_concurrency=spec.get('vdc_parallelism') or kvcd_config.power_vdc_concurrency,
+        progress_callback=_report)
+    status_writer.submit('vcdpowerschedules', namespace, name, {'progress': progress.as_dict()}, urgent=True)
+    logger.info(f"Bulk power operation done: {progress.as_dict()}")
+    if progress.failed:
+        raise kopf.PermanentError(f"{progress.failed} vcdvapps failed to reach the expected power state")
+    return {'message': f"{progress.succeeded} vcdvapps powered {'on' if powered_on else 'off'}"}
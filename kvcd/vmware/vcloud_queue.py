@@ -0,0 +1,150 @@
+"""Per-vApp serialization of the operations sent to Cloud Director.
+
+Cloud Director rejects concurrent changes on the same entity with a `BUSY_ENTITY`
+error. Operations are queued by vApp href so that operations on one vApp run one
+after another, while different vApps are still processed in parallel. An
+operation only leaves the queue once the vCD task it started is over.
+"""
+
+import logging
+import threading
+from concurrent.futures import Future
+
+import kopf
+
+
+logger = logging.getLogger(__name__)
+
+
+class OperationWaitTimeout(kopf.TemporaryError):
+    """The previous operations on the vApp did not finish in time: retry after the given delay.
+    """
+
+
+class _Operation:
+    """A queued operation and the future shared by all its callers.
+    """
+
+    def __init__(self, merge_key: str, func, args: tuple, kwargs: dict):
+        self.merge_key = merge_key
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.turn = threading.Event()  # set once the operation is at the head of the queue
+        self.started = False
+        self.callers = 1  # callers still waiting for their turn: the first one to get it runs the operation
+
+
+class VappOperationQueue:
+    """Ordered work queue of operations, keyed by vApp href.
+
+    Each caller waits for its operation to reach the head of the queue of its
+    href, runs it on its own thread, then hands over to the next operation:
+    there is no extra thread, and no caller runs the work of another one.
+
+    kopf already runs the handlers of one object one after another: the queue
+    orders them with the operations of the other callers on the same vApp (bulk
+    power, sweep, pools). An operation submitted with the same `merge_key` as
+    one still waiting in the queue is merged into it: the queued operation takes
+    the arguments of the latest call and both callers get the same result.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}  # href -> list of _Operation, the running one first
+
+    def run(self, href: str, func, *args, merge_key: str = None, wait_timeout: float = None, **kwargs):
+        """Run `func(*args, **kwargs)` once every previous operation on `href` is done.
+
+        The operation must wait for the vCD tasks it starts: the next operation
+        on the vApp runs as soon as it returns.
+
+        Args:
+            href (str): Href of the vApp targeted by the operation
+            func (callable): Operation to run
+            merge_key (str, optional): Operations with the same key can be merged
+                while queued. Defaults to None (never merged).
+            wait_timeout (float, optional): Maximum waiting duration (in secs) for
+                the previous operations. Defaults to None (no limit).
+
+        Raises:
+            OperationWaitTimeout: The turn of the operation did not come within `wait_timeout`
+
+        Returns:
+            The result of `func`, or of the operation it was merged into.
+        """
+        with self._lock:
+            queue = self._pending.setdefault(href, [])
+            operation = next((queued for queued in queue if merge_key is not None
+                              and queued.merge_key == merge_key and not queued.started), None)
+            if operation is not None:
+                logger.debug(f"Merging queued {merge_key} operation on vApp: {href}")
+                operation.func, operation.args, operation.kwargs = func, args, kwargs
+                operation.callers += 1
+            else:
+                operation = _Operation(merge_key, func, args, kwargs)
+                queue.append(operation)
+                if len(queue) == 1:
+                    operation.turn.set()
+        if not operation.turn.wait(wait_timeout):
+            self._withdraw(href, operation, wait_timeout)
+        with self._lock:
+            owner = not operation.started
+            operation.started = True
+            func, args, kwargs = operation.func, operation.args, operation.kwargs
+        if owner:
+            try:
+                operation.future.set_result(func(*args, **kwargs))
+            except BaseException as e:
+                operation.future.set_exception(e)
+            finally:
+                self._next(href)
+        return operation.future.result()
+
+    def _withdraw(self, href: str, operation: _Operation, wait_timeout: float):
+        """Give up waiting for the turn of an operation.
+
+        The operation stays queued while other callers merged into it still wait.
+
+        Raises:
+            OperationWaitTimeout: The turn did not come
+        """
+        with self._lock:
+            if operation.turn.is_set():
+                return  # granted meanwhile
+            operation.callers -= 1
+            if not operation.callers:
+                self._pending[href].remove(operation)
+        raise OperationWaitTimeout(
+            f"Previous operations on vApp {href} still running after {wait_timeout}s",
+            delay=max(1, int(wait_timeout)))
+
+    def _next(self, href: str):
+        """Remove the finished head of the queue of `href` and give the turn to the next operation.
+
+        Args:
+            href (str): Href of the vApp
+        """
+        with self._lock:
+            queue = self._pending[href]
+            queue.pop(0)
+            if queue:
+                queue[0].turn.set()
+            else:
+                del self._pending[href]
+
+    def depth(self, href: str):
+        """Number of operations waiting for a vApp.
+
+        Args:
+            href (str): Href of the vApp
+
+        Returns:
+            int: Number of queued operations (excluding the running one)
+        """
+        with self._lock:
+            return len([operation for operation in self._pending.get(href, []) if not operation.started])
+
+
+vapp_operations = VappOperationQueue()
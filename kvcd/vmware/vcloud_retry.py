@@ -0,0 +1,316 @@
+"""Retry policy of the handlers, by class of vCD error.
+
+kopf retries a failed handler after the delay of its `TemporaryError`, the
+same for every object: after an outage, all the objects that failed together
+retry together, again and again. Instead, the handlers decorated with
+`retry_policy`:
+
+* classify the error (and the vCD error it was raised from) in a retry reason:
+  `BUSY_ENTITY`, invalid state, missing entity, vCloud unreachable or failing...
+* compute the delay of the next attempt from the backoff curve of this reason
+  and the attempt number, with some jitter to break the synchronization,
+* spread the retries of all the objects so that no more than `KVCD_RETRY_BUDGET`
+  of them are scheduled in the same second,
+* publish the retry state of the object in its `status.retry` when its reason
+  or the magnitude of its attempt number changes, cleared once the handler
+  succeeds.
+
+The transient vCD errors raised as is by the handlers (server errors, timeouts,
+`BUSY_ENTITY`) are retried as `TemporaryError` too. The permanent errors and the
+other exceptions are left untouched.
+"""
+
+import asyncio
+import collections
+import datetime
+import functools
+import logging
+import random
+import threading
+import time
+
+import kopf
+import requests
+from pyvcloud.vcd.exceptions import (
+    BadRequestException,
+    EntityNotFoundException,
+    InvalidStateException,
+    NotFoundException,
+    OperationNotSupportedException,
+    RequestTimeoutException,
+    VcdResponseException,
+)
+from kvcd.metrics import counter
+from kvcd.vmware.vcloud_breaker import CircuitOpenError
+from kvcd.vmware.vcloud_queue import OperationWaitTimeout
+from kvcd.vmware.vcloud_scheduler import SlotWaitTimeout
+from kvcd.main import kvcd_config, status_writer
+
+
+logger = logging.getLogger(__name__)
+
+_RETRIES = counter(
+    'kvcd_retries_total',
+    'Number of handler retries scheduled, by reason',
+    ('reason',))
+_DEFERRED = counter(
+    'kvcd_retries_deferred_total',
+    'Number of handler retries delayed to stay in the retry budget')
+
+
+class Backoff:
+    """Exponential backoff curve, with jitter.
+    """
+
+    def __init__(self, base: float = None, factor: float = 2, cap: float = 600):
+        """Define the curve
+
+        Args:
+            base (float, optional): Delay (in secs) of the first retry. Defaults to the
+                delay of the `TemporaryError`.
+            factor (float, optional): Growth of the delay at each attempt. Defaults to 2.
+            cap (float, optional): Maximum delay (in secs). Defaults to 600.
+        """
+        self.base = base
+        self.factor = factor
+        self.cap = cap
+
+    def delay(self, attempt: int, base: float = None):
+        """Delay before an attempt, between half and all of the curve value.
+
+        Args:
+            attempt (int): Number of the failed attempts so far (0 for the first retry)
+            base (float, optional): Delay of the first retry, if the curve has none. Defaults to None.
+
+        Returns:
+            float: Delay (in secs)
+        """
+        delay = min(self.cap, (self.base or base or 60) * self.factor ** min(attempt, 32))
+        return random.uniform(delay / 2, delay)
+
+
+# Backoff curve by retry reason
+RETRY_POLICIES = {
+    # Another task runs on the entity: it is usually freed within seconds
+    'busy_entity': Backoff(base=5, cap=120),
+    # The entity is not in a state allowing the change yet (not powered off...)
+    'invalid_state': Backoff(base=15, cap=300),
+    'not_supported': Backoff(base=30, cap=600),
+    # Waiting for something else to create an entity (like an owner)
+    'not_found': Backoff(base=60, cap=1800),
+    # vCloud is unreachable or failing: retry slowly until it recovers
+    'server_error': Backoff(base=30, cap=900),
+    # Shed by the circuit breaker: from its own delay
+    'circuit_open': Backoff(cap=900),
+    # No scheduler slot or no turn in the queue of the vApp in time: they free up as the running work ends
+    'no_slot': Backoff(cap=60),
+    # Other temporary errors: from their own delay
+    'default': Backoff(cap=600),
+}
+
+
+def _error_chain(error: BaseException):
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        yield error
+        error = error.__cause__ or error.__context__
+
+
+def classify_error(error: BaseException):
+    """Retry reason of an error, from itself or the vCD error it was raised from.
+
+    Args:
+        error (BaseException): Error raised by a handler
+
+    Returns:
+        str: Retry reason, a key of `RETRY_POLICIES`, or None for a permanent or unknown error
+    """
+    if isinstance(error, kopf.PermanentError):
+        return None
+    for exc in _error_chain(error):
+        if isinstance(exc, CircuitOpenError):
+            return 'circuit_open'
+        if isinstance(exc, (SlotWaitTimeout, OperationWaitTimeout)):
+            return 'no_slot'
+        if isinstance(exc, VcdResponseException):
+            if (exc.vcd_error or {}).get('minorErrorCode') == 'BUSY_ENTITY':
+                return 'busy_entity'
+            if isinstance(exc, RequestTimeoutException) or (exc.status_code or 0) >= 500:
+                return 'server_error'
+            if isinstance(exc, NotFoundException):
+                return 'not_found'
+            if isinstance(exc, BadRequestException):
+                return 'invalid_state'
+        if isinstance(exc, EntityNotFoundException):
+            return 'not_found'
+        if isinstance(exc, InvalidStateException):
+            return 'invalid_state'
+        if isinstance(exc, OperationNotSupportedException):
+            return 'not_supported'
+        if isinstance(exc, (requests.ConnectionError, requests.Timeout)):
+            return 'server_error'
+    if isinstance(error, kopf.TemporaryError):
+        return 'default'
+    return None
+
+
+class RetryBudget:
+    """Spread the retries of all the objects over time.
+    """
+
+    def __init__(self, rate: int):
+        """Define the budget
+
+        Args:
+            rate (int): Maximum number of retries scheduled in the same second: 0 for no limit
+        """
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._seconds = collections.Counter()  # epoch second -> scheduled retries
+
+    def schedule(self, delay: float):
+        """Book the first second with some budget left, from the wanted delay.
+
+        Args:
+            delay (float): Wanted delay (in secs)
+
+        Returns:
+            float: Delay (in secs), at least the wanted one
+        """
+        if not self.rate:
+            return delay
+        with self._lock:
+            now = time.time()
+            for second in [s for s in self._seconds if s < now - 1]:
+                del self._seconds[second]
+            second = int(now + delay)
+            while self._seconds[second] >= self.rate:
+                second += 1
+            self._seconds[second] += 1
+        if second > int(now + delay):
+            _DEFERRED.inc()
+            return second - now
+        return delay
+
+
+retry_budget = RetryBudget(kvcd_config.retry.budget)
+
+
+def retry_error(error: BaseException, attempt: int):
+    """Turn a handler error into a `TemporaryError` with the delay of its retry policy.
+
+    Args:
+        error (BaseException): Error raised by the handler
+        attempt (int): Number of the failed attempts so far (kopf `retry`)
+
+    Returns:
+        tuple: (retry reason, TemporaryError), or (None, None) to raise the error as is
+    """
+    reason = classify_error(error)
+    if reason is None:
+        return None, None
+    base = error.delay if isinstance(error, kopf.TemporaryError) else None
+    delay = RETRY_POLICIES[reason].delay(attempt, base=base)
+    delay = retry_budget.schedule(min(delay, kvcd_config.retry.max_delay))
+    message = str(error) if isinstance(error, kopf.TemporaryError) else f"{type(error).__name__}: {error}"
+    return reason, kopf.TemporaryError(message, delay=round(delay, 1))
+
+
+# Retry state last published by object: (plural, namespace, name) -> (handler, reason, attempt bucket)
+_published = collections.OrderedDict()
+_published_lock = threading.Lock()
+PUBLISHED_MAX_SIZE = 4096
+
+
+def _attempt_bucket(attempt: int):
+    """Bucket of an attempt number: 1, 2-3, 4-7, 8-15...
+    """
+    return attempt.bit_length()
+
+
+def _publish(plural: str, handler: str, kwargs: dict, reason: str = None, error: kopf.TemporaryError = None):
+    """Write the retry state of the object, or clear it.
+
+    The retry state is only written when its handler, its reason or the bucket of
+    its attempt number changed: not at each attempt of an object failing again and
+    again for the same reason.
+    """
+    namespace, name = kwargs.get('namespace'), kwargs.get('name')
+    if not name:
+        return
+    key = (plural, namespace, name)
+    if error is None:
+        with _published_lock:
+            published = _published.pop(key, None)
+        if published is not None or (kwargs.get('status') or {}).get('retry'):
+            status_writer.submit(plural, namespace, name, {'retry': None})
+        return
+    attempt = kwargs.get('retry', 0) + 1
+    state = (handler, reason, _attempt_bucket(attempt))
+    with _published_lock:
+        if _published.get(key) == state:
+            return
+        _published[key] = state
+        _published.move_to_end(key)
+        while len(_published) > PUBLISHED_MAX_SIZE:
+            _published.popitem(last=False)
+    next_attempt = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=error.delay)
+    status_writer.submit(plural, namespace, name, {'retry': {
+        'handler': handler,
+        'attempt': attempt,
+        'reason': reason,
+        'message': str(error)[:256],
+        'next_attempt': next_attempt.isoformat(timespec='seconds'),
+    }})
+
+
+def _handle(plural: str, handler: str, kwargs: dict, error: BaseException):
+    reason, retry = retry_error(error, kwargs.get('retry', 0))
+    if retry is None:
+        return None
+    _RETRIES.labels(reason).inc()
+    logger.debug(f"Retrying {handler} of {kwargs.get('namespace')}/{kwargs.get('name')} "
+                 f"in {retry.delay}s ({reason})")
+    _publish(plural, handler, kwargs, reason, retry)
+    return retry
+
+
+def retry_policy(plural: str):
+    """Decorate a kopf handler to retry its temporary errors with the retry policy of their class.
+
+    Args:
+        plural (str): Plural name of the custom resource, to publish the retry state
+    """
+    def decorator(func):
+        handler = func.__name__
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                try:
+                    result = await func(*args, **kwargs)
+                except Exception as e:
+                    retry = _handle(plural, handler, kwargs, e)
+                    if retry is None:
+                        raise
+                    raise retry from e
+                if kwargs.get('retry'):
+                    _publish(plural, handler, kwargs)
+                return result
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                retry = _handle(plural, handler, kwargs, e)
+                if retry is None:
+                    raise
+                raise retry from e
+            if kwargs.get('retry'):
+                _publish(plural, handler, kwargs)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,246 @@
+"""Prioritized admission of the work sent to a Cloud Director endpoint.
+
+The handlers do not all have the same urgency: a user creating or deleting a vApp
+should not wait behind thousands of background refresh ticks. Each piece of work
+waits for a slot of the scheduler in its priority class. A class cannot use more
+than its share of the slots, and a waiter that was starved for too long is
+admitted before any higher priority waiter.
+
+The sync handlers run in the executor of kopf: they only wait for a slot for
+a bounded time, then give their thread back and are retried later, so that the
+handlers waiting for a busy class never hold all the threads of the executor.
+"""
+
+import asyncio
+import collections
+import contextlib
+import logging
+import math
+import threading
+import time
+from enum import IntEnum
+
+import kopf
+from kvcd.tracing import span
+
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    """Priority classes, from the most to the least urgent.
+    """
+    LIFECYCLE = 0  # vApp creation and deletion
+    RECONCILE = 1  # spec changes
+    REFRESH = 2  # background refresh
+
+
+class SlotWaitTimeout(kopf.TemporaryError):
+    """No slot was granted in time to a handler: retry after the given delay.
+    """
+
+
+class _Waiter:
+    """A piece of work waiting for a slot.
+    """
+
+    def __init__(self, priority: Priority, wake):
+        self.priority = priority
+        self.wake = wake
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+
+
+class PriorityScheduler:
+    """Slots based scheduler with per class concurrency shares and a starvation guard.
+    """
+
+    def __init__(self, slots: int, shares: dict, starvation_timeout: float, breaker=None,
+                 handler_wait: float = 10):
+        """Define the scheduler
+
+        Args:
+            slots (int): Number of pieces of work running at the same time
+            shares (dict): Maximum fraction of the slots usable by each priority class
+            starvation_timeout (float): Waiting duration (in secs) after which a
+                waiter is admitted before the higher priority ones.
+            breaker (CircuitBreaker, optional): Circuit breaker checked before
+                queuing any work. Defaults to None.
+            handler_wait (float, optional): Maximum waiting duration (in secs) of
+                a handler thread for a slot. Defaults to 10.
+        """
+        self.breaker = breaker
+        self.handler_wait = handler_wait
+        self.slots = max(1, slots)
+        self.limits = {
+            priority: max(1, math.ceil(shares.get(priority, 1.0) * self.slots))
+            for priority in Priority
+        }
+        self.starvation_timeout = starvation_timeout
+        self._lock = threading.Lock()
+        self._running = {priority: 0 for priority in Priority}
+        self._waiters = {priority: collections.deque() for priority in Priority}
+
+    def _next_waiter(self):
+        """Select the next waiter to admit (lock must be held).
+
+        Returns:
+            _Waiter: Next waiter, or None if no waiter can be admitted.
+        """
+        candidates = [
+            queue[0] for priority, queue in self._waiters.items()
+            if queue and self._running[priority] < self.limits[priority]
+        ]
+        if not candidates:
+            return None
+        now = time.monotonic()
+        starved = [w for w in candidates if now - w.enqueued_at > self.starvation_timeout]
+        if starved:
+            return min(starved, key=lambda w: w.enqueued_at)
+        return min(candidates, key=lambda w: w.priority)
+
+    def _dispatch(self):
+        """Admit waiters while there are free slots (lock must be held).
+        """
+        while sum(self._running.values()) < self.slots:
+            waiter = self._next_waiter()
+            if waiter is None:
+                return
+            self._waiters[waiter.priority].popleft()
+            self._running[waiter.priority] += 1
+            waiter.granted = True
+            waiter.wake()
+
+    def _enqueue(self, priority: Priority, wake):
+        with self._lock:
+            waiter = _Waiter(priority, wake)
+            self._waiters[priority].append(waiter)
+            self._dispatch()
+            return waiter
+
+    def _cancel(self, waiter: _Waiter):
+        """Withdraw a waiter, releasing its slot if it was already granted.
+        """
+        with self._lock:
+            if not waiter.granted:
+                self._waiters[waiter.priority].remove(waiter)
+                return
+        self.release(waiter.priority)
+
+    def release(self, priority: Priority):
+        """Release a slot of a priority class.
+
+        Args:
+            priority (Priority): Priority class of the finished work
+        """
+        with self._lock:
+            self._running[priority] -= 1
+            self._dispatch()
+
+    @contextlib.contextmanager
+    def slot(self, priority: Priority, timeout: float = None):
+        """Hold a slot, blocking the current thread until it is granted.
+
+        Args:
+            priority (Priority): Priority class of the work
+            timeout (float, optional): Maximum waiting duration (in secs). Defaults to None (no limit).
+
+        Raises:
+            SlotWaitTimeout: No slot was granted within `timeout`
+        """
+        probe = self.breaker.admit(priority) if self.breaker else None
+        completed = False
+        try:
+            granted = threading.Event()
+            with span('scheduler.wait', **{'scheduler.priority': priority.name.lower()}):
+                waiter = self._enqueue(priority, granted.set)
+                if not granted.wait(timeout):
+                    self._cancel(waiter)
+                    raise SlotWaitTimeout(
+                        f"No {priority.name.lower()} slot free for {timeout}s", delay=max(1, int(timeout)))
+            try:
+                yield
+                completed = True
+            finally:
+                self.release(priority)
+        finally:
+            if probe is not None:
+                self.breaker.probe_done(probe, completed)
+
+    @contextlib.asynccontextmanager
+    async def async_slot(self, priority: Priority):
+        """Hold a slot, without blocking the event loop while waiting for it.
+
+        Args:
+            priority (Priority): Priority class of the work
+        """
+        probe = self.breaker.admit(priority) if self.breaker else None
+        completed = False
+        try:
+            loop = asyncio.get_running_loop()
+            granted = loop.create_future()
+
+            def _wake():
+                loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+            with span('scheduler.wait', **{'scheduler.priority': priority.name.lower()}):
+                waiter = self._enqueue(priority, _wake)
+                try:
+                    await granted
+                except asyncio.CancelledError:
+                    self._cancel(waiter)
+                    raise
+            try:
+                yield
+                completed = True
+            finally:
+                self.release(priority)
+        finally:
+            if probe is not None:
+                self.breaker.probe_done(probe, completed)
+
+    def run(self, priority: Priority, func, *args, **kwargs):
+        """Run `func(*args, **kwargs)` in a slot of the priority class.
+
+        Args:
+            priority (Priority): Priority class of the work
+            func (callable): Work to run
+
+        Returns:
+            The result of `func`.
+        """
+        with self.slot(priority):
+            return func(*args, **kwargs)
+
+    def run_handler(self, priority: Priority, func, *args, **kwargs):
+        """Run `func(*args, **kwargs)` from a handler thread, in a slot of the priority class.
+
+        The handler waits at most `handler_wait` for the slot, then is retried by kopf.
+
+        Args:
+            priority (Priority): Priority class of the work
+            func (callable): Work to run
+
+        Raises:
+            SlotWaitTimeout: No slot was granted in time
+
+        Returns:
+            The result of `func`.
+        """
+        with self.slot(priority, timeout=self.handler_wait):
+            return func(*args, **kwargs)
+
+    def stats(self):
+        """Current number of running and waiting pieces of work by priority class.
+
+        Returns:
+            dict: Counters by priority class name
+        """
+        with self._lock:
+            return {
+                priority.name.lower(): {
+                    'running': self._running[priority],
+                    'waiting': len(self._waiters[priority]),
+                }
+                for priority in Priority
+            }
@@ -0,0 +1,108 @@
+"""Warm-up of the caches of a standby replica.
+
+A standby replica does not handle the objects, but it reads them to keep the
+caches of its vCD sessions warm: the hrefs of their Org VDCs, the vApp index
+of these VDCs, the VM inventory of their vApps and the capacity of the Org VDCs. When it
+becomes the leader, it resumes the objects from these caches instead of
+reading every vApp again.
+"""
+
+import collections
+import logging
+
+from kvcd.kube_helper import list_custom_objects
+from kvcd.vmware.vcloud_helper import VcdSession, get_vdc
+from kvcd.vmware.vcloud_scheduler import Priority
+
+
+logger = logging.getLogger(__name__)
+
+
+def vdcs_by_site(vcdvapps: list, resolve_site):
+    """Group the Org VDCs of the vcdvapps by site.
+
+    Args:
+        vcdvapps (list): vcdvapps objects
+        resolve_site (callable): Resolve the site of an object from its `spec.site`
+
+    Returns:
+        dict: set of (org name, VDC name) by site
+    """
+    sites = collections.defaultdict(set)
+    for obj in vcdvapps:
+        spec = obj.get('spec', {})
+        vdc_name = spec.get('vdc') or obj.get('status', {}).get('placement', {}).get('vdc')
+        if not spec.get('org') or not vdc_name:
+            continue
+        try:
+            site = resolve_site(spec.get('site'))
+        except Exception:
+            continue  # reported by the handlers of the leader
+        sites[site].add((spec['org'], vdc_name))
+    return sites
+
+
+def vapp_hrefs_by_site(vcdvapps: list, resolve_site):
+    """Group the hrefs of the vApps of the vcdvapps by site.
+
+    Args:
+        vcdvapps (list): vcdvapps objects
+        resolve_site (callable): Resolve the site of an object from its `spec.site`
+
+    Returns:
+        dict: set of vApp hrefs by site
+    """
+    sites = collections.defaultdict(set)
+    for obj in vcdvapps:
+        href = obj.get('status', {}).get('backing', {}).get('vcd_vapp_href')
+        if not href:
+            continue
+        try:
+            site = resolve_site(obj.get('spec', {}).get('site'))
+        except Exception:
+            continue
+        sites[site].add(href)
+    return sites
+
+
+def warm_site_caches(vcd_session: VcdSession, vdcs: set):
+    """Fill the caches of a vCD session for a set of Org VDCs.
+
+    Args:
+        vcd_session (VcdSession): VCD session
+        vdcs (set): (org name, VDC name) tuples
+
+    Returns:
+        int: Number of vApps indexed
+    """
+    vapps = 0
+    for org_name, vdc_name in sorted(vdcs):
+        try:
+            with vcd_session.scheduler.slot(Priority.REFRESH):
+                vdc = get_vdc(vcd_session=vcd_session, org_name=org_name, vdc_name=vdc_name)
+                vapps += vcd_session.vapp_index.refresh(vdc.href)
+        except Exception as e:
+            logger.warning(f"Failed to warm up the caches of the VDC {org_name}/{vdc_name}: {e}")
+    with vcd_session.scheduler.slot(Priority.REFRESH):
+        vcd_session.vm_inventory.refresh(force=True)
+        vcd_session.vdc_capacity.refresh(force=True)
+    return vapps
+
+
+def warm_caches(vcd_sessions: dict, resolve_site):
+    """Fill the caches of the vCD sessions for the Org VDCs of all the vcdvapps.
+
+    Args:
+        vcd_sessions (dict): Opened `VcdSession` by site
+        resolve_site (callable): Resolve the site of an object from its `spec.site`
+    """
+    vcdvapps = list_custom_objects('vcdvapps')
+    vapp_hrefs = vapp_hrefs_by_site(vcdvapps, resolve_site)
+    sites = vdcs_by_site(vcdvapps, resolve_site)
+    for site, vdcs in sites.items():
+        vcd_session = vcd_sessions.get(site)
+        if vcd_session is None:
+            continue  # not opened yet
+        vcd_session.vm_inventory.watch(vapp_hrefs.get(site, ()))
+        vapps = warm_site_caches(vcd_session, vdcs)
+        logger.debug(f"Caches of site {site} warmed up: {len(vdcs)} VDCs, {vapps} vApps")
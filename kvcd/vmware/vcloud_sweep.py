@@ -0,0 +1,269 @@
+"""Periodic sweep of the vApps managed by kvcd on the Cloud Director side.
+
+The operator only reconciles from the vcdvapps to vCloud: a vApp whose vcdvapp
+was deleted while the operator was down stays in vCloud forever. The sweep
+lists all the vApps flagged with the `managed-by: kvcd` metadata with one
+paged query per site, and joins them with the vcdvapps in memory. With an
+instance id, only the vApps flagged with the `kvcd-instance` metadata of this
+operator deployment are listed: the vApps of other operators managing the
+same vCloud are left alone.
+
+* orphans: managed vApps without a vcdvapp. They are reported, and deleted if
+  the cleanup is enabled and they were already orphans at the previous sweep.
+  The cleanup needs an instance id: without it, the vApps of another operator
+  would be deleted as orphans.
+* drifts: vcdvapps whose vApp is not in the managed ones, has another name or
+  another power state than expected. They are reported as events.
+"""
+
+import collections
+import logging
+import threading
+
+import kopf
+from kubernetes.client.rest import ApiException
+from pyvcloud.vcd.client import QueryResultFormat
+from pyvcloud.vcd.client import ResourceType
+from kvcd.kube_helper import post_event
+from kvcd.metrics import counter, gauge
+from kvcd.vmware.vcloud_helper import VcdSession
+from kvcd.vmware.vcloud_queue import vapp_operations
+from kvcd.vmware.vcloud_scheduler import Priority
+from kvcd.vmware.vcloud_vapp import vapp_delete, managed_metadata
+from kvcd.main import get_vcd_session, resolve_site, kvcd_config, vcd_sites, wait_for_leadership
+
+
+logger = logging.getLogger(__name__)
+
+QUERY_PAGE_SIZE = 128
+
+_ORPHANS = gauge(
+    'kvcd_sweep_orphan_vapps',
+    'Number of managed vApps without a vcdvapp at the last sweep',
+    ('site',))
+_DRIFTS = gauge(
+    'kvcd_sweep_drifted_vapps',
+    'Number of vcdvapps drifting from their vApp at the last sweep',
+    ('site', 'kind'))
+_CLEANED = counter(
+    'kvcd_sweep_cleaned_vapps_total',
+    'Number of orphan vApps deleted by the sweep',
+    ('site',))
+
+
+def managed_filter():
+    """Query filter of the vApps managed by this operator deployment.
+
+    Returns:
+        str: Metadata filter
+    """
+    return ';'.join(f'metadata:{key}==STRING:{value}' for key, value in managed_metadata().items())
+
+
+def list_managed_vapps(vcd_session: VcdSession):
+    """List the vApps flagged as managed by this operator, with a metadata filtered query.
+
+    Args:
+        vcd_session (VcdSession): VCD session
+
+    Returns:
+        dict: Query records of the managed vApps, by href
+    """
+    client = vcd_session.client
+    query_type = ResourceType.ADMIN_VAPP.value if client.is_sysadmin() else ResourceType.VAPP.value
+    query = client.get_typed_query(
+        query_type,
+        query_result_format=QueryResultFormat.RECORDS,
+        page_size=QUERY_PAGE_SIZE,
+        qfilter=managed_filter())
+    return {record.get('href'): record for record in query.execute()}
+
+
+def vcdvapps_by_site(vcdvapp_index: kopf.Index):
+    """Group the indexed vcdvapps by site.
+
+    Args:
+        vcdvapp_index (kopf.Index): Index of the vcdvapps by namespace
+
+    Returns:
+        dict: list of indexed vcdvapps entries (with their namespace) by site
+    """
+    sites = collections.defaultdict(list)
+    for namespace in list(vcdvapp_index):
+        for entry in vcdvapp_index.get(namespace, []):
+            try:
+                site = resolve_site(entry.get('site'))
+            except kopf.PermanentError:
+                continue
+            sites[site].append(dict(entry, namespace=namespace))
+    return sites
+
+
+def find_drifts(entries: list, managed: dict):
+    """Compare the vcdvapps of a site with its managed vApps.
+
+    Args:
+        entries (list): Indexed vcdvapps entries of the site
+        managed (dict): Query records of the managed vApps, by href
+
+    Returns:
+        tuple: set of the orphan hrefs, list of (entry, kind, message) drifts
+    """
+    orphans = set(managed)
+    drifts = []
+    for entry in entries:
+        href = entry.get('vcd_vapp_href')
+        if not href:
+            continue
+        orphans.discard(href)
+        record = managed.get(href)
+        if record is None:
+            drifts.append((entry, 'unmanaged', f"vApp {href} is not found among the vApps managed by kvcd"))
+            continue
+        if record.get('name') != entry['name']:
+            drifts.append((entry, 'name', f"vApp is named {record.get('name')} on vCloud"))
+        powered_on = record.get('status') == 'POWERED_ON'
+        if entry.get('powered_on') is not None and powered_on != bool(entry.get('powered_on')):
+            drifts.append((entry, 'power_state', f"vApp is {record.get('status')} on vCloud"))
+    return orphans, drifts
+
+
+class VappSweeper:
+    """Background thread running the sweep of every site at a regular interval.
+    """
+
+    def __init__(self, vcdvapp_index: kopf.Index, interval: int, initial_delay: int, cleanup: bool):
+        """Define the sweeper
+
+        Args:
+            vcdvapp_index (kopf.Index): Index of the vcdvapps by namespace
+            interval (int): Interval (in secs) between two sweeps
+            initial_delay (int): Delay (in secs) before the first sweep, to let the index fill
+            cleanup (bool): Delete the orphan vApps
+        """
+        self.vcdvapp_index = vcdvapp_index
+        self.interval = interval
+        self.initial_delay = initial_delay
+        self.cleanup = cleanup
+        self._orphans = {}  # site -> orphan hrefs of the previous sweep
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the background thread.
+        """
+        self._thread = threading.Thread(target=self._run, name='kvcd-vapp-sweeper', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread.
+        """
+        self._stopping.set()
+
+    def _run(self):
+        # Only the leader sweeps, once its index is filled
+        if not wait_for_leadership(self._stopping) or self._stopping.wait(self.initial_delay):
+            return
+        while True:
+            self.sweep()
+            if self._stopping.wait(self.interval):
+                return
+
+    def sweep(self):
+        """Sweep every site.
+        """
+        entries_by_site = vcdvapps_by_site(self.vcdvapp_index)
+        for site in vcd_sites:
+            try:
+                self.sweep_site(site, entries_by_site.get(site, []))
+            except Exception as e:
+                logger.warning(f"Sweep of site {site} failed: {e}")
+
+    def sweep_site(self, site: str, entries: list):
+        """Report the orphans and drifts of a site, and clean up the orphans.
+
+        Args:
+            site (str): Name of the site
+            entries (list): Indexed vcdvapps entries of the site
+        """
+        vcd_session = get_vcd_session(site)
+        with vcd_session.scheduler.slot(Priority.REFRESH):
+            managed = list_managed_vapps(vcd_session)
+        orphans, drifts = find_drifts(entries, managed)
+        logger.info(f"Sweep of site {site}: {len(managed)} managed vApps, "
+                    f"{len(orphans)} orphans, {len(drifts)} drifts")
+
+        _ORPHANS.labels(site).set(len(orphans))
+        drift_counts = collections.Counter(kind for _, kind, _ in drifts)
+        for kind in ('unmanaged', 'name', 'power_state'):
+            _DRIFTS.labels(site, kind).set(drift_counts.get(kind, 0))
+        for entry, kind, message in drifts:
+            try:
+                post_event('VcdVapp', entry['namespace'], entry['name'], entry.get('uid'),
+                           'Warning', 'Drift', f"{kind}: {message}")
+            except ApiException as e:
+                logger.debug(f"Cannot post the drift event of {entry['namespace']}/{entry['name']}: {e}")
+
+        previous_orphans = self._orphans.get(site, set())
+        for href in orphans:
+            record = managed[href]
+            logger.warning(f"Orphan vApp {record.get('name')} ({href}) on site {site}")
+            # Only delete the orphans confirmed by two sweeps
+            if self.cleanup and href in previous_orphans:
+                self.delete_orphan(site, vcd_session, href, record.get('vdc'))
+        self._orphans[site] = orphans
+
+    def delete_orphan(self, site: str, vcd_session: VcdSession, href: str, vdc_href: str = None):
+        """Delete an orphan vApp.
+
+        Args:
+            site (str): Name of the site
+            vcd_session (VcdSession): VCD session
+            href (str): href of the orphan vApp
+            vdc_href (str, optional): href of the Org VDC of the orphan vApp. Defaults to None.
+        """
+        try:
+            vapp_operations.run(
+                href, vcd_session.scheduler.run, Priority.REFRESH,
+                vapp_delete, merge_key='delete',
+                vcd_session=vcd_session, vapp_href=href, vdc_href=vdc_href, force=True, logger=logger)
+        except (kopf.PermanentError, kopf.TemporaryError) as e:
+            logger.warning(f"Failed to delete the orphan vApp {href}: {e}")
+            return
+        _CLEANED.labels(site).inc()
+        logger.info(f"Orphan vApp {href} deleted from site {site}")
+
+
+_sweeper = None
+
+
+@kopf.on.startup()
+def start_vcdvapp_sweep(vcdvapp_index: kopf.Index, logger: kopf.Logger, **kwargs):
+    """Startup function: start the sweep of the managed vApps
+
+    Args:
+        vcdvapp_index (kopf.Index): Index of the vcdvapps by namespace
+        logger (kopf.Logger): Logger facility
+    """
+    global _sweeper
+    if not kvcd_config.sweep_interval:
+        logger.debug("The sweep of the managed vApps is disabled")
+        return
+    cleanup = kvcd_config.sweep_cleanup
+    if cleanup and not kvcd_config.instance_id:
+        logger.warning("The cleanup of the orphan vApps needs KVCD_INSTANCE_ID: orphans are only reported")
+        cleanup = False
+    _sweeper = VappSweeper(
+        vcdvapp_index,
+        interval=kvcd_config.sweep_interval,
+        initial_delay=kvcd_config.refresh_initial_delay,
+        cleanup=cleanup)
+    _sweeper.start()
+
+
+@kopf.on.cleanup()
+def stop_vcdvapp_sweep(**kwargs):
+    """Cleanup function: stop the sweep of the managed vApps
+    """
+    if _sweeper is not None:
+        _sweeper.stop()
@@ -0,0 +1,263 @@
+"""Recording and replay of the HTTP traffic to Cloud Director.
+
+A recording captures the request/response pairs exchanged with a vCloud
+instance in a JSON lines file, one exchange per line. The credentials are
+scrubbed: authentication headers and tokens, cookies and passwords in the
+bodies. Only the path and query of the URLs are kept, so that a recording can
+be replayed whatever the hostname of the replay configuration.
+
+The replay serves the recorded responses to the real handlers instead of
+sending the requests:
+
+* the requests are matched by method, path and query, and the responses of a
+  same request are served in their recorded order. Once they are all served,
+  the last one is served again (refreshes usually poll more than recorded).
+* each response is delayed by its recorded duration, divided by the replay speed
+  (0 to serve them without any delay).
+"""
+
+import base64
+import collections
+import datetime
+import json
+import logging
+import re
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from kvcd.metrics import counter
+
+
+logger = logging.getLogger(__name__)
+
+SCRUBBED = '***'
+SCRUBBED_HEADERS = {
+    'authorization',
+    'cookie',
+    'set-cookie',
+    'x-vcloud-authorization',
+    'x-vmware-vcloud-access-token',
+}
+_SCRUBBED_BODY_PATTERNS = [
+    # XML entities, like the users passwords
+    (re.compile(rb'(<(?:\w+:)?Password>)[^<]*(</(?:\w+:)?Password>)'), rb'\1***\2'),
+    # JSON attributes
+    (re.compile(rb'("(?:password|token|access_token|refresh_token)"\s*:\s*)"(?:[^"\\]|\\.)*"', re.IGNORECASE),
+     rb'\1"***"'),
+]
+
+_REPLAY_MISSES = counter(
+    'kvcd_vcd_replay_misses_total',
+    'Number of replayed requests without any recorded response')
+
+
+def scrub_headers(headers) -> dict:
+    """Copy headers, with the credentials scrubbed.
+
+    Args:
+        headers: HTTP headers
+
+    Returns:
+        dict: Scrubbed headers
+    """
+    return {k: SCRUBBED if k.lower() in SCRUBBED_HEADERS else v for k, v in headers.items()}
+
+
+def scrub_body(body: bytes) -> bytes:
+    """Remove the passwords and tokens from a request or response body.
+
+    Args:
+        body (bytes): HTTP body
+
+    Returns:
+        bytes: Scrubbed body
+    """
+    if not body:
+        return body
+    for pattern, replacement in _SCRUBBED_BODY_PATTERNS:
+        body = pattern.sub(replacement, body)
+    return body
+
+
+def _encode_body(body) -> dict:
+    if body is None:
+        return None
+    if isinstance(body, str):
+        body = body.encode()
+    body = scrub_body(body)
+    try:
+        return {'text': body.decode()}
+    except UnicodeDecodeError:
+        return {'base64': base64.b64encode(body).decode()}
+
+
+def _decode_body(body: dict) -> bytes:
+    if body is None:
+        return b''
+    if 'base64' in body:
+        return base64.b64decode(body['base64'])
+    return body['text'].encode()
+
+
+class TrafficRecorder:
+    """Append the HTTP exchanges with a vCloud instance to a JSON lines file.
+    """
+
+    def __init__(self, path: str):
+        """Define the recorder
+
+        Args:
+            path (str): Path of the recording file
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        logger.warning(f"Recording the vCD traffic to {path}")
+
+    def transport(self):
+        """New HTTP adapter recording the exchanges.
+
+        Returns:
+            RecordingTransport: HTTP adapter
+        """
+        return RecordingTransport(self)
+
+    def record(self, request: requests.PreparedRequest, response: requests.Response, started: float):
+        """Record an exchange.
+
+        Args:
+            request (requests.PreparedRequest): Sent request
+            response (requests.Response): Received response
+            started (float): Monotonic time of the request sending
+        """
+        entry = {
+            'offset': round(started - self._start, 6),
+            'method': request.method,
+            'path': request.path_url,
+            'request_headers': scrub_headers(request.headers),
+            'request_body': _encode_body(request.body),
+            'status': response.status_code,
+            'reason': response.reason,
+            'headers': scrub_headers(response.headers),
+            'body': _encode_body(response.content),
+            'elapsed': round(time.monotonic() - started, 6),
+        }
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+
+class RecordingTransport(requests.adapters.HTTPAdapter):
+    """HTTP adapter sending the requests and recording the exchanges.
+    """
+
+    def __init__(self, recorder: TrafficRecorder, *args, **kwargs):
+        self.recorder = recorder
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, *args, **kwargs):
+        started = time.monotonic()
+        response = super().send(request, *args, **kwargs)
+        try:
+            self.recorder.record(request, response, started)
+        except Exception as e:
+            logger.warning(f"Failed to record {request.method} {request.path_url}: {e}")
+        return response
+
+
+class TrafficReplay:
+    """Recorded HTTP exchanges with a vCloud instance, served in place of the real ones.
+    """
+
+    def __init__(self, path: str, speed: float = 1.0):
+        """Load a recording
+
+        Args:
+            path (str): Path of the recording file
+            speed (float, optional): Acceleration of the recorded response times: 0 to
+                serve the responses without delay. Defaults to 1.0.
+        """
+        self.path = path
+        self.speed = speed
+        self._lock = threading.Lock()
+        self._exchanges = collections.defaultdict(collections.deque)
+        self._last = {}
+        count = 0
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self._exchanges[(entry['method'], entry['path'])].append(entry)
+                    count += 1
+        logger.warning(f"Replaying {count} vCD exchanges from {path} at speed {speed}")
+
+    def transport(self):
+        """New HTTP adapter serving the recorded responses.
+
+        Returns:
+            ReplayTransport: HTTP adapter
+        """
+        return ReplayTransport(self)
+
+    def next_exchange(self, method: str, path: str):
+        """Next recorded exchange of a request.
+
+        Args:
+            method (str): HTTP method
+            path (str): Path and query of the URL
+
+        Returns:
+            dict: Recorded exchange, or None if this request was never recorded
+        """
+        key = (method, path)
+        with self._lock:
+            exchanges = self._exchanges.get(key)
+            if exchanges:
+                self._last[key] = exchanges.popleft()
+            return self._last.get(key)
+
+    def remaining(self):
+        """Number of recorded exchanges not served yet.
+
+        Returns:
+            int: Number of exchanges
+        """
+        with self._lock:
+            return sum(len(exchanges) for exchanges in self._exchanges.values())
+
+
+class ReplayTransport(requests.adapters.BaseAdapter):
+    """HTTP adapter serving the recorded responses, without any network access.
+    """
+
+    def __init__(self, replay: TrafficReplay):
+        self.replay = replay
+        super().__init__()
+
+    def send(self, request, *args, **kwargs):
+        exchange = self.replay.next_exchange(request.method, request.path_url)
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        if exchange is None:
+            _REPLAY_MISSES.inc()
+            logger.warning(f"No recorded response for {request.method} {request.path_url}")
+            response.status_code = 404
+            response.reason = 'Not Recorded'
+            response._content = b''
+            return response
+        if self.replay.speed > 0:
+            time.sleep(exchange['elapsed'] / self.replay.speed)
+        response.status_code = exchange['status']
+        response.reason = exchange.get('reason')
+        response.headers = CaseInsensitiveDict(exchange['headers'])
+        response._content = _decode_body(exchange['body'])
+        response.elapsed = datetime.timedelta(seconds=exchange['elapsed'])
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        return response
+
+    def close(self):
+        pass
@@ -0,0 +1,366 @@
+"""Kopf based resource management for the user objects
+
+There is no per-object timer for the users: a single background sync runs one
+paged `adminUser` query per organization, diffs the records with the vcdusers
+in memory and only writes the changed status entries.
+"""
+
+import logging
+import threading
+
+import kopf
+from kubernetes.client.rest import ApiException
+from pyvcloud.vcd.client import QueryResultFormat
+from pyvcloud.vcd.client import ResourceType
+from pyvcloud.vcd.exceptions import EntityNotFoundException
+from kvcd.kube_helper import read_secret_value
+from kvcd.vmware.vcloud_helper import VcdSession, get_org
+from kvcd.vmware.vcloud_scheduler import Priority
+from kvcd.vmware.vcloud_breaker import CircuitOpenError
+from kvcd.vmware.vcloud_retry import retry_policy
+from kvcd.tracing import traced
+from kvcd.main import get_vcd_session, resolve_site, kvcd_config, status_writer, wait_for_leadership
+
+
+QUERY_PAGE_SIZE = 128
+
+
+def user_record_to_backing(record):
+    """Build the backing status of a user from its query record.
+
+    Args:
+        record (ObjectifiedElement): `AdminUserRecord` from a query
+
+    Returns:
+        dict: Backing status entries
+    """
+    if record.get('isLocked') == 'true':
+        user_status = 'Locked'
+    elif record.get('isEnabled') == 'true':
+        user_status = 'Enabled'
+    else:
+        user_status = 'Disabled'
+    return {
+        'vcd_user_href': record.get('href'),
+        'status': user_status,
+        'role': record.get('roleName'),
+        'full_name': record.get('fullName') or None,
+        'email': record.get('email') or None,
+    }
+
+
+@kopf.index('kvcd.lrivallain.dev', 'v1', 'vcdusers')
+def vcduser_index(name: str, namespace: str, spec: kopf.Spec, status: kopf.Status, **kwargs):
+    """In-memory index of the vcdusers, by site and organization
+
+    Args:
+        name (str): Name of the object
+        namespace (str): Name of the namespace where object is declared
+        spec (kopf.Spec): Object specs
+        status (kopf.Status): Current status data of the object
+    """
+    return {(spec.get('site'), spec.get('org')): {
+        'name': name,
+        'namespace': namespace,
+        'username': spec.get('username') or name,
+        'backing': dict(status.get('backing', {})),
+    }}
+
+
+@kopf.on.resume('kvcd.lrivallain.dev', 'v1', 'vcdusers')
+@kopf.on.create('kvcd.lrivallain.dev', 'v1', 'vcdusers')
+@traced('vcduser.create')
+@retry_policy('vcdusers')
+def create_vcduser(spec: kopf.Spec, status: kopf.Status, name: str, namespace: str,
+                   logger: kopf.Logger, patch: kopf.Patch, **kwargs):
+    """Create a vcduser from specs
+
+    Args:
+        spec (kopf.Spec): Object specs
+        status (kopf.Status): Current status data of the object
+        name (str): Name of the object
+        namespace (str): Name of the namespace where object is declared
+        logger (kopf.Logger): Logger facility
+        patch (kopf.Patch): Patch to apply
+    """
+    if status.get('backing', {}).get('vcd_user_href'):
+        # Already created: the periodic sync keeps the status up to date
+        return
+    vcd_session = get_vcd_session(spec.get('site'))
+    return vcd_session.scheduler.run_handler(
+        Priority.LIFECYCLE, user_create, vcd_session,
+        spec=spec, name=name, namespace=namespace, logger=logger, patch=patch)
+
+
+def user_create(vcd_session: VcdSession, spec: kopf.Spec, name: str, namespace: str,
+                logger: kopf.Logger, patch: kopf.Patch):
+    """Create the user of a vcduser, or find the existing one.
+
+    Args:
+        vcd_session (VcdSession): VCD session
+        spec (kopf.Spec): Object specs
+        name (str): Name of the object
+        namespace (str): Name of the namespace where object is declared
+        logger (kopf.Logger): Logger facility
+        patch (kopf.Patch): Patch to apply
+    """
+    username = spec.get('username') or name
+    org = get_org(vcd_session=vcd_session, org_name=spec.get('org'))
+    try:
+        user_resource = org.get_user(username)
+        logger.info(f"User {username} already exists. Lets reconciliate everything.")
+        _created = False
+    except EntityNotFoundException:
+        logger.info(f"Creating a vcduser named: {username} in namespace: {namespace}")
+        try:
+            role_href = org.get_role_record(spec.get('role')).get('href')
+        except EntityNotFoundException:
+            raise kopf.PermanentError(f"No role found with name: {spec.get('role')}")
+        try:
+            password = read_secret_value(namespace,
+                                         spec['password_secret']['name'],
+                                         spec['password_secret']['key'])
+        except (ApiException, KeyError) as e:
+            raise kopf.TemporaryError(f"Cannot read the password of user {username}: {e}", delay=60)
+        user_resource = org.create_user(
+            user_name=username,
+            password=password,
+            role_href=role_href,
+            full_name=spec.get('full_name', ''),
+            email=spec.get('email', ''),
+            is_enabled=spec.get('enabled', True))
+        _created = True
+
+    patch.status['backing'] = {
+        'vcd_user_href': user_resource.get('href'),
+        'status': 'Enabled' if user_resource.IsEnabled.text == 'true' else 'Disabled',
+        'role': spec.get('role'),
+    }
+    if _created:
+        return {'message': 'User successfuly created'}
+    user_reconcile(vcd_session, spec=spec, name=name, logger=logger)
+
+
+@kopf.on.field('kvcd.lrivallain.dev', 'v1', 'vcdusers', field='spec.enabled')
+@kopf.on.field('kvcd.lrivallain.dev', 'v1', 'vcdusers', field='spec.role')
+@traced('vcduser.update')
+@retry_policy('vcdusers')
+def update_vcduser(spec: kopf.Spec, status: kopf.Status, name: str, namespace: str,
+                   logger: kopf.Logger, **kwargs):
+    """Update the state and the role of a vcduser
+
+    Args:
+        spec (kopf.Spec): Object specs
+        status (kopf.Status): Current status data of the object
+        name (str): Name of the object
+        namespace (str): Name of the namespace where object is declared
+        logger (kopf.Logger): Logger facility
+    """
+    if not status.get('backing', {}).get('vcd_user_href'):
+        return
+    logger.info(f"Updating a vcduser: {name} in namespace: {namespace}")
+    vcd_session = get_vcd_session(spec.get('site'))
+    return vcd_session.scheduler.run_handler(
+        Priority.RECONCILE, user_reconcile, vcd_session,
+        spec=spec, name=name, logger=logger)
+
+
+def user_reconcile(vcd_session: VcdSession, spec: kopf.Spec, name: str, logger: kopf.Logger):
+    """Apply the expected state and role to a user.
+
+    Args:
+        vcd_session (VcdSession): VCD session
+        spec (kopf.Spec): Object specs
+        name (str): Name of the object
+        logger (kopf.Logger): Logger facility
+    """
+    username = spec.get('username') or name
+    org = get_org(vcd_session=vcd_session, org_name=spec.get('org'))
+    try:
+        # The role is always given: pyvcloud skips the update of a disabled-only change
+        org.update_user(username, is_enabled=spec.get('enabled', True), role_name=spec.get('role'))
+    except EntityNotFoundException:
+        raise kopf.PermanentError(f"Cannot find the user {username} or the role {spec.get('role')}")
+    logger.debug(f"Successful update of user {username}")
+
+
+@kopf.on.delete('kvcd.lrivallain.dev', 'v1', 'vcdusers')
+@traced('vcduser.delete')
+@retry_policy('vcdusers')
+def delete_vcduser(spec: kopf.Spec, status: kopf.Status, name: str, namespace: str,
+                   logger: kopf.Logger, **kwargs):
+    """Delete a vcduser
+
+    Args:
+        spec (kopf.Spec): Object specs
+        status (kopf.Status): Current status data of the object
+        name (str): Name of the object
+        namespace (str): Name of the namespace where object is declared
+        logger (kopf.Logger): Logger facility
+    """
+    logger.info(f"Deleting a vcduser named: {name} in namespace: {namespace}")
+    if not status.get('backing', {}).get('vcd_user_href'):
+        return  # never created user
+    vcd_session = get_vcd_session(spec.get('site'))
+    return vcd_session.scheduler.run_handler(
+        Priority.LIFECYCLE, user_delete, vcd_session,
+        spec=spec, name=name, logger=logger)
+
+
+def user_delete(vcd_session: VcdSession, spec: kopf.Spec, name: str, logger: kopf.Logger):
+    """Disable and delete a user.
+
+    Args:
+        vcd_session (VcdSession): VCD session
+        spec (kopf.Spec): Object specs
+        name (str): Name of the object
+        logger (kopf.Logger): Logger facility
+    """
+    username = spec.get('username') or name
+    org = get_org(vcd_session=vcd_session, org_name=spec.get('org'))
+    try:
+        user_resource = org.get_user(username)
+    except EntityNotFoundException:
+        logger.info(f"User {username} is already deleted")
+        return
+    if user_resource.IsEnabled.text == 'true':
+        # The current role forces the update: pyvcloud skips a disabled-only change
+        updated = org.update_user(username, is_enabled=False, role_name=user_resource.Role.get('name'))
+        if updated.IsEnabled.text != 'false':
+            raise kopf.TemporaryError(f"User {username} is still enabled, not deleting it", delay=30)
+        logger.debug(f"User {username} disabled")
+    try:
+        org.delete_user(username)
+    except EntityNotFoundException:
+        logger.info(f"User {username} is already deleted")
+        return
+    logger.info(f"User {username} deleted")
+
+
+class VcdUserSync:
+    """Background thread syncing the status of all the vcdusers, one query per organization.
+    """
+
+    def __init__(self, vcduser_index: kopf.Index, interval: int, initial_delay: int):
+        """Define the sync
+
+        Args:
+            vcduser_index (kopf.Index): Index of the vcdusers by site and organization
+            interval (int): Interval (in secs) between two syncs
+            initial_delay (int): Delay (in secs) before the first sync
+        """
+        self.vcduser_index = vcduser_index
+        self.interval = interval
+        self.initial_delay = initial_delay
+        self.logger = logging.getLogger(__name__)
+        self._org_hrefs = {}  # (site, org name) -> org href
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the background thread.
+        """
+        self._thread = threading.Thread(target=self._run, name='kvcd-user-sync', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread.
+        """
+        self._stopping.set()
+
+    def _run(self):
+        if not wait_for_leadership(self._stopping) or self._stopping.wait(self.initial_delay):
+            return
+        while True:
+            self.sync()
+            if self._stopping.wait(self.interval):
+                return
+
+    def sync(self):
+        """Sync the vcdusers of every organization.
+        """
+        for (site, org_name) in list(self.vcduser_index):
+            entries = list(self.vcduser_index.get((site, org_name), []))
+            try:
+                self.sync_org(resolve_site(site), org_name, entries)
+            except CircuitOpenError as e:
+                self.logger.debug(f"Skipping the sync of org {org_name}: {e}")
+            except Exception as e:
+                self.logger.warning(f"Sync of the users of org {org_name} failed: {e}")
+
+    def list_org_users(self, vcd_session: VcdSession, site: str, org_name: str):
+        """List the users of an organization with a single paged query.
+
+        Args:
+            vcd_session (VcdSession): VCD session
+            site (str): Name of the site
+            org_name (str): Name of the organization
+
+        Returns:
+            dict: `AdminUserRecord` by username
+        """
+        org_href = self._org_hrefs.get((site, org_name))
+        if org_href is None:
+            org_href = get_org(vcd_session=vcd_session, org_name=org_name).href
+            self._org_hrefs[(site, org_name)] = org_href
+        query = vcd_session.client.get_typed_query(
+            ResourceType.ADMIN_USER.value,
+            query_result_format=QueryResultFormat.RECORDS,
+            page_size=QUERY_PAGE_SIZE,
+            qfilter=f'org=={org_href}')
+        return {record.get('name'): record for record in query.execute()}
+
+    def sync_org(self, site: str, org_name: str, entries: list):
+        """Diff the users of an organization with their vcdusers, and write the changes.
+
+        Args:
+            site (str): Name of the site
+            org_name (str): Name of the organization
+            entries (list): Indexed vcdusers entries of the organization
+        """
+        vcd_session = get_vcd_session(site)
+        with vcd_session.scheduler.slot(Priority.REFRESH):
+            records = self.list_org_users(vcd_session, site, org_name)
+        changed = 0
+        for entry in entries:
+            current = entry['backing']
+            if not current.get('vcd_user_href'):
+                continue  # not created yet
+            record = records.get(entry['username'])
+            if record is None:
+                backing = {'vcd_user_href': None, 'status': 'Missing'}
+            else:
+                backing = user_record_to_backing(record)
+            update = {k: v for k, v in backing.items() if current.get(k) != v}
+            if update:
+                changed += 1
+                status_writer.submit('vcdusers', entry['namespace'], entry['name'],
+                                     {'backing': update}, urgent='status' in update)
+        self.logger.debug(f"Sync of org {org_name}: {len(records)} users, {changed} vcdusers changed")
+
+
+_user_sync = None
+
+
+@kopf.on.startup()
+def start_vcduser_sync(vcduser_index: kopf.Index, logger: kopf.Logger, **kwargs):
+    """Startup function: start the sync of the vcdusers
+
+    Args:
+        vcduser_index (kopf.Index): Index of the vcdusers by site and organization
+        logger (kopf.Logger): Logger facility
+    """
+    global _user_sync
+    _user_sync = VcdUserSync(
+        vcduser_index,
+        interval=kvcd_config.refresh_interval,
+        initial_delay=kvcd_config.refresh_initial_delay)
+    _user_sync.start()
+
+
+@kopf.on.cleanup()
+def stop_vcduser_sync(**kwargs):
+    """Cleanup function: stop the sync of the vcdusers
+    """
+    if _user_sync is not None:
+        _user_sync.stop()
@@ -2,8 +2,16 @@
 """
 
 import kopf
-from kubernetes.client.api import core_v1_api
-from kubernetes.client.rest import ApiException
+import time
+import logging
+import asyncio
+import contextvars
+import functools
+import hashlib
+import math
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pyvcloud.vcd.vapp import VApp
 from pyvcloud.vcd.vdc import VDC
 from pyvcloud.vcd.vdc import Org
@@ -15,15 +23,69 @@ from pyvcloud.vcd.exceptions import EntityNotFoundException
 from pyvcloud.vcd.exceptions import BadRequestException
 from pyvcloud.vcd.exceptions import OperationNotSupportedException
 from pyvcloud.vcd.utils import metadata_to_dict
+from lxml.objectify import ObjectifiedElement
 from datetime import datetime, timezone
 import dateutil.parser
 from kvcd.utils import str2bool, lowercase_first_string_letter
-from kvcd.vmware.vcloud_helper import VcdSession, get_org, get_vdc
-from kvcd.main import get_vcd_session, kvcd_config
+from kvcd.vmware.vcloud_helper import VcdSession, get_org, get_vdc, wait_for_task
+from kvcd.vmware.vcloud_inventory import VAPP_RECORD_STATUSES
+from kvcd.vmware.vcloud_queue import vapp_operations
+from kvcd.vmware.vcloud_scheduler import Priority
+from kvcd.vmware.vcloud_breaker import CircuitOpenError
+from kvcd.vmware.vcloud_pool import vapp_pools, claim_pool_vapp
+from kvcd.vmware.vcloud_retry import retry_policy
+from kvcd.tracing import traced
+from kvcd.metrics import counter
+from kvcd.main import get_vcd_session, kvcd_config, status_writer, vcd_sessions, vcd_sites, wait_for_leadership
+
+logger = logging.getLogger(__name__)
+
+_PLACEMENTS = counter(
+    'kvcd_placement_total',
+    'Number of vcdvapps placed in an Org VDC (placed), or waiting for capacity (no_capacity)',
+    ('result',))
+
+
+def managed_metadata():
+    """Metadata flagging the vApps managed by this operator deployment.
+
+    Returns:
+        dict: `managed-by`, and `kvcd-instance` if an instance id is configured
+    """
+    metadata = {'managed-by': 'kvcd'}
+    if kvcd_config.instance_id:
+        metadata['kvcd-instance'] = kvcd_config.instance_id
+    return metadata
+
+
+@kopf.index('kvcd.lrivallain.dev', 'v1', 'vcdvapps')
+def vcdvapp_index(name: str, namespace: str, uid: str, labels: kopf.Labels, spec: kopf.Spec,
+                  status: kopf.Status, **kwargs):
+    """In-memory index of the vcdvapps, by namespace
+
+    Args:
+        name (str): Name of the object
+        uid (str): UID of the object
+        namespace (str): Name of the namespace where object is declared
+        labels (kopf.Labels): Object labels
+        spec (kopf.Spec): Object specs
+        status (kopf.Status): Current status data of the object
+    """
+    return {namespace: {
+        'name': name,
+        'uid': uid,
+        'labels': dict(labels),
+        'site': spec.get('site'),
+        'powered_on': spec.get('powered_on'),
+        'vcd_vapp_href': status.get('backing', {}).get('vcd_vapp_href'),
+        'vcd_vdc_href': status.get('backing', {}).get('vcd_vdc_href'),
+    }}
 
 
 @kopf.on.resume('kvcd.lrivallain.dev', 'v1', 'vcdvapps')
 @kopf.on.create('kvcd.lrivallain.dev', 'v1', 'vcdvapps')
+@traced('vcdvapp.create')
+@retry_policy('vcdvapps')
 def create_vcdvapp(spec: kopf.Spec, status: kopf.Status, name: str,
     namespace: str, logger: kopf.Logger, patch: kopf.Patch,
     annotations: kopf._cogs.structs.dicts.MappingView,
@@ -37,34 +99,57 @@ def create_vcdvapp(spec: kopf.Spec, status: kopf.Status, name: str,
         namespace (str): Name of the namespace where object is declared
         logger (kopf.Logger): Logger facility
         patch (kopf.Patch): Patch to apply
+        annotations (kopf._cogs.structs.dicts.MappingView): Object annotations
+    """
+    vcd_session = get_vcd_session(spec.get('site'))
+    return vcd_session.scheduler.run_handler(
+        Priority.LIFECYCLE, vapp_create, vcd_session,
+        spec=spec, status=status, name=name, namespace=namespace,
+        logger=logger, patch=patch, annotations=annotations)
+
+
+def vapp_create(vcd_session: VcdSession, spec: kopf.Spec, status: kopf.Status, name: str,
+                namespace: str, logger: kopf.Logger, patch: kopf.Patch,
+                annotations: kopf._cogs.structs.dicts.MappingView = None):
+    """Create the vApp of a vcdvapp, or find the existing one.
+
+    Args:
+        vcd_session (VcdSession): VCD session
+        spec (kopf.Spec): Object specs
+        status (kopf.Status): Current status data of the object
+        name (str): Name of the object
+        namespace (str): Name of the namespace where object is declared
+        logger (kopf.Logger): Logger facility
+        patch (kopf.Patch): Patch to apply
+        annotations (kopf._cogs.structs.dicts.MappingView, optional): Object annotations
     """
     _created = False
     vdc = get_vdc(
-        vcd_session=get_vcd_session(),
+        vcd_session=vcd_session,
         org_name=spec.get('org'),
-        vdc_name=spec.get('vdc'))
+        vdc_name=place_vapp(vcd_session, spec=spec, status=status, name=name, logger=logger, patch=patch))
     if ((status.get('backing', {}).get('vcd_vapp_href') is None) and
         (status.get('backing', {}).get('status') != 'Missing')):
         logger.info(f"Creating a vcdvapp named: {name} in namespace: {namespace}")
 
-        create_or_instantiate_new_vapp(spec=spec, status=status, name=name, vdc=vdc, logger=logger)
+        vapp_href = create_or_instantiate_new_vapp(vcd_session, spec=spec, status=status, name=name, vdc=vdc,
+                                                   logger=logger, annotations=annotations)
 
         try:
             # Get the new vApp resource
-            vapp_resource = vdc.get_vapp(name)
-            vapp = VApp(get_vcd_session().client,
-                        resource=vapp_resource)
+            vapp = VApp(vcd_session.client,
+                        href=vapp_href)
+            vapp_resource = vapp.get_resource()
         except EntityNotFoundException:
             raise kopf.PermanentError(f"Cannot find the newly created vApp {name}")
+        vcd_session.vapp_index.add(vdc.href, name, vapp_href, **vapp_resource_state(vapp_resource))
         _created = True
     else:
         logger.info(f"vApp {name} in namespace: {namespace} alreday exists. Lets reconciliate everything.")
-        # The vApp already exists
-        try:
-            vapp = VApp(get_vcd_session().client,
-                        href=status.get('backing').get('vcd_vapp_href'))
-            vapp_resource = vapp.get_resource()
-        except EntityNotFoundException:
+        # The vApp already exists: check it in the vApp index, no need to read it
+        vapp_href = status.get('backing').get('vcd_vapp_href')
+        if vapp_href is None or vcd_session.vapp_index.get_by_href(vdc.href, vapp_href,
+                                                                   refresh_missing=True) is None:
             raise kopf.PermanentError(f"Cannot find the previously created vApp {name}")
 
     if _created:
@@ -75,72 +160,244 @@ def create_vcdvapp(spec: kopf.Spec, status: kopf.Status, name: str,
             'owner': vapp_resource.Owner.User.get('name'),
             'uuid': vapp_resource.get('id')
         }
-        patch.metadata.annotations['managed-by'] = 'kvcd'
+        patch.metadata.annotations.update(managed_metadata())
         return { 'message': 'vApp successfuly created' }
     else:
         logger.debug(f"Found an existing vapp with the same name: {name}")
 
 
-def create_or_instantiate_new_vapp(spec: kopf.Spec, status: kopf.Status, name: str, vdc: VDC, logger: kopf.Logger):
+def place_vapp(vcd_session: VcdSession, spec: kopf.Spec, status: kopf.Status, name: str,
+               logger: kopf.Logger, patch: kopf.Patch):
+    """Get the Org VDC of a vcdvapp: the `vdc` of its specs, or one picked from its `placement`.
+
+    The Org VDC is picked in memory, from the capacity and usage snapshot of the
+    Org VDCs, and kept in `status.placement` for the next runs of the handler.
+    The snapshot is only read here: it is taken by the `CapacityRefresher`.
+
+    Args:
+        vcd_session (VCDSession): VCD session
+        spec (kopf.Spec): Object specs
+        status (kopf.Status): Current status data of the object
+        name (str): Name of the object
+        logger (kopf.Logger): Logger facility
+        patch (kopf.Patch): Patch to apply
+
+    Raises:
+        kopf.PermanentError: Neither a `vdc` nor a `placement` in the specs
+        kopf.TemporaryError: No candidate Org VDC with enough free capacity
+
+    Returns:
+        str: Name of the Org VDC
+    """
+    if spec.get('vdc'):
+        return spec.get('vdc')
+    placement = spec.get('placement')
+    if not placement:
+        raise kopf.PermanentError(f"A vdc or a placement must be set for the vApp {name}")
+    placed = status.get('placement', {}).get('vdc')
+    if placed:
+        return placed
+    vdc_name = vcd_session.vdc_capacity.place(
+        spec.get('org'),
+        candidates=placement.get('vdcs'),
+        pattern=placement.get('vdc_pattern'),
+        min_free=kvcd_config.placement_min_free)
+    if vdc_name is None:
+        if not vcd_session.vdc_capacity.is_taken():
+            raise kopf.TemporaryError(f"The Org VDCs capacity is not read yet, to place the vApp {name}",
+                                      delay=CapacityRefresher.FIRST_SNAPSHOT_RETRY)
+        _PLACEMENTS.labels('no_capacity').inc()
+        # Wait for the next snapshot instead of starting a creation doomed to fail
+        raise kopf.TemporaryError(f"No Org VDC with enough free capacity for the vApp {name}",
+                                  delay=kvcd_config.refresh_interval)
+    _PLACEMENTS.labels('placed').inc()
+    patch.status['placement'] = {'vdc': vdc_name}
+    logger.info(f"vApp {name} placed in the Org VDC {vdc_name}")
+    return vdc_name
+
+
+class CapacityRefresher:
+    """Periodic snapshot of the capacity of the Org VDCs, for every site.
+
+    The placement of the new vApps only reads the snapshot, and never waits for
+    the `orgVdc` query. Until the first snapshot of a site is taken, it is
+    retried every `FIRST_SNAPSHOT_RETRY` seconds.
+    """
+
+    FIRST_SNAPSHOT_RETRY = 5
+
+    def __init__(self, interval: int):
+        """Define the refresher
+
+        Args:
+            interval (int): Interval (in secs) between two snapshots
+        """
+        self.interval = interval
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the background thread.
+        """
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='kvcd-capacity-refresh', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread.
+        """
+        self._stopping.set()
+
+    def _run(self):
+        if not wait_for_leadership(self._stopping):
+            return
+        while not self._stopping.is_set():
+            for site, vcd_session in list(vcd_sessions.items()):
+                try:
+                    with vcd_session.scheduler.slot(Priority.REFRESH):
+                        vcd_session.vdc_capacity.refresh(force=True)
+                except Exception as e:
+                    logger.warning(f"Failed to refresh the Org VDCs capacity of site {site}: {e}")
+            taken = vcd_sessions and all(vcd_session.vdc_capacity.is_taken()
+                                         for vcd_session in list(vcd_sessions.values()))
+            self._stopping.wait(self.interval if taken else self.FIRST_SNAPSHOT_RETRY)
+
+
+capacity_refresher = CapacityRefresher(interval=kvcd_config.refresh_interval)
+
+
+@kopf.on.startup()
+def start_capacity_refresh(**kwargs):
+    """Startup function: start the periodic snapshot of the Org VDCs capacity
+    """
+    capacity_refresher.start()
+
+
+@kopf.on.cleanup()
+def stop_capacity_refresh(**kwargs):
+    """Cleanup function: stop the periodic snapshot of the Org VDCs capacity
+    """
+    capacity_refresher.stop()
+
+
+def create_or_instantiate_new_vapp(vcd_session: VcdSession, spec: kopf.Spec, status: kopf.Status, name: str,
+                                   vdc: VDC, logger: kopf.Logger,
+                                   annotations: kopf._cogs.structs.dicts.MappingView = None):
     """Create a vcdvapp from specs:
-        if catalog and template_name are provided: clone the vApp from the catalog
+        if catalog and template_name are provided: claim a vApp from a matching warm pool,
+            or clone the vApp from the catalog
         else: create the vApp from scratch.
 
     Args:
+        vcd_session (VcdSession): VCD session
         spec (kopf.Spec): Object
         status (kopf.Status): Current status data of the object
         name (str): Name of the object
         vdc (VDC): VDC where the vApp will be created
         logger (kopf.Logger): Logger facility
+        annotations (kopf._cogs.structs.dicts.MappingView, optional): Object annotations
+
+    Returns:
+        str: href of the new vApp, or of the existing one with the same name
     """
-    try:
-        # look for a VM with the same name: if so, just retrun
-        vapp_resource = vdc.get_vapp(name)
-        return
-    except EntityNotFoundException:
-        if not spec.get('source_catalog') and not spec.get('source_template_name'):
-            logger.debug("Creating a new vApp from scratch")
-
-            # create the vApp
-            create_result = vdc.create_vapp(name,
-                description=spec.get('description'),
-                network=None,
-                fence_mode=spec.get('fence_mode', 'bridged'),
-                accept_all_eulas=spec.get('accept_all_eulas', True)
-            )
-
-            # Monitor the task
-            logger.debug(f"Wait for task to complete...")
-            task = vcd_session.client.get_task_monitor().wait_for_status(task=create_result.Tasks.Task[0])
-            if task.get('status') != TaskStatus.SUCCESS.value:
-                raise kopf.PermanentError(f"Failed to create vApp: {task.get('status')}")
-        else:
-            if not spec.get('source_catalog'):
-                raise kopf.PermanentError(f"Missing catalog information to create the vApp {name}")
-            if not spec.get('source_template_name'):
-                raise kopf.PermanentError(f"Missing template_name information to create the vApp {name}")
-            logger.debug(
-                f"Instantiating a vApp from a catalog item: {spec.get('source_catalog')} on {spec.get('source_template_name')}"
-            )
-
-            # create the vApp
-            create_result = vdc.instantiate_vapp(
-                name=name,
-                catalog=spec.get('source_catalog'),
-                template=spec.get('source_template_name'),
-                description=spec.get('description'),
-                deploy=True,
-                power_on=spec.get('powered_on'),
-                accept_all_eulas=spec.get('accept_all_eulas'))
+    # look for a vApp with the same name: if so, just return it
+    existing = vcd_session.vapp_index.get(vdc.href, name, refresh_missing=True)
+    if existing is not None:
+        return existing['href']
+    pool = vapp_pools.find(spec, vdc_name=vdc.name)
+    if pool is not None:
+        vapp_href = claim_pool_vapp(vcd_session, pool, vdc, name, spec.get('description'), logger)
+        if vapp_href is not None:
+            vapp_apply_claimed_spec(vcd_session, vapp_href, spec, annotations or {}, logger)
+            return vapp_href
+    if not spec.get('source_catalog') and not spec.get('source_template_name'):
+        logger.debug("Creating a new vApp from scratch")
+
+        # create the vApp
+        create_result = vdc.create_vapp(
+            name,
+            description=spec.get('description'),
+            network=None,
+            fence_mode=spec.get('fence_mode', 'bridged'),
+            accept_all_eulas=spec.get('accept_all_eulas', True)
+        )
 
         # Monitor the task
         logger.debug(f"Wait for task to complete...")
-        task = vcd_session.client.get_task_monitor().wait_for_status(task=create_result.Tasks.Task[0])
+        task = wait_for_task(vcd_session, create_result.Tasks.Task[0])
         if task.get('status') != TaskStatus.SUCCESS.value:
             raise kopf.PermanentError(f"Failed to create vApp: {task.get('status')}")
+    else:
+        if not spec.get('source_catalog'):
+            raise kopf.PermanentError(f"Missing catalog information to create the vApp {name}")
+        if not spec.get('source_template_name'):
+            raise kopf.PermanentError(f"Missing template_name information to create the vApp {name}")
+        logger.debug(
+            f"Instantiating a vApp from a catalog item: {spec.get('source_catalog')} "
+            f"on {spec.get('source_template_name')}"
+        )
+
+        # create the vApp
+        create_result = vdc.instantiate_vapp(
+            name=name,
+            catalog=spec.get('source_catalog'),
+            template=spec.get('source_template_name'),
+            description=spec.get('description'),
+            deploy=True,
+            power_on=spec.get('powered_on'),
+            accept_all_eulas=spec.get('accept_all_eulas'))
+
+    # Monitor the task
+    logger.debug("Wait for task to complete...")
+    task = wait_for_task(vcd_session, create_result.Tasks.Task[0])
+    if task.get('status') != TaskStatus.SUCCESS.value:
+        raise kopf.PermanentError(f"Failed to create vApp: {task.get('status')}")
+    return create_result.get('href')
+
+
+def vapp_apply_claimed_spec(vcd_session: VcdSession, vapp_href: str, spec: kopf.Spec,
+                            annotations: kopf._cogs.structs.dicts.MappingView, logger: kopf.Logger):
+    """Apply the owner, leases and metadata of a vcdvapp to a vApp claimed from a warm pool.
+
+    The power state is reconciled afterwards, like for an instantiated vApp.
+
+    Args:
+        vcd_session (VcdSession): VCD session
+        vapp_href (str): Href of the claimed vApp
+        spec (kopf.Spec): Object specs
+        annotations (kopf._cogs.structs.dicts.MappingView): Object annotations
+        logger (kopf.Logger): Logger facility
+    """
+    vapp_reconcile_owner(
+        vcd_session, vapp_href,
+        current_owner=None,
+        expected_owner=spec.get('owner'),
+        org_name=spec.get('org'),
+        logger=logger)
+    lease_info = VApp(vcd_session.client, href=vapp_href).get_lease()
+    vapp_reconcile_lease_info(
+        vcd_session, vapp_href,
+        current_deploymentLeaseInSeconds=int(lease_info.get('DeploymentLeaseInSeconds')),
+        current_storageLeaseInSeconds=int(lease_info.get('StorageLeaseInSeconds')),
+        expected_deploymentLeaseInSeconds=spec.get('deploymentLeaseInSeconds'),
+        expected_storageLeaseInSeconds=spec.get('storageLeaseInSeconds'),
+        logger=logger)
+    vapp_reconcile_metadata(
+        vcd_session, vapp_href,
+        current_metadata={},
+        expected_metadata=dict(annotations, **managed_metadata()),
+        logger=logger)
+
+
+# Bound the number of vApp deletions running at the same time: a deletion out of
+# the window is retried later, without holding a worker thread meanwhile
+_delete_window = threading.BoundedSemaphore(kvcd_config.delete_concurrency)
+DELETE_WINDOW_RETRY_DELAY = 10
 
 
 @kopf.on.delete('kvcd.lrivallain.dev', 'v1', 'vcdvapps')
+@traced('vcdvapp.delete')
+@retry_policy('vcdvapps')
 def delete_vcdvapp(spec: kopf.Spec, status: kopf.Status, name: str,
     namespace: str, logger: kopf.Logger, patch: kopf.Patch,
     **kwargs):
@@ -156,39 +413,86 @@ def delete_vcdvapp(spec: kopf.Spec, status: kopf.Status, name: str,
     """
     logger.info(f"Deleting a vcdvapp named: {name} in namespace: {namespace}")
 
-    if not status.get('backing') or not status.get('backing', {}).get('vcd_vapp_href'):
+    vapp_href = status.get('backing', {}).get('vcd_vapp_href')
+    if not vapp_href:
         logger.info(f"Skipping deletion: no vApp href found.")
         return # never created vApp
+    vcd_session = get_vcd_session(spec.get('site'))
+    if not _delete_window.acquire(blocking=False):
+        raise kopf.TemporaryError(
+            f"Already {kvcd_config.delete_concurrency} vApp deletions running",
+            delay=random.uniform(DELETE_WINDOW_RETRY_DELAY / 2, DELETE_WINDOW_RETRY_DELAY * 3 / 2))
     try:
-        if not status.get('backing', {}).get('vcd_vapp_href'):
-            raise EntityNotFoundException()
-        vapp = VApp(get_vcd_session().client,
-                    href=status.get('backing').get('vcd_vapp_href'))
-    except EntityNotFoundException:
-        logger.info(f"Skipping deletion: no vApp found with href: {status.get('backing').get('vcd_vapp_href')}")
-        return  # already deleted vApp?
-    if vapp:
-        # delete the vApp
-        vdc = get_vdc(vcd_session=get_vcd_session(),
-                      org_name=spec.get('org'),
-                      vdc_name=spec.get('vdc'))
-        logger.info(f"Deleting vApp: {name}")
-        action_result = vdc.delete_vapp(name, force=spec.get('force_delete', False))
-        logger.debug(f"Wait for task to complete...")
+        return vapp_operations.run(
+            vapp_href, vcd_session.scheduler.run_handler, Priority.LIFECYCLE,
+            vapp_delete, merge_key='delete',
+            wait_timeout=vcd_session.scheduler.handler_wait,
+            vcd_session=vcd_session,
+            vapp_href=vapp_href,
+            vdc_href=status.get('backing', {}).get('vcd_vdc_href'),
+            force=spec.get('force_delete', False),
+            logger=logger)
+    finally:
+        _delete_window.release()
+
+
+def vapp_delete(vcd_session: VcdSession, vapp_href: str, force: bool, logger: kopf.Logger,
+                vdc_href: str = None):
+    """Power off (if needed) and delete a vApp, from its href only.
+
+    With the href of its VDC, the existence and the deployment of the vApp are
+    checked in the vApp index: only a deployed vApp is downloaded, to undeploy it.
+
+    Args:
+        vcd_session (VcdSession): VCD session
+        vapp_href (str): Href of the vApp to delete
+        force (bool): Force the undeploy and the deletion
+        logger (kopf.Logger): Logger facility
+        vdc_href (str, optional): Href of the Org VDC of the vApp. Defaults to None.
+    """
+    client = vcd_session.client
+    entry = None
+    if vdc_href:
+        entry = vcd_session.vapp_index.get_by_href(vdc_href, vapp_href, refresh_missing=True)
+        if entry is None:
+            logger.info(f"Skipping deletion: no vApp found with href: {vapp_href}")
+            return  # already deleted vApp
+    vapp = VApp(client, href=vapp_href)
+    if entry is None or entry['deployed']:
         try:
-            task = get_vcd_session().client.get_task_monitor().wait_for_status(task=action_result)
+            vapp.reload()
+        except EntityNotFoundException:
+            logger.info(f"Skipping deletion: no vApp found with href: {vapp_href}")
+            return  # already deleted vApp?
+    else:
+        vapp.name = entry['name']
+    try:
+        if vapp.resource is not None and vapp.resource.get('deployed') == 'true':
+            logger.info(f"Undeploying vApp: {vapp.name}")
+            action_result = vapp.undeploy(action='force' if force else 'powerOff')
+            task = wait_for_task(vcd_session, action_result)
             if task.get('status') != TaskStatus.SUCCESS.value:
-                raise kopf.PermanentError(f"Failed to delete vApp: {task.get('status')}")
-        except BadRequestException:
-            raise kopf.TemporaryError(f"The vApp cannot be deleted. Ensure it is power_off to help the process.")
-        except Exception as e:
-            raise e
-        logger.info(f"vApp {name} deleted")
-        return {'message': 'vApp successfuly deleted'}
+                raise kopf.PermanentError(f"Failed to undeploy vApp: {task.get('status')}")
+        logger.info(f"Deleting vApp: {vapp.name}")
+        action_result = client.delete_resource(vapp_href, force=force)
+        logger.debug("Wait for task to complete...")
+        task = wait_for_task(vcd_session, action_result)
+        if task.get('status') != TaskStatus.SUCCESS.value:
+            raise kopf.PermanentError(f"Failed to delete vApp: {task.get('status')}")
+    except BadRequestException as e:
+        # Maybe deployed since it was indexed: download it at the next try
+        vcd_session.vapp_index.update(vapp_href, deployed=True)
+        raise kopf.TemporaryError(f"The vApp {vapp.name} cannot be deleted yet.") from e
+    vcd_session.vapp_index.remove(vapp_href)
+    _backing_signals.pop(vapp_href, None)
+    logger.info(f"vApp {vapp.name} deleted")
+    return {'message': 'vApp successfuly deleted'}
 
 
 @kopf.on.field('kvcd.lrivallain.dev', 'v1', 'vcdvapps', field='spec.description')
-def update_vcdvapp_description(old: dict, new: dict, status: kopf.Status,
+@traced('vcdvapp.update_description')
+@retry_policy('vcdvapps')
+def update_vcdvapp_description(old: dict, new: dict, status: kopf.Status, spec: kopf.Spec,
                                name: str, namespace: str, logger: kopf.Logger, **kwargs):
     """Update a vcdvapp description
 
@@ -196,43 +500,110 @@ def update_vcdvapp_description(old: dict, new: dict, status: kopf.Status,
         old (dict): Old object specs
         new (dict): New object specs
         status (kopf.Status): Current status data of the object
+        spec (kopf.Spec): Object specs
         name (str): Name of the object
         namespace (str): Name of the namespace where object is declared
         logger (kopf.Logger): Logger facility
     """
     logger.info(f"Updating a vcdvapp description for: {name} in namespace: {namespace}")
     if not status.get('backing', {}).get('vcd_vapp_href'): return
-    return vapp_edit_name_and_description(
-        vapp_href=status.get('backing', {}).get('vcd_vapp_href'),
+    vapp_href = status.get('backing', {}).get('vcd_vapp_href')
+    vcd_session = get_vcd_session(spec.get('site'))
+    return vapp_operations.run(
+        vapp_href, vcd_session.scheduler.run_handler, Priority.RECONCILE,
+        vapp_edit_name_and_description, merge_key='description',
+        wait_timeout=vcd_session.scheduler.handler_wait,
+        vcd_session=vcd_session,
+        vapp_href=vapp_href,
         name=name, description=new,
         logger=logger
     )
 
 
-def vapp_edit_name_and_description(vapp_href: str, name: str, description: str, logger: kopf.Logger):
+def vapp_edit_name_and_description(vcd_session: VcdSession, vapp_href: str, name: str, description: str,
+                                   logger: kopf.Logger):
     """Edit the name and/or the description of a vApp
 
     Args:
+        vcd_session (VcdSession): VCD session
         vapp_href (str): Href of the vApp to edit
         name (str): New name
         description (str): New description
         logger (kopf.Logger): Logger facility
     """
     try:
-        vapp = VApp(get_vcd_session().client, href=vapp_href)
+        vapp = VApp(vcd_session.client, href=vapp_href)
     except EntityNotFoundException:
         raise kopf.PermanentError(f"Cannot find the vApp with href: {vapp_href}")
     action_result = vapp.edit_name_and_description(name=name, description=description)
-    task = get_vcd_session().client.get_task_monitor().wait_for_status(
-        task=action_result)
+    task = wait_for_task(vcd_session, action_result)
     if task.get('status') != TaskStatus.SUCCESS.value:
         raise kopf.PermanentError(f"Failed to update vApp: {task.get('status')}")
     logger.info(f"vApp {name} updated")
     return {'message': 'vApp successfuly updated'}
 
 
+class BulkPowerOwners:
+    """Reference counted ownership of the vApps driven by the bulk power operations.
+
+    An href stays owned while any of the overlapping bulk operations selecting
+    it has not processed it yet.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._owners = {}
+
+    def acquire(self, vapp_href: str):
+        """Take a reference on a vApp.
+
+        Args:
+            vapp_href (str): Href of the vApp
+        """
+        with self._lock:
+            self._owners[vapp_href] = self._owners.get(vapp_href, 0) + 1
+
+    def release(self, vapp_href: str):
+        """Drop a reference on a vApp.
+
+        Args:
+            vapp_href (str): Href of the vApp
+        """
+        with self._lock:
+            count = self._owners.get(vapp_href, 0) - 1
+            if count > 0:
+                self._owners[vapp_href] = count
+            else:
+                self._owners.pop(vapp_href, None)
+
+    def __contains__(self, vapp_href: str):
+        with self._lock:
+            return vapp_href in self._owners
+
+
+# vApps whose power state is driven by a bulk power operation
+bulk_power_hrefs = BulkPowerOwners()
+
+
+def power_state_reached(status: str, expected_power_state: bool):
+    """Whether a vApp status already matches the expected power state.
+
+    Args:
+        status (str): Status of the vApp, as mapped by `VCLOUD_STATUS_MAP`
+        expected_power_state (bool): Expected power state of the vApp
+
+    Returns:
+        bool: True if no power operation is needed
+    """
+    if expected_power_state:
+        return status == 'Powered on'
+    return status in ('Powered off', 'Deployed')
+
+
 @kopf.on.field('kvcd.lrivallain.dev', 'v1', 'vcdvapps', field='spec.powered_on')
 @kopf.on.field('kvcd.lrivallain.dev', 'v1', 'vcdvapps', field='status.backing.status')
+@traced('vcdvapp.update_power_state')
+@retry_policy('vcdvapps')
 def update_vcdvapp_power_state(old: dict, new: dict, status: kopf.Status, spec: kopf.Spec,
                                name: str, namespace: str, logger: kopf.Logger, **kwargs):
     """Update a vcdvapp power state
@@ -248,28 +619,44 @@ def update_vcdvapp_power_state(old: dict, new: dict, status: kopf.Status, spec:
     """
     logger.info(f"Updating a vcdvapp power state for: {name} in namespace: {namespace}")
     if not status.get('backing', {}).get('vcd_vapp_href'): return
-    return vapp_reconcile_power_state(
-        vapp_href=status.get('backing', {}).get('vcd_vapp_href'),
-        current_status=status.get('backing').get('status'),
+    vapp_href = status.get('backing', {}).get('vcd_vapp_href')
+    if vapp_href in bulk_power_hrefs:
+        logger.debug(f"vApp {name} is handled by a bulk power operation")
+        return
+    if power_state_reached(status.get('backing', {}).get('status'), spec.get('powered_on')):
+        logger.debug(f"vApp {name} is already in the expected power state")
+        return
+    vcd_session = get_vcd_session(spec.get('site'))
+    return vapp_operations.run(
+        vapp_href, vcd_session.scheduler.run_handler, Priority.RECONCILE,
+        vapp_reconcile_power_state, merge_key='power_state',
+        wait_timeout=vcd_session.scheduler.handler_wait,
+        vcd_session=vcd_session,
+        vapp_href=vapp_href,
         expected_power_state=spec.get('powered_on'),
         logger=logger)
 
 
-def vapp_reconcile_power_state(vapp_href: str, current_status:str, expected_power_state: bool, logger: kopf.Logger):
+def vapp_reconcile_power_state(vcd_session: VcdSession, vapp_href: str, expected_power_state: bool,
+                               logger: kopf.Logger):
     """Reconcile the vApp power status with spec.
 
+    The current status is read from the vApp itself: a previous operation on the
+    same vApp may have already changed it since the last refresh.
+
     Args:
+        vcd_session (VcdSession): VCD session
         vapp_href (str): Href of the vApp to edit
-        current_status (str): Current status of the vApp
         expected_power_state (bool): Expected power state of the vApp
         logger (kopf.Logger): Logger facility
     """
     logger.debug(f"Starting vapp_reconcile_power_state")
     try:
-        vapp = VApp(get_vcd_session().client, href=vapp_href)
-        vapp.reload() # just to get the vapp name :/
+        vapp = VApp(vcd_session.client, href=vapp_href)
+        vapp.reload()
     except EntityNotFoundException:
         raise kopf.PermanentError(f"Cannot find the vApp with href: {vapp_href}")
+    current_status = VCLOUD_STATUS_MAP[vapp.get_power_state()]
     # reconcile the vApp power status with spec
     action_result = None
     if expected_power_state and current_status in ['Deployed', 'Suspended', 'Powered off']:
@@ -281,10 +668,11 @@ def vapp_reconcile_power_state(vapp_href: str, current_status:str, expected_powe
         logger.info(f"Shutting down vApp: {vapp.name}")
         action_result = vapp.undeploy()
     if action_result != None:
-        task = get_vcd_session().client.get_task_monitor().wait_for_status(
-            task=action_result,
-            timeout=60,
-            poll_frequency=2,
+        task = wait_for_task(
+            vcd_session,
+            action_result,
+            timeout=kvcd_config.power_task_timeout,
+            poll_frequency=kvcd_config.task_poll_frequency,
             fail_on_statuses=None,
             expected_target_statuses=[
                 TaskStatus.SUCCESS, TaskStatus.ABORTED, TaskStatus.ERROR,
@@ -293,10 +681,14 @@ def vapp_reconcile_power_state(vapp_href: str, current_status:str, expected_powe
             callback=None)
         if task.get('status') != TaskStatus.SUCCESS.value:
             raise kopf.PermanentError(f"Failed to power {action} vApp: {task.get('status')}")
+        vcd_session.vapp_index.update(vapp_href, deployed=action == "on",
+                                      status=VAPP_RECORD_STATUSES[4 if action == "on" else 8])
 
 
 @kopf.on.field('kvcd.lrivallain.dev', 'v1', 'vcdvapps', field='spec.owner')
 @kopf.on.field('kvcd.lrivallain.dev', 'v1', 'vcdvapps', field='status.backing.owner')
+@traced('vcdvapp.update_owner')
+@retry_policy('vcdvapps')
 def update_vcdvapp_owner(old: dict, new: dict, status: kopf.Status, spec: kopf.Spec,
                                name: str, namespace: str, logger: kopf.Logger, **kwargs):
     """Update a vcdvapp owner
@@ -312,20 +704,27 @@ def update_vcdvapp_owner(old: dict, new: dict, status: kopf.Status, spec: kopf.S
     """
     logger.info(f"Updating a vcdvapp owner for: {name} in namespace: {namespace}")
     if not status.get('backing', {}).get('vcd_vapp_href'): return
-    return vapp_reconcile_owner(
-        vapp_href=status.get('backing', {}).get('vcd_vapp_href'),
+    vapp_href = status.get('backing', {}).get('vcd_vapp_href')
+    vcd_session = get_vcd_session(spec.get('site'))
+    return vapp_operations.run(
+        vapp_href, vcd_session.scheduler.run_handler, Priority.RECONCILE,
+        vapp_reconcile_owner, merge_key='owner',
+        wait_timeout=vcd_session.scheduler.handler_wait,
+        vcd_session=vcd_session,
+        vapp_href=vapp_href,
         current_owner=status.get('backing').get('owner'),
         expected_owner=spec.get('owner'),
         org_name=spec.get('org'),
         logger=logger)
 
 
-def vapp_reconcile_owner(vapp_href: str, current_owner: str,
+def vapp_reconcile_owner(vcd_session: VcdSession, vapp_href: str, current_owner: str,
                         expected_owner: str, org_name: str,
                         logger: kopf.Logger):
     """Reconcile the vApp owner with spec.
 
     Args:
+        vcd_session (VcdSession): VCD session
         vapp_href (str): Href of the vApp to edit
         current_owner (str): Current owner of the vApp
         expected_owner (str): Expected owner of the vApp
@@ -336,20 +735,25 @@ def vapp_reconcile_owner(vapp_href: str, current_owner: str,
     if not expected_owner:
         return # no need to change owner
     try:
-        vapp = VApp(get_vcd_session().client, href=vapp_href)
+        vapp = VApp(vcd_session.client, href=vapp_href)
     except EntityNotFoundException:
         raise kopf.PermanentError(
             f"Cannot find the vApp with href: {vapp_href}")
 
     # reconcile the vApp owner with spec
     try:
-        org = get_org(vcd_session=get_vcd_session(), org_name=org_name)
+        org = get_org(vcd_session=vcd_session, org_name=org_name)
         future_owner = org.get_user(expected_owner)
-    except EntityNotFoundException:
+    except EntityNotFoundException as e:
         raise kopf.TemporaryError(
-            f"Cannot find the expected owner as an org user: {expected_owner}")
+            f"Cannot find the expected owner as an org user: {expected_owner}") from e
 
-    vapp.change_owner(future_owner.get('href'))
+    action_result = vapp.change_owner(future_owner.get('href'))
+    if action_result is not None:  # 204 on most vCD versions, a task on others
+        task = wait_for_task(vcd_session, action_result)
+        if task.get('status') != TaskStatus.SUCCESS.value:
+            raise kopf.PermanentError(f"Failed to change vApp owner: {task.get('status')}")
+    vcd_session.vapp_index.update(vapp_href, owner=expected_owner)
     logger.debug("Successful owner change")
 
 
@@ -357,6 +761,8 @@ def vapp_reconcile_owner(vapp_href: str, current_owner: str,
 @kopf.on.field('kvcd.lrivallain.dev', 'v1', 'vcdvapps', field='status.backing.deploymentLeaseInSeconds')
 @kopf.on.field('kvcd.lrivallain.dev', 'v1', 'vcdvapps', field='spec.storageLeaseInSeconds')
 @kopf.on.field('kvcd.lrivallain.dev', 'v1', 'vcdvapps', field='status.backing.storageLeaseInSeconds')
+@traced('vcdvapp.update_lease_info')
+@retry_policy('vcdvapps')
 def update_vcdvapp_lease_info(old: dict, new: dict, status: kopf.Status, spec: kopf.Spec,
                               name: str, namespace: str, logger: kopf.Logger, **kwargs):
     """Update a vcdvapp lease_info
@@ -372,8 +778,14 @@ def update_vcdvapp_lease_info(old: dict, new: dict, status: kopf.Status, spec: k
     """
     logger.info(f"Updating a vcdvapp lease_info for: {name} in namespace: {namespace}")
     if not status.get('backing', {}).get('vcd_vapp_href'): return
-    return vapp_reconcile_lease_info(
-        vapp_href=status.get('backing', {}).get('vcd_vapp_href'),
+    vapp_href = status.get('backing', {}).get('vcd_vapp_href')
+    vcd_session = get_vcd_session(spec.get('site'))
+    return vapp_operations.run(
+        vapp_href, vcd_session.scheduler.run_handler, Priority.RECONCILE,
+        vapp_reconcile_lease_info, merge_key='lease_info',
+        wait_timeout=vcd_session.scheduler.handler_wait,
+        vcd_session=vcd_session,
+        vapp_href=vapp_href,
         current_deploymentLeaseInSeconds=status.get('backing').get('deploymentLeaseInSeconds'),
         current_storageLeaseInSeconds=status.get('backing').get('storageLeaseInSeconds'),
         expected_deploymentLeaseInSeconds=spec.get('deploymentLeaseInSeconds'),
@@ -381,12 +793,13 @@ def update_vcdvapp_lease_info(old: dict, new: dict, status: kopf.Status, spec: k
         logger=logger)
 
 
-def vapp_reconcile_lease_info(vapp_href: str, current_deploymentLeaseInSeconds: int,
+def vapp_reconcile_lease_info(vcd_session: VcdSession, vapp_href: str, current_deploymentLeaseInSeconds: int,
     current_storageLeaseInSeconds: int, expected_deploymentLeaseInSeconds: int,
     expected_storageLeaseInSeconds: int, logger: kopf.Logger):
     """Reconcile the vApp lease_info with spec.
 
     Args:
+        vcd_session (VcdSession): VCD session
         vapp_href (str): Href of the vApp to edit
         current_deploymentLeaseInSeconds (int): Current deploymentLease in seconds
         current_storageLeaseInSeconds (int): Current storageLease in seconds
@@ -405,29 +818,37 @@ def vapp_reconcile_lease_info(vapp_href: str, current_deploymentLeaseInSeconds:
         return # no need to change lease_info
 
     try:
-        vapp = VApp(get_vcd_session().client, href=vapp_href)
+        vapp = VApp(vcd_session.client, href=vapp_href)
     except EntityNotFoundException:
         raise kopf.PermanentError(
             f"Cannot find the vApp with href: {vapp_href}")
 
     try:
-        vapp.set_lease(
+        action_result = vapp.set_lease(
             deployment_lease=expected_deploymentLeaseInSeconds,
             storage_lease=expected_storageLeaseInSeconds
         )
     except BadRequestException as e:
         if e.vcd_error.get('minorErrorCode') == 'BUSY_ENTITY':
-            raise kopf.TemporaryError(f"Cannot set lease for vApp: {vapp_href}")
+            raise kopf.TemporaryError(f"Cannot set lease for vApp: {vapp_href}") from e
         else:
             raise e
     except Exception as e:
         raise e
+    # The next operation on the vApp must not start before the end of the update
+    task = wait_for_task(vcd_session, action_result)
+    if task.get('status') != TaskStatus.SUCCESS.value:
+        raise kopf.PermanentError(f"Failed to set vApp lease: {task.get('status')}")
+    # Force a full read of the vApp on next refresh
+    _backing_signals.pop(vapp_href, None)
     logger.debug("Successful lease_info change")
 
 
 @kopf.on.field('kvcd.lrivallain.dev', 'v1', 'vcdvapps', field='metadata.annotations')
 @kopf.on.field('kvcd.lrivallain.dev', 'v1', 'vcdvapps', field='status.backing.metadata')
-def update_vcdvapp_metadata(old: dict, new: dict, status: kopf.Status,
+@traced('vcdvapp.update_metadata')
+@retry_policy('vcdvapps')
+def update_vcdvapp_metadata(old: dict, new: dict, status: kopf.Status, spec: kopf.Spec,
                             annotations: kopf._cogs.structs.dicts.MappingView,
                             name: str, namespace: str, logger: kopf.Logger,
                             **kwargs):
@@ -437,6 +858,7 @@ def update_vcdvapp_metadata(old: dict, new: dict, status: kopf.Status,
         old (dict): Old object specs
         new (dict): New object specs
         status (kopf.Status): Current status data of the object
+        spec (kopf.Spec): Object specs
         annotations (dict): Object annotations
         name (str): Name of the object
         namespace (str): Name of the namespace where object is declared
@@ -444,19 +866,26 @@ def update_vcdvapp_metadata(old: dict, new: dict, status: kopf.Status,
     """
     logger.info(f"Updating a vcdvapp metadata entries for: {name} in namespace: {namespace}")
     if not status.get('backing', {}).get('vcd_vapp_href'): return
-    return vapp_reconcile_metadata(
-        vapp_href=status.get('backing', {}).get('vcd_vapp_href'),
+    vapp_href = status.get('backing', {}).get('vcd_vapp_href')
+    vcd_session = get_vcd_session(spec.get('site'))
+    return vapp_operations.run(
+        vapp_href, vcd_session.scheduler.run_handler, Priority.RECONCILE,
+        vapp_reconcile_metadata, merge_key='metadata',
+        wait_timeout=vcd_session.scheduler.handler_wait,
+        vcd_session=vcd_session,
+        vapp_href=vapp_href,
         current_metadata=status.get('backing').get('metadata', {}),
         expected_metadata=annotations,
         logger=logger)
 
 
-
-def vapp_reconcile_metadata(vapp_href: str, current_metadata: kopf._cogs.structs.dicts.MappingView,
-    expected_metadata: dict, logger: kopf.Logger):
+def vapp_reconcile_metadata(vcd_session: VcdSession, vapp_href: str,
+                            current_metadata: kopf._cogs.structs.dicts.MappingView,
+                            expected_metadata: dict, logger: kopf.Logger):
     """Reconcile the vApp metadata entries with spec.
 
     Args:
+        vcd_session (VcdSession): VCD session
         vapp_href (str): Href of the vApp to edit
         current_metadata (dict): Current deploymentLease in seconds
         expected_metadata (kopf._cogs.structs.dicts.MappingView): Current storageLease in seconds
@@ -464,14 +893,14 @@ def vapp_reconcile_metadata(vapp_href: str, current_metadata: kopf._cogs.structs
     """
     logger.debug(f"Starting vapp_reconcile_metadata")
     try:
-        vapp = VApp(get_vcd_session().client, href=vapp_href)
+        vapp = VApp(vcd_session.client, href=vapp_href)
         vapp.reload()  # just to get the vapp name :/
     except EntityNotFoundException:
         raise kopf.PermanentError(
             f"Cannot find the vApp with href: {vapp_href}")
 
     # Sadly we cannot set READONLY metadata except if we are running as sysadmin
-    if get_vcd_session().client.is_sysadmin():
+    if vcd_session.client.is_sysadmin():
         metadata_visibility = MetadataVisibility.READONLY.value
     else:
         metadata_visibility = MetadataVisibility.READ_WRITE.value
@@ -484,20 +913,115 @@ def vapp_reconcile_metadata(vapp_href: str, current_metadata: kopf._cogs.structs
                         visibility=metadata_visibility,
                         key=entry,
                         value=str(expected_metadata[entry]))
-                    result = get_vcd_session().client.get_task_monitor().wait_for_status(task=task)
+                    result = wait_for_task(vcd_session, task)
                     if result.get('status') != TaskStatus.SUCCESS.value:
                         raise kopf.PermanentError(f"Failed to create metadata on vApp: {result.get('status')}")
                 except OperationNotSupportedException as e:
-                    raise kopf.TemporaryError(f"OperationNotSupportedException exception raised by vCloud")
+                    raise kopf.TemporaryError("OperationNotSupportedException exception raised by vCloud") from e
                 except Exception as e:
                     raise e
                 logger.debug(f"Successful metadata change for: {entry} on vApp {vapp.name}")
+    # Force a full read of the vApp on next refresh
+    _backing_signals.pop(vapp_href, None)
+
+
+# vApp href -> (change signal, time of the last full read)
+_backing_signals = {}
+
+
+def vapp_resource_state(vapp_resource: ObjectifiedElement):
+    """Extract the indexed state of a vApp from its main resource.
+
+    Args:
+        vapp_resource (ObjectifiedElement): vApp resource
+
+    Returns:
+        dict: vApp status (as in the query records), deployment and owner
+    """
+    return {
+        'status': VAPP_RECORD_STATUSES.get(int(vapp_resource.get('status'))),
+        'deployed': vapp_resource.get('deployed') == 'true',
+        'owner': vapp_resource.Owner.User.get('name'),
+    }
+
+
+def vapp_entry_signal(entry: dict):
+    """Compute a change signal of a vApp from its entry in the vApp index.
+
+    Args:
+        entry (dict): Indexed entry of the vApp
+
+    Returns:
+        str: Hash of the observed fields of the vApp
+    """
+    observed = [entry.get(key) for key in ('name', 'status', 'deployed', 'owner', 'expired',
+                                           'storage_expiration', 'deployment_expiration')]
+    return hashlib.sha1('|'.join(str(o) for o in observed).encode()).hexdigest()
+
+
+def vapp_entry_status(entry: dict):
+    """Get the status of a vApp from its entry in the vApp index.
+
+    Args:
+        entry (dict): Indexed entry of the vApp
+
+    Returns:
+        str: Status of the vApp, as mapped by `VCLOUD_STATUS_MAP`, or None if unknown
+    """
+    code = next((code for code, record_status in VAPP_RECORD_STATUSES.items()
+                 if record_status == entry.get('status')), None)
+    return VCLOUD_STATUS_MAP.get(code)
+
+
+def vapp_entry_expired(entry: dict):
+    """Check if the storage lease of a vApp expired, from its entry in the vApp index.
+
+    Args:
+        entry (dict): Indexed entry of the vApp
+
+    Returns:
+        bool: Whether the vApp is expired
+    """
+    if entry.get('expired'):
+        return True
+    expiration = entry.get('storage_expiration')
+    return bool(expiration) and dateutil.parser.isoparse(expiration) < datetime.now(timezone.utc)
+
+
+def vapp_change_signal(vapp_resource: ObjectifiedElement):
+    """Compute a cheap change signal of a vApp from its main resource.
+
+    Args:
+        vapp_resource (ObjectifiedElement): vApp resource
+
+    Returns:
+        str: Hash of the observed fields of the vApp
+    """
+    observed = [
+        vapp_resource.get('name'),
+        vapp_resource.get('status'),
+        vapp_resource.get('deployed'),
+        str(getattr(vapp_resource, 'Description', '')),
+        vapp_resource.Owner.User.get('name'),
+    ]
+    lease_section = getattr(vapp_resource, 'LeaseSettingsSection', None)
+    if lease_section is not None:
+        observed.extend(str(child) for child in lease_section.iterchildren())
+    return hashlib.sha1('|'.join(str(o) for o in observed).encode()).hexdigest()
+
+
+# A refresh only takes a thread once it holds a refresh slot: one thread per refresh slot of each site, never
+# waiting. Not the default executor of the loop, sized by the number of CPUs, nor the one of the handlers.
+_refresh_executor = ThreadPoolExecutor(
+    max_workers=max(1, math.ceil(kvcd_config.scheduler.refresh_share * kvcd_config.scheduler.slots)) * len(vcd_sites),
+    thread_name_prefix='kvcd-refresh')
 
 
 @kopf.timer('kvcd.lrivallain.dev', 'v1', 'vcdvapps',
             interval=kvcd_config.refresh_interval,
             initial_delay=kvcd_config.refresh_initial_delay,
             idle=kvcd_config.refresh_idle_delay)
+@traced('vcdvapp.refresh')
 async def refresh_vcdvapp(spec: kopf.Spec, status: kopf.Status, name: str, namespace: str,
     annotations: kopf._cogs.structs.dicts.MappingView, logger: kopf.Logger,
     patch: kopf.Patch, **kwargs):
@@ -514,17 +1038,41 @@ async def refresh_vcdvapp(spec: kopf.Spec, status: kopf.Status, name: str, names
     """
     if not status.get('backing', {}).get('vcd_vapp_href'):
         return  # nothing to update
+    vcd_session = get_vcd_session(spec.get('site'))
+    # Wait for a slot without blocking the event loop, then run the vCD calls in a thread
+    try:
+        async with vcd_session.scheduler.async_slot(Priority.REFRESH):
+            # Run in a copy of the context to keep the current span
+            await asyncio.get_running_loop().run_in_executor(_refresh_executor, functools.partial(
+                contextvars.copy_context().run, vapp_refresh, vcd_session, spec=spec, status=status, name=name,
+                namespace=namespace, annotations=annotations, logger=logger, patch=patch))
+    except CircuitOpenError as e:
+        logger.debug(f"Skipping refresh: {e}")
+
+
+def vapp_refresh(vcd_session: VcdSession, spec: kopf.Spec, status: kopf.Status, name: str, namespace: str,
+                 annotations: kopf._cogs.structs.dicts.MappingView, logger: kopf.Logger,
+                 patch: kopf.Patch):
+    """Update the backing status of a vcdvapp from its vApp
+
+    Args:
+        vcd_session (VcdSession): VCD session
+        spec (kopf.Spec): Object specs
+        status (kopf.Status): Current status data of the object
+        name (str): Name of the object
+        namespace (str): Name of the namespace where object is declared
+        annotations (kopf._cogs.structs.dicts.MappingView): Object annotations
+        logger (kopf.Logger): Logger facility
+        patch (kopf.Patch): Patch to apply
+    """
     logger.debug(f"Timer: update status of vApp: {name} in namespace: {namespace}")
-    vdc = get_vdc(vcd_session=get_vcd_session(),
-                  org_name=spec.get('org'),
-                  vdc_name=spec.get('vdc'))
+    vapp_href = status.get('backing', {}).get('vcd_vapp_href')
+    vdc_href = status.get('backing', {}).get('vcd_vdc_href')
 
-    # look for a vApp with the same name
-    try:
-        vapp_resource = vdc.get_vapp(name)
-        vapp = VApp(get_vcd_session().client, resource=vapp_resource)
-        vapp.reload()
-    except EntityNotFoundException:
+    backing = status.get('backing', {})
+
+    def _missing():
+        vcd_session.vapp_index.remove(vapp_href)
         logger.error(f"vApp {name} is not existing anymore on vCloud")
         # removing backing data
         backing_info = {
@@ -532,32 +1080,78 @@ async def refresh_vcdvapp(spec: kopf.Spec, status: kopf.Status, name: str, names
             'status': 'Missing',
             'uuid': None
         }
-        patch.status['backing'] = backing_info
+        status_writer.submit('vcdvapps', namespace, name, {'backing': backing_info}, urgent=True)
         raise kopf.PermanentError(f"vApp {name} is not existing anymore on vCloud")
 
+    # check the existence of the vApp in the index of its VDC: its state is read from its entry, and the vApp
+    # itself (lease, metadata) only when this state changed since the last full read
+    entry = None
+    if vdc_href:
+        entry = vcd_session.vapp_index.get_by_href(vdc_href, vapp_href, refresh_missing=True)
+        if entry is None:
+            _missing()
+    last_signal, last_read = _backing_signals.get(vapp_href, (None, 0))
+    full_read = (entry is None or vapp_entry_signal(entry) != last_signal or
+                 vapp_entry_status(entry) is None or not entry.get('owner') or
+                 time.monotonic() - last_read > kvcd_config.refresh_full_interval or
+                 ('metadata' not in backing and not vapp_entry_expired(entry)))
+
     backing_update = {}
-    # leases
-    lease_info = vapp.get_lease()
-    if lease_info.get('StorageLeaseExpiration'):
-        # compare current utc to the iso date in StorageLeaseExpiration to know if it is expired
-        if dateutil.parser.isoparse(str(lease_info.get('StorageLeaseExpiration'))) < datetime.now(timezone.utc):
+    if full_read:
+        try:
+            vapp = VApp(vcd_session.client, href=vapp_href)
+            vapp_resource = vapp.get_resource()
+        except EntityNotFoundException:
+            _missing()
+        state = vapp_resource_state(vapp_resource)
+        vcd_session.vapp_index.update(vapp_href, **state)
+        # leases
+        lease_info = vapp.get_lease()
+        if lease_info.get('StorageLeaseExpiration'):
+            # compare current utc to the iso date in StorageLeaseExpiration to know if it is expired
+            if dateutil.parser.isoparse(str(lease_info.get('StorageLeaseExpiration'))) < datetime.now(timezone.utc):
+                backing_update['status'] = "Expired"
+        for l in ['DeploymentLeaseInSeconds', 'StorageLeaseInSeconds']:
+            lease_value = int(lease_info.get(l))
+            lease_key = lowercase_first_string_letter(l)
+            backing_update[lease_key] = lease_value
+        if entry is not None:
+            signal = vapp_entry_signal(dict(entry, **state))
+            read_metadata = True
+        else:
+            # Not indexed without the href of its VDC: the metadata is only read when the vApp changed
+            signal = vapp_change_signal(vapp_resource)
+            read_metadata = (signal != last_signal or 'metadata' not in backing or
+                             time.monotonic() - last_read > kvcd_config.refresh_full_interval)
+        if backing_update.get('status') != "Expired":
+            # vApp status
+            backing_update['status'] = VCLOUD_STATUS_MAP[int(vapp_resource.get('status'))]
+            if read_metadata:
+                backing_update['metadata'] = metadata_to_dict(vapp.get_metadata())
+            # vApp owner
+            backing_update['owner'] = state['owner']
+        if read_metadata:
+            _backing_signals[vapp_href] = (signal, time.monotonic())
+    else:
+        logger.debug(f"vApp {name} is unchanged since the last refresh")
+        if vapp_entry_expired(entry):
             backing_update['status'] = "Expired"
-    for l in ['DeploymentLeaseInSeconds', 'StorageLeaseInSeconds']:
-        lease_value = int(lease_info.get(l))
-        lease_key = lowercase_first_string_letter(l)
-        backing_update[lease_key] = lease_value
-    if backing_update.get('status') != "Expired":
-        # vApp status
-        backing_status = VCLOUD_STATUS_MAP[int(vapp_resource.get('status'))]
-        backing_update['status'] = backing_status
-        # Metadata
-        backing_update['metadata'] = metadata_to_dict(vapp.get_metadata())
-        # vApp owner
-        backing_owner = vapp.resource.Owner.User.get('name')
-        backing_update['owner'] = backing_owner
-    # Update the backing status
-    patch.status['backing'] = backing_update
-    # Force the managed-by metadata on vCloud side
-    if not annotations.get('managed-by'):
-        patch.metadata.annotations['managed-by'] = 'kvcd'
+        else:
+            backing_update['status'] = vapp_entry_status(entry)
+            backing_update['owner'] = entry['owner']
+    if backing_update['status'] != "Expired":
+        # VMs: from the inventory shared by all the vApps of the site
+        vms = vcd_session.vm_inventory.get(vapp_href)
+        if vms is not None:
+            backing_update['vms'] = vms
+    # Update the backing status, only with the changed values
+    backing_update = {k: v for k, v in backing_update.items() if backing.get(k) != v}
+    if backing_update:
+        # User-visible transitions are written first
+        status_writer.submit('vcdvapps', namespace, name, {'backing': backing_update},
+                             urgent='status' in backing_update)
+    # Force the managed-by (and instance) metadata on vCloud side
+    for key, value in managed_metadata().items():
+        if not annotations.get(key):
+            patch.metadata.annotations[key] = value
     return
@@ -0,0 +1,213 @@
+"""Validating admission webhook of the vcdvapps.
+
+The handlers only discover a wrong org, Org VDC, catalog item or owner after
+some vCD calls, and sometimes retries. The webhook rejects these vcdvapps at
+`kubectl apply` instead, with in-memory lookups only: the names are checked
+against the Org VDCs capacity snapshot and the directory (organizations,
+users, catalog items) of each site, refreshed in the background once older
+than their usual maximum age.
+
+The checks never wait for vCloud: a name that cannot be checked (site not
+connected yet, snapshot not taken) is accepted and left to the handlers. A
+name that is not found triggers an early refresh of the snapshots, so that an
+object referencing something just created in vCloud is accepted again shortly.
+
+The webhook is enabled with `KVCD_WEBHOOK_PORT`, and only served by the leader
+replica (see `KVCD_LEADER_POD_LABEL`), with a certificate shared by all the
+replicas. It ignores its own failures: when the operator is not reachable
+(restart, leader change), the objects are admitted and validated by the
+handlers, as without the webhook.
+"""
+
+import logging
+import threading
+import time
+
+import kopf
+from kvcd.metrics import counter
+from kvcd.vmware.vcloud_helper import VcdSession
+from kvcd.main import resolve_site, kvcd_config, vcd_sessions
+
+
+logger = logging.getLogger(__name__)
+
+# Minimum interval (in secs) between two refreshes triggered by unknown names
+MIN_REFRESH_INTERVAL = 10
+
+_REVIEWS = counter(
+    'kvcd_webhook_reviews_total',
+    'Number of vcdvapps admitted (allowed) or rejected by the validating webhook',
+    ('result',))
+
+
+def validate_vapp_owner(vcd_session: VcdSession, org_name: str, owner: str, declared_users=()):
+    """Check the owner of a vcdvapp against the directory.
+
+    Args:
+        vcd_session (VcdSession): VCD session
+        org_name (str): Name of the organization
+        owner (str): Name of the owner, if any
+        declared_users (Iterable, optional): Usernames of the vcdusers of the organization,
+            that may not be created yet. Defaults to ().
+
+    Returns:
+        list: Errors
+    """
+    if not owner or owner in declared_users:
+        return []
+    if vcd_session.directory.has_user(org_name, owner) is False:
+        return [f"Unknown owner {owner} in the org {org_name}"]
+    return []
+
+
+def validate_vapp_spec(vcd_session: VcdSession, spec: kopf.Spec, declared_users=()):
+    """Check the specs of a new vcdvapp against the snapshots of a site.
+
+    Args:
+        vcd_session (VcdSession): VCD session
+        spec (kopf.Spec): vcdvapp specs
+        declared_users (Iterable, optional): Usernames of the vcdusers of the organization,
+            that may not be created yet. Defaults to ().
+
+    Returns:
+        list: Errors
+    """
+    directory = vcd_session.directory
+    org_name = spec.get('org')
+    if directory.has_org(org_name) is False:
+        return [f"Unknown org: {org_name}"]
+    errors = []
+    vdc_names = [spec['vdc']] if spec.get('vdc') else (spec.get('placement') or {}).get('vdcs') or []
+    if not spec.get('vdc') and not spec.get('placement'):
+        errors.append("A vdc or a placement must be set")
+    for vdc_name in vdc_names:
+        if vcd_session.vdc_capacity.has_vdc(org_name, vdc_name) is False:
+            errors.append(f"Unknown Org VDC {vdc_name} in the org {org_name}")
+    catalog, template = spec.get('source_catalog'), spec.get('source_template_name')
+    if bool(catalog) != bool(template):
+        errors.append("source_catalog and source_template_name must be set together")
+    elif catalog and directory.has_catalog_item(catalog, template) is False:
+        errors.append(f"Unknown vApp template {template} in the catalog {catalog}")
+    errors += validate_vapp_owner(vcd_session, org_name, spec.get('owner'), declared_users)
+    return errors
+
+
+class DirectoryRefresher:
+    """Background refresh of the snapshots used by the webhook, for every site.
+
+    The snapshots are refreshed when the webhook uses them, in the background:
+    once older than their maximum age, or at once (at most every
+    `MIN_REFRESH_INTERVAL`) after an unknown name. An operator without any
+    review does not query the directory at all.
+    """
+
+    def __init__(self):
+        self._wakeup = threading.Event()
+        self._force = False
+        self._stopping = threading.Event()
+        self._refreshed_at = 0
+        self._thread = None
+
+    def start(self):
+        """Start the background thread.
+        """
+        self._thread = threading.Thread(target=self._run, name='kvcd-directory-refresh', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread.
+        """
+        self._stopping.set()
+        self._wakeup.set()
+
+    def wake_up(self, force: bool = False):
+        """Refresh the snapshots that are too old, or all of them after an unknown name.
+
+        Args:
+            force (bool, optional): Ignore the age of the snapshots. Defaults to False.
+        """
+        self._force = self._force or force
+        self._wakeup.set()
+
+    def _run(self):
+        force = True  # first snapshots
+        while not self._stopping.is_set():
+            for site, vcd_session in list(vcd_sessions.items()):
+                try:
+                    vcd_session.directory.refresh(force=force)
+                    if force:  # refreshed on its own schedule otherwise
+                        vcd_session.vdc_capacity.refresh(force=True)
+                except Exception as e:
+                    logger.warning(f"Failed to refresh the directory of site {site}: {e}")
+            if force:
+                self._refreshed_at = time.monotonic()
+            self._wakeup.wait()
+            self._wakeup.clear()
+            force, self._force = self._force, False
+            if force:
+                # Do not follow a burst of invalid objects
+                self._stopping.wait(max(0, self._refreshed_at + MIN_REFRESH_INTERVAL - time.monotonic()))
+
+
+_refresher = DirectoryRefresher()
+
+
+def validate_vcdvapp(spec: kopf.Spec, old: dict, operation: str, logger: kopf.Logger, **kwargs):
+    """Validating webhook: reject the vcdvapps referencing unknown vCloud objects
+
+    Args:
+        spec (kopf.Spec): Object specs
+        old (dict): Previous state of the object, for an update
+        operation (str): Admission operation: CREATE or UPDATE
+        logger (kopf.Logger): Logger facility
+
+    Raises:
+        kopf.AdmissionError: Invalid specs
+    """
+    try:
+        site = resolve_site(spec.get('site'))
+    except kopf.PermanentError as e:
+        _REVIEWS.labels('rejected').inc()
+        raise kopf.AdmissionError(str(e), code=400)
+    vcd_session = vcd_sessions.get(site)
+    if vcd_session is None:
+        _REVIEWS.labels('allowed').inc()
+        return  # not connected yet: left to the handlers
+    # The vcdusers applied with the vcdvapp are not created yet
+    vcduser_index = kwargs.get('vcduser_index') or {}
+    declared_users = {entry['username'] for entry in vcduser_index.get((spec.get('site'), spec.get('org')), [])}
+    if operation == 'CREATE':
+        errors = validate_vapp_spec(vcd_session, spec, declared_users)
+    elif spec.get('owner') != (old or {}).get('spec', {}).get('owner'):
+        # The other references are creation only
+        errors = validate_vapp_owner(vcd_session, spec.get('org'), spec.get('owner'), declared_users)
+    else:
+        errors = []
+    _refresher.wake_up(force=bool(errors))
+    if errors:
+        _REVIEWS.labels('rejected').inc()
+        raise kopf.AdmissionError("; ".join(errors), code=400)
+    _REVIEWS.labels('allowed').inc()
+
+
+def start_directory_refresh(logger: kopf.Logger, **kwargs):
+    """Startup function: start the refresh of the snapshots used by the webhook
+
+    Args:
+        logger (kopf.Logger): Logger facility
+    """
+    _refresher.start()
+
+
+def stop_directory_refresh(**kwargs):
+    """Cleanup function: stop the refresh of the snapshots used by the webhook
+    """
+    _refresher.stop()
+
+
+# kopf refuses to start with admission handlers but without an admission server
+if kvcd_config.webhook.port:
+    kopf.on.validate('kvcd.lrivallain.dev', 'v1', 'vcdvapps', operations=['CREATE', 'UPDATE'],
+                     ignore_failures=True)(validate_vcdvapp)
+    kopf.on.startup()(start_directory_refresh)
+    kopf.on.cleanup()(stop_directory_refresh)
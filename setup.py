@@ -26,6 +26,12 @@ setup_requirements = [
 test_requirements = [
 ]
 
+extras_requirements = {
+    "metrics": ["prometheus_client"],
+    # self-signed certificate of the validating webhook
+    "webhook": ["certbuilder", "oscrypto"],
+}
+
 description = "A python based proof of concept of an operator "
 description += "to manage VMware Cloud Director ressources"
 
@@ -45,6 +51,7 @@ setup(
     description=description,
     long_description_content_type="text/markdown",
     install_requires=requirements,
+    extras_require=extras_requirements,
     license="MIT license",
     long_description=readme + '\n\n' + history,
     include_package_data=True,
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+"""Tests for the configuration of the sites."""
+
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+# kvcd.main reads its configuration at import
+for _name, _value in (('KVCD_VCD_HOST', 'vcd.test'), ('KVCD_VCD_ORG', 'test'), ('KVCD_VCD_USERNAME', 'test'),
+                      ('KVCD_VCD_PASSWORD', 'test'), ('KVCD_ENABLED_MODULES', '')):
+    os.environ.setdefault(_name, _value)
+
+import kopf  # noqa: E402
+
+from kvcd import main  # noqa: E402
+from kvcd.config import KvcdConfig, load_sites  # noqa: E402
+
+
+SITES = """
+- name: paris
+  host: vcd.paris
+  password_env: PARIS_PASSWORD
+- name: lyon
+  host: vcd.lyon
+  org: lyon
+  password: secret
+  verify_ssl: false
+"""
+
+
+class TestLoadSites(unittest.TestCase):
+    """Tests for `load_sites`."""
+
+    def _load(self, sites: str = None, **environ):
+        if sites is not None:
+            with tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False) as f:
+                f.write(sites)
+            self.addCleanup(os.remove, f.name)
+            environ['KVCD_SITES_FILE'] = f.name
+        return load_sites(KvcdConfig.from_environ(environ))
+
+    def test_000_default_site(self):
+        """The site of the KVCD_VCD_* variables is the default one."""
+        sites = self._load(KVCD_VCD_HOST='vcd.test', KVCD_VCD_PASSWORD='test')
+        self.assertEqual(list(sites), ['default'])
+        self.assertEqual((sites['default'].host, sites['default'].org), ('vcd.test', 'System'))
+
+    def test_001_sites_file(self):
+        """The sites of KVCD_SITES_FILE come after the default one, their password read from the environment."""
+        with mock.patch.dict(os.environ, {'PARIS_PASSWORD': 'from-env'}):
+            sites = self._load(SITES, KVCD_VCD_HOST='vcd.test', KVCD_VCD_PASSWORD='test')
+        self.assertEqual(list(sites), ['default', 'paris', 'lyon'])
+        self.assertEqual(sites['paris'].password, 'from-env')
+        self.assertEqual((sites['lyon'].org, sites['lyon'].password, sites['lyon'].verify_ssl),
+                         ('lyon', 'secret', False))
+
+    def test_002_sites_file_only(self):
+        """Without the KVCD_VCD_* variables, only the sites of the file are managed."""
+        with mock.patch.dict(os.environ, {'PARIS_PASSWORD': 'from-env'}):
+            self.assertEqual(list(self._load(SITES)), ['paris', 'lyon'])
+
+    def test_003_invalid(self):
+        """A duplicated site, a missing password variable or no site at all is rejected."""
+        with self.assertRaises(ValueError):
+            self._load('- name: default\n  host: vcd.other\n  password: secret\n',
+                       KVCD_VCD_HOST='vcd.test', KVCD_VCD_PASSWORD='test')
+        with mock.patch.dict(os.environ, clear=True), self.assertRaises(KeyError):
+            self._load(SITES)
+        with self.assertRaises(ValueError):
+            self._load()
+
+
+class TestResolveSite(unittest.TestCase):
+    """Tests for the site of an object."""
+
+    def test_000_single_site(self):
+        """Without a default site, the only configured one is used."""
+        with mock.patch.object(main, 'vcd_sites', {'paris': None}):
+            self.assertEqual(main.resolve_site(None), 'paris')
+
+    def test_001_default_site(self):
+        """Among several sites, the default one is used."""
+        with mock.patch.object(main, 'vcd_sites', {'default': None, 'paris': None}):
+            self.assertEqual(main.resolve_site(None), 'default')
+            self.assertEqual(main.resolve_site('paris'), 'paris')
+
+    def test_002_unknown_site(self):
+        """An unknown site, or no site among several without a default one, is a permanent error."""
+        with mock.patch.object(main, 'vcd_sites', {'paris': None, 'lyon': None}):
+            with self.assertRaises(kopf.PermanentError):
+                main.resolve_site(None)
+            with self.assertRaises(kopf.PermanentError):
+                main.resolve_site('nice')
+            with self.assertRaises(kopf.PermanentError):
+                main.get_vcd_session('nice')
+
+
+if __name__ == '__main__':
+    unittest.main()
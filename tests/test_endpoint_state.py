@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+"""Tests for the operator level view of the circuit breakers state."""
+
+
+import threading
+import unittest
+from unittest import mock
+
+from kubernetes.client.rest import ApiException
+
+from kvcd import endpoint_state
+from kvcd.endpoint_state import EndpointStatePublisher
+from kvcd.vmware.vcloud_breaker import BreakerState, CircuitBreaker
+
+
+class TestEndpointStatePublisher(unittest.TestCase):
+    """Tests for `EndpointStatePublisher`."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.writes = []
+        self.failures = []
+        self.written = threading.Event()
+        patcher = mock.patch('kvcd.endpoint_state.set_config_map_data', self._write)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(endpoint_state, 'RETRY_DELAY', 0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.publisher = EndpointStatePublisher('kvcd-endpoints')
+        self.addCleanup(self.publisher.stop, 5)
+
+    def _write(self, namespace, name, data):
+        if self.failures:
+            raise self.failures.pop(0)
+        self.writes.append((namespace, name, {k: v for k, v in data.items() if not k.endswith('.since')}))
+        self.written.set()
+
+    def test_000_written_once_leading(self):
+        """The states recorded before the start are written at once, the latest by site."""
+        self.publisher.notify('paris', BreakerState.DEGRADED)
+        self.publisher.notify('paris', BreakerState.OPEN)
+        self.publisher.notify('lyon', BreakerState.CLOSED)
+        self.assertEqual(self.writes, [])
+        self.publisher.start('kvcd-system')
+        self.publisher.stop(5)
+        self.assertEqual(self.writes, [('kvcd-system', 'kvcd-endpoints', {'paris': 'open', 'lyon': 'closed'})])
+
+    def test_001_failed_write_retried(self):
+        """A failed write is retried, merged with the newer states."""
+        self.failures.append(ApiException(status=500))
+        self.publisher.notify('paris', BreakerState.OPEN)
+        self.publisher.start('kvcd-system')
+        self.assertTrue(self.written.wait(5))
+        self.assertEqual(self.writes, [('kvcd-system', 'kvcd-endpoints', {'paris': 'open'})])
+
+    def test_002_breaker_transitions(self):
+        """A breaker reports its initial state and its transitions only."""
+        notify = mock.Mock()
+        breaker = CircuitBreaker('paris', min_calls=1, on_transition=notify)
+        breaker.record(success=True, duration=0)
+        breaker.record(success=False, duration=0)
+        breaker.record(success=False, duration=0)
+        self.assertEqual(notify.call_args_list, [
+            mock.call('paris', BreakerState.CLOSED),
+            mock.call('paris', BreakerState.OPEN),
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,9 +3,12 @@
 """Tests for `kvcd` package."""
 
 
+import os
+import subprocess
+import sys
 import unittest
 
-from kvcd import kvcd
+import kvcd
 
 
 class TestKvcd(unittest.TestCase):
@@ -19,3 +22,26 @@ class TestKvcd(unittest.TestCase):
 
     def test_000_something(self):
         """Test something."""
+
+    def test_001_version(self):
+        """The package has a version."""
+        self.assertTrue(kvcd.__version__)
+
+    def test_002_modules(self):
+        """Every kvcd module registers handlers."""
+        self.assertEqual(kvcd._available_modules, list(kvcd._handler_modules))
+        for modules in kvcd._handler_modules.values():
+            self.assertTrue(modules)
+
+    def test_003_optional_subsystems_not_imported(self):
+        """The optional subsystems are only imported when configured."""
+        env = dict(os.environ, KVCD_VCD_HOST='vcd.test', KVCD_VCD_ORG='test', KVCD_VCD_USERNAME='test',
+                   KVCD_VCD_PASSWORD='test', KVCD_ENABLED_MODULES='')
+        for name in ('KVCD_LEADER_ENABLED', 'KVCD_PROFILING_SIGNAL', 'KVCD_PROFILING_PORT',
+                     'KVCD_TRAFFIC_RECORD_FILE', 'KVCD_TRAFFIC_REPLAY_FILE'):
+            env.pop(name, None)
+        code = ("import sys, kvcd.main; "
+                "print(' '.join(m for m in ('kvcd.profiling', 'kvcd.leader', 'kvcd.vmware.vcloud_traffic', "
+                "'kvcd.vmware.vcloud_standby') if m in sys.modules))")
+        imported = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+        self.assertEqual(imported.stdout.strip(), '')
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+"""Tests for the leader election of the operator replicas."""
+
+
+import time
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from kubernetes.client import V1Lease, V1LeaseSpec, V1ObjectMeta
+from kubernetes.client.rest import ApiException
+
+from kvcd.kube_helper import MicroTimeApiClient, micro_time
+from kvcd.leader import LeaderElector
+
+
+class TestLeaderElector(unittest.TestCase):
+    """Tests for `LeaderElector`."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.kube = {}
+        for helper in ('read_lease', 'create_lease', 'replace_lease', 'patch_pod_labels'):
+            patcher = mock.patch(f'kvcd.leader.{helper}')
+            self.kube[helper] = patcher.start()
+            self.addCleanup(patcher.stop)
+        self.on_lost = mock.Mock()
+        self.elector = LeaderElector('kvcd-leader', namespace='kvcd-system', identity='kvcd-0',
+                                     lease_duration=15, renew_interval=0.01, on_lost=self.on_lost,
+                                     pod_label='kvcd-leader')
+
+    def _lease(self, holder: str, renewed_ago: float, transitions: int = 0):
+        renew_time = datetime.now(timezone.utc) - timedelta(seconds=renewed_ago)
+        return V1Lease(
+            metadata=V1ObjectMeta(name='kvcd-leader', namespace='kvcd-system'),
+            spec=V1LeaseSpec(holder_identity=holder, lease_duration_seconds=15, acquire_time=renew_time,
+                             renew_time=renew_time, lease_transitions=transitions))
+
+    def test_000_missing_lease_is_created(self):
+        """A missing lease is created, held by this replica."""
+        self.kube['read_lease'].side_effect = ApiException(status=404)
+        self.assertTrue(self.elector._try_acquire_or_renew())
+        namespace, name, spec = self.kube['create_lease'].call_args[0]
+        self.assertEqual((namespace, name), ('kvcd-system', 'kvcd-leader'))
+        self.assertEqual(spec['holderIdentity'], 'kvcd-0')
+        self.assertEqual(spec['acquireTime'], spec['renewTime'])
+        self.assertRegex(spec['renewTime'], r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{6}Z$')
+
+    def test_001_lease_created_meanwhile(self):
+        """A lease created by another replica meanwhile is not taken."""
+        self.kube['read_lease'].side_effect = ApiException(status=404)
+        self.kube['create_lease'].side_effect = ApiException(status=409)
+        self.assertFalse(self.elector._try_acquire_or_renew())
+
+    def test_002_held_lease_is_not_taken(self):
+        """A lease renewed by another replica is not taken."""
+        self.kube['read_lease'].return_value = self._lease('kvcd-1', renewed_ago=5)
+        self.assertFalse(self.elector._try_acquire_or_renew())
+        self.kube['replace_lease'].assert_not_called()
+
+    def test_003_expired_lease_is_taken_over(self):
+        """An expired lease is taken over, as a new transition."""
+        self.kube['read_lease'].return_value = self._lease('kvcd-1', renewed_ago=30, transitions=2)
+        self.assertTrue(self.elector._try_acquire_or_renew())
+        spec = self.kube['replace_lease'].call_args[0][0].spec
+        self.assertEqual(spec.holder_identity, 'kvcd-0')
+        self.assertEqual(spec.lease_transitions, 3)
+
+    def test_004_own_lease_is_renewed(self):
+        """The lease held by this replica is renewed, without a new transition."""
+        self.kube['read_lease'].return_value = self._lease('kvcd-0', renewed_ago=5, transitions=2)
+        self.assertTrue(self.elector._try_acquire_or_renew())
+        spec = self.kube['replace_lease'].call_args[0][0].spec
+        self.assertEqual(spec.lease_transitions, 2)
+        self.assertLess(datetime.now(timezone.utc) - spec.renew_time, timedelta(seconds=5))
+
+    def test_005_conflict_on_replace(self):
+        """A lease changed by another replica meanwhile is not taken."""
+        self.kube['read_lease'].return_value = self._lease('kvcd-1', renewed_ago=30)
+        self.kube['replace_lease'].side_effect = ApiException(status=409)
+        self.assertFalse(self.elector._try_acquire_or_renew())
+
+    def test_006_leadership_lost(self):
+        """The loss of the leadership removes the pod label and calls `on_lost`."""
+        self.kube['read_lease'].side_effect = [
+            self._lease('kvcd-0', renewed_ago=1),
+            self._lease('kvcd-1', renewed_ago=0),
+        ]
+        self.elector._run()
+        self.on_lost.assert_called_once_with()
+        self.assertFalse(self.elector.is_leader.is_set())
+        self.assertEqual(self.kube['patch_pod_labels'].call_args_list, [
+            mock.call('kvcd-system', 'kvcd-0', {'kvcd-leader': 'true'}),
+            mock.call('kvcd-system', 'kvcd-0', {'kvcd-leader': None}),
+        ])
+
+    def test_007_leadership_kept_on_transient_error(self):
+        """The leadership is kept while the lease cannot have been taken over."""
+        self.elector.is_leader.set()
+        self.elector._renewed_at = time.monotonic()
+        self.kube['read_lease'].side_effect = ApiException(status=500)
+
+        def _wait(timeout):
+            self.elector._stopping.set()  # a single renewal attempt
+        with mock.patch.object(self.elector._stopping, 'wait', _wait):
+            self.elector._run()
+        self.on_lost.assert_not_called()
+        self.assertTrue(self.elector.is_leader.is_set())
+
+    def test_008_stop_releases_the_lease(self):
+        """Stopping the leader releases the lease and removes the pod label."""
+        self.elector.is_leader.set()
+        self.elector._labeled = True
+        lease = self._lease('kvcd-0', renewed_ago=1)
+        self.kube['read_lease'].return_value = lease
+        self.elector.stop()
+        self.assertIsNone(self.kube['replace_lease'].call_args[0][0].spec.holder_identity)
+        self.kube['patch_pod_labels'].assert_called_once_with('kvcd-system', 'kvcd-0', {'kvcd-leader': None})
+        self.assertFalse(self.elector.is_leader.is_set())
+
+    def test_009_micro_time(self):
+        """The lease times are sent as UTC MicroTimes, with their microseconds even when 0."""
+        when = datetime(2021, 1, 1, 2, 0, tzinfo=timezone(timedelta(hours=2)))
+        self.assertEqual(micro_time(when), '2021-01-01T00:00:00.000000Z')
+        lease = self._lease('kvcd-0', renewed_ago=0)
+        lease.spec.renew_time = when
+        spec = MicroTimeApiClient().sanitize_for_serialization(lease)['spec']
+        self.assertEqual(spec['renewTime'], '2021-01-01T00:00:00.000000Z')
+        self.assertRegex(spec['acquireTime'], r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{6}Z$')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+"""Tests for the leak checks of the soak benchmark."""
+
+
+import atexit
+import os
+import sys
+import threading
+import unittest
+from unittest import mock
+
+# kvcd.main reads its configuration at import
+for _name, _value in (('KVCD_VCD_HOST', 'vcd.test'), ('KVCD_VCD_ORG', 'test'), ('KVCD_VCD_USERNAME', 'test'),
+                      ('KVCD_VCD_PASSWORD', 'test'), ('KVCD_ENABLED_MODULES', '')):
+    os.environ.setdefault(_name, _value)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import soak  # noqa: E402
+from fake_vcd import FakeVcd  # noqa: E402
+
+from kvcd import main  # noqa: E402
+
+
+# Indicators without any allowed growth
+BOUNDS = {'threads': 0, 'atexit': 0, 'vcd_sessions': 0, 'transports': 0}
+
+
+class TestSoak(unittest.TestCase):
+    """Tests for a short soak run."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        site = main.vcd_sites[soak.SITE]
+        self.vcd = FakeVcd(host=site.host, org=site.org, user=site.username, port=site.port)
+        for patcher in (mock.patch('kvcd.status_writer.patch_custom_object'),
+                        mock.patch.object(main.status_writer, 'qps', 0),
+                        mock.patch.dict(main.vcd_traffic),
+                        mock.patch.dict(main.vcd_sessions, clear=True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.soak = soak.Soak(self.vcd, vapps=4, churn=0.5, drift=0.5)
+        self.soak.start()
+        self.addCleanup(self.soak.vcd_session.close)
+        self.addCleanup(self.soak.stop)
+        self.soak.create(4)
+
+    def _cycles(self, count: int):
+        for _ in range(count):
+            self.soak.cycle()
+        return soak.sample(self.vcd)
+
+    def test_000_no_leak(self):
+        """A soak run without leak stays within the bounds."""
+        baseline = self._cycles(2)
+        self.soak.refresh_session()
+        self.assertEqual(soak.check_growth(baseline, self._cycles(3), BOUNDS), [])
+
+    def test_001_seeded_leak(self):
+        """A leaked thread, atexit handler and vCD session are reported."""
+        baseline = self._cycles(2)
+        stop = threading.Event()
+        self.addCleanup(stop.set)
+        threading.Thread(target=stop.wait, daemon=True).start()
+
+        def _handler():
+            pass
+
+        atexit.register(_handler)
+        self.addCleanup(atexit.unregister, _handler)
+        leaked = main.create_vcdsession(soak.SITE, main.vcd_sites[soak.SITE])
+        self.addCleanup(leaked.close)
+        failures = soak.check_growth(baseline, self._cycles(1), BOUNDS)
+        self.assertEqual([failure.split(':')[0] for failure in failures],
+                         ['threads', 'atexit', 'vcd_sessions', 'transports'])
+
+
+if __name__ == '__main__':
+    unittest.main()
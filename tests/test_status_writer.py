@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+"""Tests for the batched writer of the kvcd objects status."""
+
+
+import unittest
+from unittest import mock
+
+from kubernetes.client.rest import ApiException
+
+from kvcd.status_writer import StatusWriter, deep_merge
+
+
+class TestDeepMerge(unittest.TestCase):
+    """Tests for `deep_merge`."""
+
+    def test_000_nested(self):
+        """The nested dictionaries are merged, the other values replaced."""
+        target = {'backing': {'status': 'POWERED_OFF', 'vcd_vapp_href': 'href'}, 'retry': {'attempt': 1}}
+        deep_merge(target, {'backing': {'status': 'POWERED_ON'}, 'retry': None})
+        self.assertEqual(target, {'backing': {'status': 'POWERED_ON', 'vcd_vapp_href': 'href'}, 'retry': None})
+
+
+class TestStatusWriter(unittest.TestCase):
+    """Tests for `StatusWriter`."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.calls = []
+        self.failures = {}  # object name -> errors to raise, in order
+        patcher = mock.patch('kvcd.status_writer.patch_custom_object', self._patch)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('kvcd.status_writer.RETRY_DELAY', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.writer = StatusWriter(qps=0, burst=1, max_attempts=3)
+
+    def _patch(self, plural, namespace, name, body):
+        self.calls.append((name, body['status']))
+        errors = self.failures.get(name)
+        if errors:
+            raise errors.pop(0)
+
+    def _flush(self):
+        self.writer.start()
+        self.writer.stop(timeout=5)
+        self.assertEqual(self.writer.depth(), 0)
+
+    def test_000_updates_are_merged(self):
+        """The updates of one object waiting together are written at once."""
+        self.writer.submit('kvcdvapps', 'default', 'a', {'backing': {'status': 'POWERED_OFF', 'vcd_vapp_href': 'h'}})
+        self.writer.submit('kvcdvapps', 'default', 'a', {'backing': {'status': 'POWERED_ON'}})
+        self.assertEqual(self.writer.depth(), 1)
+        self._flush()
+        self.assertEqual(self.calls, [('a', {'backing': {'status': 'POWERED_ON', 'vcd_vapp_href': 'h'}})])
+
+    def test_001_urgent_first(self):
+        """The urgent updates are written before the others."""
+        self.writer.submit('kvcdvapps', 'default', 'a', {'x': 1})
+        self.writer.submit('kvcdvapps', 'default', 'b', {'x': 2}, urgent=True)
+        self._flush()
+        self.assertEqual([name for name, _ in self.calls], ['b', 'a'])
+
+    def test_002_rejected_update_is_dropped(self):
+        """An update rejected by the API is dropped at once, without holding the others."""
+        self.failures['a'] = [ApiException(status=422, reason='Unprocessable Entity')]
+        self.writer.submit('kvcdvapps', 'default', 'a', {'x': 1})
+        self.writer.submit('kvcdvapps', 'default', 'b', {'x': 2})
+        self._flush()
+        self.assertEqual([name for name, _ in self.calls], ['a', 'b'])
+
+    def test_003_deleted_object_is_dropped(self):
+        """The update of a deleted object is dropped."""
+        self.failures['a'] = [ApiException(status=404, reason='Not Found')]
+        self.writer.submit('kvcdvapps', 'default', 'a', {'x': 1})
+        self._flush()
+        self.assertEqual([name for name, _ in self.calls], ['a'])
+
+    def test_004_failed_update_is_retried_behind(self):
+        """A failed update is written again after the other objects."""
+        self.failures['a'] = [ApiException(status=500, reason='Internal Server Error')]
+        self.writer.submit('kvcdvapps', 'default', 'a', {'x': 1})
+        self.writer.submit('kvcdvapps', 'default', 'b', {'x': 2})
+        self._flush()
+        self.assertEqual([name for name, _ in self.calls], ['a', 'b', 'a'])
+
+    def test_005_throttled_update_is_retried(self):
+        """A throttled update is retried."""
+        self.failures['a'] = [ApiException(status=429, reason='Too Many Requests')]
+        self.writer.submit('kvcdvapps', 'default', 'a', {'x': 1})
+        self._flush()
+        self.assertEqual([name for name, _ in self.calls], ['a', 'a'])
+
+    def test_006_dropped_after_max_attempts(self):
+        """An update failing again and again is dropped after the maximum number of attempts."""
+        self.failures['a'] = [ConnectionError('unreachable')] * 10
+        self.writer.submit('kvcdvapps', 'default', 'a', {'x': 1})
+        self._flush()
+        self.assertEqual([name for name, _ in self.calls], ['a'] * 3)
+
+    def test_007_newer_update_merged_over_failed_one(self):
+        """An update received during a failed write is merged over it."""
+        key = ('kvcdvapps', 'default', 'a')
+        self.writer.submit(*key, {'x': 1, 'y': 1})
+        with self.writer._cond:
+            _, pending = self.writer._pop()
+        self.writer.submit(*key, {'y': 2})
+        self.assertTrue(self.writer._requeue(key, pending))
+        self.assertEqual(self.writer._pending[key].status, {'x': 1, 'y': 2})
+        self.assertEqual(self.writer._pending[key].attempts, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+"""Tests for the circuit breaker of the vCD endpoint."""
+
+
+import unittest
+from unittest import mock
+
+from kvcd.vmware.vcloud_breaker import BreakerState, CircuitBreaker, CircuitOpenError, is_failure_status
+from kvcd.vmware.vcloud_scheduler import Priority
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    """Tests for `CircuitBreaker`."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.now = 1000.0
+        patcher = mock.patch('kvcd.vmware.vcloud_breaker.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker(
+            'test', window=60, min_calls=10, degraded_error_rate=0.2, open_error_rate=0.5,
+            slow_call_duration=10, open_duration=30, half_open_probes=2)
+
+    def _record(self, successes: int, failures: int):
+        for _ in range(successes):
+            self.breaker.record(success=True, duration=0.1)
+        for _ in range(failures):
+            self.breaker.record(success=False, duration=0.1)
+
+    def test_000_closed_admits_everything(self):
+        """A closed breaker admits every priority class."""
+        self._record(20, 0)
+        self.assertEqual(self.breaker.state, BreakerState.CLOSED)
+        for priority in Priority:
+            self.breaker.admit(priority)
+
+    def test_001_not_enough_calls(self):
+        """The error rate is not evaluated under the minimum number of calls."""
+        self._record(0, 9)
+        self.assertEqual(self.breaker.error_rate(), 0)
+        self.assertEqual(self.breaker.state, BreakerState.CLOSED)
+
+    def test_002_degraded_sheds_the_refreshes(self):
+        """A degraded breaker sheds the background refreshes only."""
+        self._record(7, 3)
+        self.assertEqual(self.breaker.state, BreakerState.DEGRADED)
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.admit(Priority.REFRESH)
+        self.breaker.admit(Priority.RECONCILE)
+        self.breaker.admit(Priority.LIFECYCLE)
+
+    def test_003_open_sheds_everything(self):
+        """An open breaker sheds all the work, with the remaining open duration as delay."""
+        self._record(5, 5)
+        self.assertEqual(self.breaker.state, BreakerState.OPEN)
+        self.now += 10
+        with self.assertRaises(CircuitOpenError) as raised:
+            self.breaker.admit(Priority.LIFECYCLE)
+        self.assertEqual(raised.exception.delay, 20)
+
+    def test_004_slow_calls_are_errors(self):
+        """A call slower than the slow call duration counts as an error."""
+        for _ in range(10):
+            self.breaker.record(success=True, duration=11)
+        self.assertEqual(self.breaker.state, BreakerState.OPEN)
+
+    def test_005_half_open_probes_close(self):
+        """After the open duration, successful probes close the breaker."""
+        self._record(5, 5)
+        self.now += 31
+        self.assertEqual(self.breaker.state, BreakerState.HALF_OPEN)
+        probes = [self.breaker.admit(Priority.REFRESH), self.breaker.admit(Priority.REFRESH)]
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.admit(Priority.REFRESH)  # no probe left
+        self._record(2, 0)
+        for probe in probes:
+            self.breaker.probe_done(probe, True)
+        self.assertEqual(self.breaker.state, BreakerState.CLOSED)
+
+    def test_006_half_open_failure_opens(self):
+        """A failed probe opens the breaker again."""
+        self._record(5, 5)
+        self.now += 31
+        self.breaker.admit(Priority.LIFECYCLE)
+        self._record(0, 1)
+        self.assertEqual(self.breaker.state, BreakerState.OPEN)
+
+    def test_007_degraded_recovers(self):
+        """A degraded breaker closes once the error rate is low again."""
+        self._record(7, 3)
+        self.assertEqual(self.breaker.state, BreakerState.DEGRADED)
+        self.now += 61  # the errors leave the window
+        self._record(10, 0)
+        self.assertEqual(self.breaker.state, BreakerState.CLOSED)
+
+    def test_008_probes_counted_by_unit_of_work(self):
+        """The requests of one probe do not close the breaker on their own."""
+        self._record(5, 5)
+        self.now += 31
+        probe = self.breaker.admit(Priority.RECONCILE)
+        self._record(3, 0)
+        self.assertEqual(self.breaker.state, BreakerState.HALF_OPEN)
+        self.breaker.probe_done(probe, True)
+        self.assertEqual(self.breaker.state, BreakerState.HALF_OPEN)
+
+    def test_009_unfinished_probe_frees_its_place(self):
+        """A probe whose work did not complete lets another probe through."""
+        self._record(5, 5)
+        self.now += 31
+        probes = [self.breaker.admit(Priority.REFRESH), self.breaker.admit(Priority.REFRESH)]
+        self.breaker.probe_done(probes[0], False)
+        self.breaker.probe_done(self.breaker.admit(Priority.REFRESH), True)
+        self.breaker.probe_done(probes[1], True)
+        self.assertEqual(self.breaker.state, BreakerState.CLOSED)
+
+    def test_010_stale_probe_ignored(self):
+        """The probe of a previous half-open round is not counted."""
+        self._record(5, 5)
+        self.now += 31
+        stale = self.breaker.admit(Priority.REFRESH)
+        self._record(0, 1)
+        self.now += 31
+        self.assertEqual(self.breaker.state, BreakerState.HALF_OPEN)
+        self.breaker.probe_done(stale, True)
+        self.breaker.probe_done(self.breaker.admit(Priority.REFRESH), True)
+        self.assertEqual(self.breaker.state, BreakerState.HALF_OPEN)
+
+
+class TestIsFailureStatus(unittest.TestCase):
+    """Tests for `is_failure_status`."""
+
+    def test_000_throttling(self):
+        """The server errors and the throttling responses are failures."""
+        for status_code in (429, 500, 503, 504):
+            self.assertTrue(is_failure_status(status_code))
+        for status_code in (200, 204, 400, 403, 404):
+            self.assertFalse(is_failure_status(status_code))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+"""Tests for the inventories of a Cloud Director instance."""
+
+
+import re
+import threading
+import unittest
+
+from lxml import etree
+
+from kvcd.vmware.vcloud_inventory import VappIndex, VmInventory
+
+
+VDC_HREF = 'https://vcd/api/vdc/1'
+
+
+def vapp_href(uuid: str):
+    return f'https://vcd/api/vApp/vapp-{uuid}'
+
+
+class FakeClient:
+    """pyvcloud client answering the vApp queries from a list of records."""
+
+    def __init__(self, vapps: dict):
+        self.vapps = vapps  # name -> uuid
+        self.queries = []
+        self.fail = False
+
+    def is_sysadmin(self):
+        return False
+
+    def get_typed_query(self, query_type, query_result_format, page_size, qfilter=None, equality_filter=None):
+        self.queries.append(equality_filter)
+        if self.fail:
+            raise ConnectionError('vCD unreachable')
+        records = [etree.Element('VAppRecord', name=name, href=vapp_href(uuid), status='POWERED_OFF',
+                                 isDeployed='false', ownerName='alice')
+                   for name, uuid in self.vapps.items()]
+        if equality_filter is not None and equality_filter[0] == 'name':
+            # Like vCD: not an exact match
+            records = [r for r in records if r.get('name').lower().startswith(equality_filter[1].lower())]
+        return type('Query', (), {'execute': lambda self: iter(records)})()
+
+
+class TestVappIndex(unittest.TestCase):
+    """Tests for `VappIndex`."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.client = FakeClient({'a': '1', 'b': '2'})
+        self.index = VappIndex(self.client, max_age=60)
+
+    def test_000_snapshot(self):
+        """The vApps of a VDC are found by name and href from one query."""
+        self.assertEqual(self.index.get(VDC_HREF, 'a')['href'], vapp_href('1'))
+        self.assertEqual(self.index.get_by_href(VDC_HREF, vapp_href('2'))['name'], 'b')
+        self.assertEqual(self.index.get_by_href(VDC_HREF, vapp_href('2'))['owner'], 'alice')
+        self.assertIsNone(self.index.get(VDC_HREF, 'c'))
+        self.assertEqual(self.client.queries, [None])
+
+    def test_001_lookup_by_name(self):
+        """A missing vApp is queried by name, matched exactly, and indexed."""
+        self.index.refresh(VDC_HREF)
+        self.client.vapps.update({'c': '3', 'cc': '4'})
+        self.assertEqual(self.index.get(VDC_HREF, 'c', refresh_missing=True)['href'], vapp_href('3'))
+        self.assertEqual(self.client.queries[-1], ('name', 'c'))
+        self.assertEqual(self.index.get(VDC_HREF, 'c')['href'], vapp_href('3'))
+        self.assertEqual(len(self.client.queries), 2)
+
+    def test_002_lookup_by_href(self):
+        """A missing vApp is queried by the id of its href, and matched on its href."""
+        self.index.refresh(VDC_HREF)
+        self.client.vapps['c'] = '3'
+        self.assertEqual(self.index.get_by_href(VDC_HREF, vapp_href('3'), refresh_missing=True)['name'], 'c')
+        self.assertEqual(self.client.queries[-1], ('id', 'urn:vcloud:vapp:3'))
+        # The other records of an unfiltered answer do not match
+        self.assertIsNone(self.index.get_by_href(VDC_HREF, vapp_href('9'), refresh_missing=True))
+
+    def test_003_operator_mutations(self):
+        """The vApps created, renamed, updated and deleted by the operator are indexed at once."""
+        self.index.refresh(VDC_HREF)
+        self.index.add(VDC_HREF, 'c', vapp_href('3'), status='POWERED_ON', deployed=True, owner='bob')
+        self.assertEqual(self.index.get(VDC_HREF, 'c')['owner'], 'bob')
+        self.index.add(VDC_HREF, 'd', vapp_href('3'))
+        self.assertIsNone(self.index.get(VDC_HREF, 'c'))
+        self.index.update(vapp_href('3'), deployed=True)
+        self.assertTrue(self.index.get(VDC_HREF, 'd')['deployed'])
+        self.index.remove(vapp_href('3'))
+        self.assertIsNone(self.index.get_by_href(VDC_HREF, vapp_href('3')))
+        self.assertEqual(len(self.client.queries), 1)
+
+    def test_004_failed_query(self):
+        """A failed query keeps the previous snapshot, and fails without one."""
+        self.client.fail = True
+        with self.assertRaises(ConnectionError):
+            self.index.get(VDC_HREF, 'a')
+        self.client.fail = False
+        self.index.refresh(VDC_HREF)
+        self.client.fail = True
+        self.assertEqual(self.index.refresh(VDC_HREF), 2)
+
+
+class FakeVmClient:
+    """pyvcloud client answering the VM queries with one VM per vApp."""
+
+    def __init__(self):
+        self.queries = []
+        self.fail = False
+        self.blocked = None  # event the single vApp queries wait for
+        self.querying = threading.Event()
+
+    def is_sysadmin(self):
+        return False
+
+    def get_typed_query(self, query_type, query_result_format, page_size, qfilter=None):
+        containers = re.findall(r'container==([^,)]+)', qfilter)
+        self.queries.append(containers)
+        if self.blocked is not None and len(containers) == 1:
+            self.querying.set()
+            self.blocked.wait(5)
+        if self.fail:
+            raise ConnectionError('vCD unreachable')
+        records = [etree.Element('VMRecord', name=f"vm-{href.rsplit('-', 1)[-1]}", container=href,
+                                 status='POWERED_OFF', numberOfCpus='2')
+                   for href in containers]
+        return type('Query', (), {'execute': lambda self: iter(records)})()
+
+
+class TestVmInventory(unittest.TestCase):
+    """Tests for `VmInventory`."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.client = FakeVmClient()
+        self.inventory = VmInventory(self.client, max_age=60)
+        self.inventory.watch([vapp_href('1'), vapp_href('2')])
+        self.inventory.refresh()
+
+    def test_000_snapshot(self):
+        """The VMs of the watched vApps are read from one snapshot."""
+        self.assertEqual([vm['name'] for vm in self.inventory.get(vapp_href('1'))], ['vm-1'])
+        self.assertEqual(self.inventory.get(vapp_href('2'))[0]['numberOfCpus'], 2)
+        self.assertEqual(self.client.queries, [[vapp_href('1'), vapp_href('2')]])
+
+    def test_001_unwatched_vapp(self):
+        """A vApp not watched yet is queried alone, then read from the snapshot."""
+        self.assertEqual(self.inventory.get(vapp_href('3'))[0]['name'], 'vm-3')
+        self.assertEqual(self.client.queries[-1], [vapp_href('3')])
+        self.assertEqual(self.inventory.get(vapp_href('3'))[0]['name'], 'vm-3')
+        self.assertEqual(len(self.client.queries), 2)
+        self.inventory.refresh(force=True)
+        self.assertEqual(self.client.queries[-1], [vapp_href('1'), vapp_href('2'), vapp_href('3')])
+
+    def test_002_query_outside_the_lock(self):
+        """The snapshot stays readable while a vApp is queried alone."""
+        self.client.blocked = threading.Event()
+        results = {}
+        thread = threading.Thread(target=lambda: results.update(vms=self.inventory.get(vapp_href('3'))))
+        thread.start()
+        try:
+            self.assertTrue(self.client.querying.wait(5))
+            self.assertEqual(self.inventory.get(vapp_href('1'))[0]['name'], 'vm-1')
+            self.assertTrue(thread.is_alive())
+        finally:
+            self.client.blocked.set()
+            thread.join(5)
+        self.assertEqual(results['vms'][0]['name'], 'vm-3')
+
+    def test_003_failed_query(self):
+        """A failed query keeps the snapshot, and its vApp has no VM details."""
+        self.client.fail = True
+        self.assertIsNone(self.inventory.get(vapp_href('3')))
+        self.inventory.refresh(force=True)
+        self.client.fail = False
+        self.assertEqual(self.inventory.get(vapp_href('1'))[0]['name'], 'vm-1')
+
+
+if __name__ == '__main__':
+    unittest.main()
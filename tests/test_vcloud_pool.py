@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+"""Tests for the warm pools of vApps."""
+
+
+import os
+import threading
+import types
+import unittest
+import uuid
+from datetime import datetime, timezone
+from unittest import mock
+
+from kubernetes.client.rest import ApiException
+from lxml import etree
+
+# kvcd.main reads its configuration at import
+for _name, _value in (('KVCD_VCD_HOST', 'vcd.test'), ('KVCD_VCD_ORG', 'test'), ('KVCD_VCD_USERNAME', 'test'),
+                      ('KVCD_VCD_PASSWORD', 'test'), ('KVCD_ENABLED_MODULES', '')):
+    os.environ.setdefault(_name, _value)
+
+from kvcd.vmware.vcloud_pool import PoolManager, VappPool, claim_pool_vapp  # noqa: E402
+
+
+VDC_HREF = 'https://vcd/api/vdc/1'
+
+
+class FakePoolVcd:
+    """vApps of an Org VDC and claim leases, shared by the claimers."""
+
+    def __init__(self):
+        self.vapps = {}  # href -> [name, status]
+        self.leases = {}  # name -> lease spec
+        self.renames = []
+        self.lock = threading.Lock()
+        self.barrier = None  # to line up the claimers after their query
+
+    def add(self, name: str, status: str = 'POWERED_OFF'):
+        href = f'https://vcd/api/vApp/vapp-{uuid.uuid4()}'
+        self.vapps[href] = [name, status]
+        return href
+
+    def list_pool_vapps(self, vcd_session, pool, vdc_href):
+        with self.lock:
+            records = [etree.Element('VAppRecord', name=name, href=href, status=status)
+                       for href, (name, status) in self.vapps.items() if name.startswith(pool.name_prefix)]
+        if self.barrier is not None:
+            self.barrier.wait(5)
+        return records
+
+    def vapp(self, client, href):
+        def _rename(name, description):
+            with self.lock:
+                self.vapps[href][0] = name
+                self.renames.append((href, name))
+            return {'status': 'success'}
+
+        return mock.Mock(get_resource=lambda: etree.Element('VApp', name=self.vapps[href][0]),
+                         edit_name_and_description=_rename)
+
+    def create_lease(self, namespace, name, spec):
+        with self.lock:
+            if name in self.leases:
+                raise ApiException(status=409)
+            self.leases[name] = types.SimpleNamespace(
+                holder_identity=spec['holderIdentity'], lease_duration_seconds=spec['leaseDurationSeconds'],
+                acquire_time=datetime.now(timezone.utc), renew_time=datetime.now(timezone.utc))
+
+    def read_lease(self, namespace, name):
+        with self.lock:
+            return types.SimpleNamespace(spec=self.leases[name])
+
+    def delete_lease(self, namespace, name):
+        with self.lock:
+            self.leases.pop(name, None)
+
+
+class PoolTestCase(unittest.TestCase):
+    """Fake vCD and claim leases for the pool tests."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.vcd = FakePoolVcd()
+        self.manager = PoolManager([], concurrency=2, interval=60)
+        for name, value in (('list_pool_vapps', self.vcd.list_pool_vapps),
+                            ('VApp', self.vcd.vapp),
+                            ('wait_for_task', lambda vcd_session, task: task),
+                            ('create_lease', self.vcd.create_lease),
+                            ('read_lease', self.vcd.read_lease),
+                            ('delete_lease', self.vcd.delete_lease),
+                            ('current_namespace', lambda: 'default'),
+                            ('vapp_pools', self.manager)):
+            patcher = mock.patch(f'kvcd.vmware.vcloud_pool.{name}', value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _pool(self, size: int = 2):
+        return VappPool('org', 'vdc', 'catalog', 'ubuntu', size)
+
+
+class TestClaim(PoolTestCase):
+    """Tests for `claim_pool_vapp`."""
+
+    def test_000_claim(self):
+        """A ready vApp is claimed by renaming it, and the pool refill woken up."""
+        pool = self._pool()
+        href = self.vcd.add(f'{pool.name_prefix}a')
+        self.vcd.add(f'{pool.name_prefix}b', status='UNRESOLVED')
+        self.assertEqual(claim_pool_vapp(mock.Mock(), pool, mock.Mock(href=VDC_HREF), 'app', '', mock.Mock()), href)
+        self.assertEqual(self.vcd.renames, [(href, 'app')])
+        self.assertEqual(self.vcd.leases, {})
+        self.assertTrue(self.manager._wakeup.is_set())
+
+    def test_001_double_claim_race(self):
+        """Two claimers racing on the same ready vApp never both rename it."""
+        # Two replicas: one pool object each, sharing the vCD and the claim leases
+        pools = [self._pool(), self._pool()]
+        href = self.vcd.add(f'{pools[0].name_prefix}a')
+        self.vcd.barrier = threading.Barrier(2)
+        results = {}
+
+        def _claim(index):
+            results[index] = claim_pool_vapp(mock.Mock(), pools[index], mock.Mock(href=VDC_HREF),
+                                             f'app{index}', '', mock.Mock())
+
+        threads = [threading.Thread(target=_claim, args=(i,)) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(sorted(results.values(), key=str), [None, href])
+        self.assertEqual(len(self.vcd.renames), 1)
+        self.assertEqual(self.vcd.leases, {})
+
+    def test_002_claim_held_by_another(self):
+        """A vApp whose claim is held by another claimer is skipped."""
+        pool = self._pool()
+        href = self.vcd.add(f'{pool.name_prefix}a')
+        self.vcd.create_lease('default', f"kvcd-pool-claim-{href.rsplit('/', 1)[-1]}",
+                              {'holderIdentity': 'other', 'leaseDurationSeconds': 600})
+        self.assertIsNone(claim_pool_vapp(mock.Mock(), pool, mock.Mock(href=VDC_HREF), 'app', '', mock.Mock()))
+        self.assertEqual(self.vcd.renames, [])
+
+
+class TestRefill(PoolTestCase):
+    """Tests for `PoolManager.refill`."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        super().setUp()
+        for name, value in (('get_vcd_session', mock.Mock(return_value=mock.MagicMock())),
+                            ('get_vdc', mock.Mock(return_value=mock.Mock(href=VDC_HREF)))):
+            patcher = mock.patch(f'kvcd.vmware.vcloud_pool.{name}', value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.manager._executor = mock.Mock()
+
+    def _instantiated(self):
+        names = [call[0][4] for call in self.manager._executor.submit.call_args_list]
+        self.manager._executor.submit.reset_mock()
+        return names
+
+    def test_000_refill_after_claim(self):
+        """A claimed vApp leaves the pool, and is replaced once."""
+        pool = self._pool(size=2)
+        for suffix in 'ab':
+            self.vcd.add(f'{pool.name_prefix}{suffix}')
+        self.manager.refill(pool)
+        self.assertEqual(self._instantiated(), [])
+        claim_pool_vapp(mock.Mock(), pool, mock.Mock(href=VDC_HREF), 'app', '', mock.Mock())
+        self.manager.refill(pool)
+        names = self._instantiated()
+        self.assertEqual(len(names), 1)
+        self.assertTrue(names[0].startswith(pool.name_prefix))
+        # Listed by vCD as soon as its instantiation starts: not counted twice
+        self.vcd.add(names[0], status='UNRESOLVED')
+        self.manager.refill(pool)
+        self.assertEqual(self._instantiated(), [])
+
+    def test_001_instantiations_in_progress(self):
+        """The instantiations not listed by vCD yet are not started again."""
+        pool = self._pool(size=2)
+        self.manager.refill(pool)
+        self.assertEqual(len(self._instantiated()), 2)
+        self.manager.refill(pool)
+        self.assertEqual(self._instantiated(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+"""Tests for the bulk power operations on vApps."""
+
+
+import asyncio
+import os
+import unittest
+from unittest import mock
+
+# kvcd.main reads its configuration at import
+for _name, _value in (('KVCD_VCD_HOST', 'vcd.test'), ('KVCD_VCD_ORG', 'test'), ('KVCD_VCD_USERNAME', 'test'),
+                      ('KVCD_VCD_PASSWORD', 'test'), ('KVCD_ENABLED_MODULES', '')):
+    os.environ.setdefault(_name, _value)
+
+from kvcd.vmware import vcloud_power  # noqa: E402
+from kvcd.vmware.vcloud_vapp import (  # noqa: E402
+    BulkPowerOwners,
+    bulk_power_hrefs,
+    power_state_reached,
+    update_vcdvapp_power_state,
+)
+
+
+HREF = 'https://vcd/api/vApp/vapp-1'
+
+
+class TestBulkPowerOwners(unittest.TestCase):
+    """Tests for `BulkPowerOwners`."""
+
+    def test_000_reference_counted(self):
+        """A vApp stays owned until every owner released it."""
+        owners = BulkPowerOwners()
+        owners.acquire(HREF)
+        owners.acquire(HREF)
+        owners.release(HREF)
+        self.assertIn(HREF, owners)
+        owners.release(HREF)
+        self.assertNotIn(HREF, owners)
+        owners.release(HREF)
+        self.assertNotIn(HREF, owners)
+
+
+class TestPowerStateReached(unittest.TestCase):
+    """Tests for `power_state_reached`."""
+
+    def test_000_states(self):
+        """Only the statuses matching the expected state need no operation."""
+        self.assertTrue(power_state_reached('Powered on', True))
+        self.assertFalse(power_state_reached('Powered off', True))
+        self.assertFalse(power_state_reached('Suspended', True))
+        self.assertTrue(power_state_reached('Powered off', False))
+        self.assertTrue(power_state_reached('Deployed', False))
+        self.assertFalse(power_state_reached('Powered on', False))
+
+
+class TestUpdatePowerState(unittest.TestCase):
+    """Tests for the per-object power handler."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        patcher = mock.patch('kvcd.vmware.vcloud_vapp.get_vcd_session')
+        self.get_vcd_session = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _handle(self, status: str, powered_on: bool):
+        return update_vcdvapp_power_state(
+            old=None, new=None, status={'backing': {'vcd_vapp_href': HREF, 'status': status}},
+            spec={'powered_on': powered_on}, name='a', namespace='default', logger=mock.Mock(), retry=0)
+
+    def test_000_bulk_owned_is_a_noop(self):
+        """The handler stands back, without retry, while a bulk operation owns the vApp."""
+        bulk_power_hrefs.acquire(HREF)
+        self.addCleanup(bulk_power_hrefs.release, HREF)
+        self.assertIsNone(self._handle('Powered off', True))
+        self.get_vcd_session.assert_not_called()
+
+    def test_001_target_state_is_a_noop(self):
+        """The handler does nothing when the vApp is already in the expected state."""
+        self.assertIsNone(self._handle('Powered on', True))
+        self.get_vcd_session.assert_not_called()
+
+
+class TestBulkPower(unittest.TestCase):
+    """Tests for `bulk_power`."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.patched = []
+        self.reconciled = []
+        session = mock.Mock()
+        session.scheduler.run.side_effect = lambda priority, func, *args, **kwargs: func(*args, **kwargs)
+        for name, value in (('get_vcd_session', mock.Mock(return_value=session)),
+                            ('patch_custom_object', self._patch),
+                            ('vapp_reconcile_power_state', self._reconcile)):
+            patcher = mock.patch(f'kvcd.vmware.vcloud_power.{name}', value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _patch(self, plural, namespace, name, body):
+        self.patched.append((name, body, HREF in bulk_power_hrefs))
+
+    def _reconcile(self, vcd_session, vapp_href, expected_power_state, logger):
+        self.reconciled.append(vapp_href)
+        if vapp_href.endswith('broken'):
+            raise RuntimeError('broken')
+
+    def _run(self, targets: list, powered_on: bool = True):
+        return asyncio.run(vcloud_power.bulk_power(
+            targets, powered_on=powered_on, logger=mock.Mock(), concurrency=2, vdc_concurrency=1))
+
+    def test_000_owned_before_the_patch(self):
+        """The vApp is owned before its spec is patched, and released once processed."""
+        progress = self._run([{'name': 'a', 'namespace': 'default', 'vcd_vapp_href': HREF, 'powered_on': False}])
+        self.assertEqual(self.patched, [('a', {'spec': {'powered_on': True}}, True)])
+        self.assertEqual(self.reconciled, [HREF])
+        self.assertEqual(progress.as_dict()['succeeded'], 1)
+        self.assertNotIn(HREF, bulk_power_hrefs)
+
+    def test_001_overlapping_operations(self):
+        """A bulk operation does not release the vApps still owned by an overlapping one."""
+        bulk_power_hrefs.acquire(HREF)
+        try:
+            self._run([{'name': 'a', 'namespace': 'default', 'vcd_vapp_href': HREF, 'powered_on': True}])
+            self.assertIn(HREF, bulk_power_hrefs)
+        finally:
+            bulk_power_hrefs.release(HREF)
+        self.assertEqual(self.patched, [])
+
+    def test_002_failure_counted(self):
+        """A failure on one vApp is counted, and its ownership released."""
+        broken = HREF + '-broken'
+        progress = self._run([
+            {'name': 'a', 'namespace': 'default', 'vcd_vapp_href': HREF, 'powered_on': True},
+            {'name': 'b', 'namespace': 'default', 'vcd_vapp_href': broken, 'powered_on': True},
+        ])
+        self.assertEqual((progress.succeeded, progress.failed), (1, 1))
+        self.assertNotIn(broken, bulk_power_hrefs)
+
+
+if __name__ == '__main__':
+    unittest.main()
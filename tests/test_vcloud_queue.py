@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+"""Tests for the per-vApp operation queue."""
+
+
+import threading
+import time
+import unittest
+
+from kvcd.vmware.vcloud_queue import OperationWaitTimeout, VappOperationQueue
+
+
+HREF = 'https://vcd/api/vApp/vapp-1'
+
+
+class TestVappOperationQueue(unittest.TestCase):
+    """Tests for `VappOperationQueue`."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.queue = VappOperationQueue()
+
+    def _start(self, *args, **kwargs):
+        results = {}
+
+        def _run():
+            try:
+                results['result'] = self.queue.run(*args, **kwargs)
+            except Exception as e:
+                results['error'] = e
+        thread = threading.Thread(target=_run)
+        thread.start()
+        return thread, results
+
+    def _block(self, href: str = HREF):
+        """Queue an operation holding the vApp until the returned event is set."""
+        started, release = threading.Event(), threading.Event()
+
+        def _hold():
+            started.set()
+            release.wait()
+            return 'held'
+        thread, results = self._start(href, _hold)
+        self.assertTrue(started.wait(1))
+        return release, thread, results
+
+    def _wait_depth(self, depth: int, href: str = HREF):
+        deadline = time.monotonic() + 1
+        while self.queue.depth(href) != depth and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.queue.depth(href), depth)
+
+    def test_000_runs_on_the_caller_thread(self):
+        """An operation runs on the thread of its caller."""
+        result = self.queue.run(HREF, threading.current_thread)
+        self.assertIs(result, threading.current_thread())
+        self.assertEqual(self.queue.depth(HREF), 0)
+
+    def test_001_operations_run_in_order(self):
+        """The operations on one vApp run one after another, in order."""
+        release, holder, _ = self._block()
+        order = []
+        threads = []
+        for i in range(3):
+            threads.append(self._start(HREF, order.append, i)[0])
+            self._wait_depth(i + 1)
+        release.set()
+        for thread in [holder] + threads:
+            thread.join(1)
+        self.assertEqual(order, [0, 1, 2])
+        self.assertEqual(self.queue.depth(HREF), 0)
+
+    def test_002_vapps_run_in_parallel(self):
+        """An operation on another vApp does not wait."""
+        release, holder, _ = self._block()
+        self.assertEqual(self.queue.run('https://vcd/api/vApp/vapp-2', lambda: 'other'), 'other')
+        release.set()
+        holder.join(1)
+
+    def test_003_queued_operations_are_merged(self):
+        """A queued operation with the same merge key takes the arguments of the latest call."""
+        release, holder, _ = self._block()
+        calls = []
+
+        def _apply(value):
+            calls.append(value)
+            return value
+        first, first_results = self._start(HREF, _apply, 'old', merge_key='power_state')
+        self._wait_depth(1)
+        second, second_results = self._start(HREF, _apply, 'new', merge_key='power_state')
+        time.sleep(0.05)
+        self.assertEqual(self.queue.depth(HREF), 1)
+        release.set()
+        for thread in (holder, first, second):
+            thread.join(1)
+        self.assertEqual(calls, ['new'])
+        self.assertEqual(first_results, {'result': 'new'})
+        self.assertEqual(second_results, {'result': 'new'})
+
+    def test_004_running_operation_is_not_merged(self):
+        """An operation is not merged into a running one."""
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def _apply(value):
+            calls.append(value)
+            if value == 'running':
+                started.set()
+                release.wait()
+        running, _ = self._start(HREF, _apply, 'running', merge_key='owner')
+        self.assertTrue(started.wait(1))
+        queued, _ = self._start(HREF, _apply, 'queued', merge_key='owner')
+        self._wait_depth(1)
+        release.set()
+        running.join(1)
+        queued.join(1)
+        self.assertEqual(calls, ['running', 'queued'])
+
+    def test_005_failure_is_raised_to_its_callers_only(self):
+        """A failed operation raises to its caller, and the next operation still runs."""
+        release, holder, _ = self._block()
+
+        def _fail():
+            raise ValueError('failed')
+        failing, failing_results = self._start(HREF, _fail)
+        self._wait_depth(1)
+        next_op, next_results = self._start(HREF, lambda: 'done')
+        self._wait_depth(2)
+        release.set()
+        for thread in (holder, failing, next_op):
+            thread.join(1)
+        self.assertIsInstance(failing_results.get('error'), ValueError)
+        self.assertEqual(next_results, {'result': 'done'})
+        self.assertEqual(self.queue._pending, {})
+
+    def test_006_wait_is_bounded(self):
+        """A caller gives up waiting after its timeout, and its operation leaves the queue."""
+        release, holder, _ = self._block()
+        calls = []
+        with self.assertRaises(OperationWaitTimeout) as raised:
+            self.queue.run(HREF, calls.append, 'late', wait_timeout=0.05)
+        self.assertGreaterEqual(raised.exception.delay, 1)
+        self.assertEqual(self.queue.depth(HREF), 0)
+        release.set()
+        holder.join(1)
+        self.assertEqual(calls, [])
+        self.assertEqual(self.queue._pending, {})
+
+    def test_007_merged_caller_keeps_the_operation(self):
+        """An operation stays queued for the merged callers still waiting when one gives up."""
+        release, holder, _ = self._block()
+        calls = []
+        waiting, results = self._start(HREF, calls.append, 'first', merge_key='owner')
+        self._wait_depth(1)
+        with self.assertRaises(OperationWaitTimeout):
+            self.queue.run(HREF, calls.append, 'second', merge_key='owner', wait_timeout=0.05)
+        self.assertEqual(self.queue.depth(HREF), 1)
+        release.set()
+        for thread in (holder, waiting):
+            thread.join(1)
+        self.assertEqual(calls, ['second'])
+        self.assertEqual(results, {'result': None})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+"""Tests for the retry policy of the handlers."""
+
+
+import collections
+import contextlib
+import os
+import unittest
+from unittest import mock
+
+# kvcd.main reads its configuration at import
+for _name, _value in (('KVCD_VCD_HOST', 'vcd.test'), ('KVCD_VCD_ORG', 'test'), ('KVCD_VCD_USERNAME', 'test'),
+                      ('KVCD_VCD_PASSWORD', 'test'), ('KVCD_ENABLED_MODULES', '')):
+    os.environ.setdefault(_name, _value)
+
+import kopf  # noqa: E402
+import requests  # noqa: E402
+from pyvcloud.vcd.exceptions import (  # noqa: E402
+    BadRequestException,
+    EntityNotFoundException,
+    InvalidStateException,
+    NotFoundException,
+    VcdResponseException,
+)
+
+from kvcd.vmware import vcloud_retry  # noqa: E402
+from kvcd.vmware.vcloud_breaker import CircuitOpenError  # noqa: E402
+from kvcd.vmware.vcloud_queue import OperationWaitTimeout  # noqa: E402
+from kvcd.vmware.vcloud_retry import Backoff, RetryBudget, classify_error, retry_error, retry_policy  # noqa: E402
+from kvcd.vmware.vcloud_scheduler import SlotWaitTimeout  # noqa: E402
+
+
+class TestClassifyError(unittest.TestCase):
+    """Tests for `classify_error`."""
+
+    def test_000_vcd_errors(self):
+        """The vCD errors are classified by their status and error code."""
+        busy = VcdResponseException(400, 'req', {'minorErrorCode': 'BUSY_ENTITY', 'message': 'busy'})
+        self.assertEqual(classify_error(busy), 'busy_entity')
+        self.assertEqual(classify_error(VcdResponseException(503, 'req', {})), 'server_error')
+        self.assertEqual(classify_error(NotFoundException(404, 'req', {})), 'not_found')
+        self.assertEqual(classify_error(BadRequestException(400, 'req', {})), 'invalid_state')
+        self.assertEqual(classify_error(EntityNotFoundException('missing')), 'not_found')
+        self.assertEqual(classify_error(InvalidStateException('powered on')), 'invalid_state')
+        self.assertEqual(classify_error(requests.ConnectionError('unreachable')), 'server_error')
+
+    def test_001_shed_work(self):
+        """The work shed by the breaker or the scheduler has its own reason."""
+        self.assertEqual(classify_error(CircuitOpenError('open', delay=10)), 'circuit_open')
+        self.assertEqual(classify_error(SlotWaitTimeout('no slot', delay=10)), 'no_slot')
+        self.assertEqual(classify_error(OperationWaitTimeout('no turn', delay=10)), 'no_slot')
+
+    def test_002_cause(self):
+        """A temporary error is classified from the vCD error it was raised from."""
+        try:
+            try:
+                raise VcdResponseException(400, 'req', {'minorErrorCode': 'BUSY_ENTITY'})
+            except VcdResponseException as e:
+                raise kopf.TemporaryError('retry', delay=30) from e
+        except kopf.TemporaryError as e:
+            self.assertEqual(classify_error(e), 'busy_entity')
+        self.assertEqual(classify_error(kopf.TemporaryError('retry', delay=30)), 'default')
+
+    def test_003_permanent_errors(self):
+        """The permanent and unknown errors are not retried."""
+        self.assertIsNone(classify_error(kopf.PermanentError('invalid spec')))
+        self.assertIsNone(classify_error(ValueError('bug')))
+        self.assertEqual(retry_error(ValueError('bug'), 0), (None, None))
+
+
+class TestBackoff(unittest.TestCase):
+    """Tests for `Backoff`."""
+
+    def test_000_curve(self):
+        """The delay grows with the attempts, with jitter, up to the cap."""
+        backoff = Backoff(base=10, factor=2, cap=100)
+        for attempt, delay in ((0, 10), (1, 20), (2, 40), (10, 100)):
+            for _ in range(20):
+                self.assertTrue(delay / 2 <= backoff.delay(attempt) <= delay)
+
+    def test_001_error_delay(self):
+        """A curve without base starts from the delay of the error."""
+        self.assertLessEqual(Backoff(cap=600).delay(0, base=4), 4)
+
+
+class TestRetryBudget(unittest.TestCase):
+    """Tests for `RetryBudget`."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        patcher = mock.patch('kvcd.vmware.vcloud_retry.time.time', lambda: 1000.0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_000_spread(self):
+        """The retries over the budget of a second are moved to the next ones."""
+        budget = RetryBudget(2)
+        self.assertEqual([budget.schedule(10) for _ in range(5)], [10, 10, 11, 11, 12])
+
+    def test_001_no_limit(self):
+        """A budget of 0 does not limit the retries."""
+        budget = RetryBudget(0)
+        self.assertEqual([budget.schedule(10) for _ in range(5)], [10] * 5)
+
+
+class TestRetryPolicy(unittest.TestCase):
+    """Tests for the `retry_policy` decorator."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        patcher = mock.patch('kvcd.vmware.vcloud_retry.status_writer')
+        self.status_writer = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('kvcd.vmware.vcloud_retry.retry_budget', RetryBudget(0))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('kvcd.vmware.vcloud_retry._published', collections.OrderedDict())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_000_retry_published(self):
+        """A vCD error is retried as a temporary error, and the retry state published."""
+        error = VcdResponseException(503, 'req', {})
+
+        @retry_policy('kvcdvapps')
+        def handler(**kwargs):
+            raise error
+
+        with self.assertRaises(kopf.TemporaryError) as raised:
+            handler(namespace='default', name='a', retry=2)
+        self.assertIs(raised.exception.__cause__, error)
+        self.assertLessEqual(raised.exception.delay, vcloud_retry.kvcd_config.retry.max_delay)
+        plural, namespace, name, status = self.status_writer.submit.call_args[0]
+        self.assertEqual((plural, namespace, name), ('kvcdvapps', 'default', 'a'))
+        self.assertEqual(status['retry']['reason'], 'server_error')
+        self.assertEqual(status['retry']['attempt'], 3)
+        self.assertEqual(status['retry']['handler'], 'handler')
+
+    def test_001_retry_cleared(self):
+        """The retry state is cleared once the handler succeeds."""
+        @retry_policy('kvcdvapps')
+        def handler(**kwargs):
+            return 'done'
+
+        self.assertEqual(handler(namespace='default', name='a', retry=0), 'done')
+        self.status_writer.submit.assert_not_called()
+        self.assertEqual(handler(namespace='default', name='a', retry=1, status={}), 'done')
+        self.status_writer.submit.assert_not_called()
+        self.assertEqual(handler(namespace='default', name='a', retry=1, status={'retry': {'attempt': 1}}), 'done')
+        self.status_writer.submit.assert_called_once_with('kvcdvapps', 'default', 'a', {'retry': None})
+
+    def test_002_permanent_error_untouched(self):
+        """A permanent error is raised as is."""
+        @retry_policy('kvcdvapps')
+        def handler(**kwargs):
+            raise kopf.PermanentError('invalid spec')
+
+        with self.assertRaises(kopf.PermanentError):
+            handler(namespace='default', name='a', retry=0)
+        self.status_writer.submit.assert_not_called()
+
+    def test_003_async_handler(self):
+        """The async handlers are decorated too."""
+        import asyncio
+
+        @retry_policy('kvcdvapps')
+        async def handler(**kwargs):
+            raise InvalidStateException('powered on')
+
+        with self.assertRaises(kopf.TemporaryError):
+            asyncio.run(handler(namespace='default', name='a', retry=0))
+        self.assertEqual(self.status_writer.submit.call_args[0][3]['retry']['reason'], 'invalid_state')
+
+    def test_004_published_on_change(self):
+        """The retry state is written when its reason or attempt bucket changes only, and cleared once."""
+        errors = [VcdResponseException(503, 'req', {})] * 4 + [InvalidStateException('powered on')]
+
+        @retry_policy('kvcdvapps')
+        def handler(**kwargs):
+            if errors:
+                raise errors.pop(0)
+
+        published = []
+        for retry in range(6):
+            with contextlib.suppress(kopf.TemporaryError):
+                handler(namespace='default', name='b', retry=retry)
+            if self.status_writer.submit.called:
+                retry_state = self.status_writer.submit.call_args[0][3]['retry']
+                published.append(retry_state and (retry_state['attempt'], retry_state['reason']))
+            self.status_writer.submit.reset_mock()
+        self.assertEqual(published, [(1, 'server_error'), (2, 'server_error'), (4, 'server_error'),
+                                     (5, 'invalid_state'), None])
+
+
+if __name__ == '__main__':
+    unittest.main()
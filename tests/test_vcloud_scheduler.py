@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+"""Tests for the priority scheduler of the vCD work."""
+
+
+import asyncio
+import threading
+import time
+import unittest
+from unittest import mock
+
+from kvcd.vmware.vcloud_breaker import BreakerState, CircuitBreaker, CircuitOpenError
+from kvcd.vmware.vcloud_scheduler import Priority, PriorityScheduler, SlotWaitTimeout
+
+
+class TestPriorityScheduler(unittest.TestCase):
+    """Tests for `PriorityScheduler`."""
+
+    def _scheduler(self, slots: int = 1, shares: dict = None, starvation_timeout: float = 30, **kwargs):
+        return PriorityScheduler(slots=slots, shares=shares or {}, starvation_timeout=starvation_timeout, **kwargs)
+
+    def _hold(self, scheduler: PriorityScheduler, priority: Priority):
+        """Hold a slot until the returned event is set."""
+        started, release = threading.Event(), threading.Event()
+
+        def _work():
+            started.set()
+            release.wait()
+        thread = threading.Thread(target=scheduler.run, args=(priority, _work))
+        thread.start()
+        self.assertTrue(started.wait(1))
+        return release, thread
+
+    def _wait_waiting(self, scheduler: PriorityScheduler, count: int):
+        deadline = time.monotonic() + 1
+        while (sum(s['waiting'] for s in scheduler.stats().values()) != count and
+               time.monotonic() < deadline):
+            time.sleep(0.01)
+
+    def test_000_limits_from_shares(self):
+        """Each class gets its share of the slots, at least one."""
+        scheduler = self._scheduler(slots=10, shares={
+            Priority.LIFECYCLE: 1.0, Priority.RECONCILE: 0.75, Priority.REFRESH: 0.01})
+        self.assertEqual(scheduler.limits, {Priority.LIFECYCLE: 10, Priority.RECONCILE: 8, Priority.REFRESH: 1})
+
+    def test_001_run_releases_the_slot(self):
+        """A slot is released after the work, even when it fails."""
+        scheduler = self._scheduler()
+        self.assertEqual(scheduler.run(Priority.RECONCILE, lambda x: x * 2, 21), 42)
+        with self.assertRaises(ValueError):
+            scheduler.run(Priority.RECONCILE, int, 'x')
+        self.assertEqual(scheduler.stats()['reconcile'], {'running': 0, 'waiting': 0})
+
+    def test_002_share_limits_a_class(self):
+        """A class cannot use more than its share of the slots."""
+        scheduler = self._scheduler(slots=2, shares={Priority.REFRESH: 0.5})
+        release, holder = self._hold(scheduler, Priority.REFRESH)
+        done = []
+        refresh = threading.Thread(target=scheduler.run, args=(Priority.REFRESH, done.append, 'refresh'))
+        refresh.start()
+        self._wait_waiting(scheduler, 1)
+        self.assertEqual(scheduler.run(Priority.LIFECYCLE, lambda: 'free'), 'free')
+        self.assertEqual(done, [])
+        release.set()
+        for thread in (holder, refresh):
+            thread.join(1)
+        self.assertEqual(done, ['refresh'])
+
+    def test_003_higher_priority_first(self):
+        """A freed slot goes to the most urgent waiter."""
+        scheduler = self._scheduler()
+        release, holder = self._hold(scheduler, Priority.LIFECYCLE)
+        order = []
+        refresh = threading.Thread(target=scheduler.run, args=(Priority.REFRESH, order.append, 'refresh'))
+        refresh.start()
+        self._wait_waiting(scheduler, 1)
+        lifecycle = threading.Thread(target=scheduler.run, args=(Priority.LIFECYCLE, order.append, 'lifecycle'))
+        lifecycle.start()
+        self._wait_waiting(scheduler, 2)
+        release.set()
+        for thread in (holder, refresh, lifecycle):
+            thread.join(1)
+        self.assertEqual(order, ['lifecycle', 'refresh'])
+
+    def test_004_starved_waiter_first(self):
+        """A waiter starved for too long goes before the more urgent ones."""
+        scheduler = self._scheduler(starvation_timeout=0)
+        release, holder = self._hold(scheduler, Priority.LIFECYCLE)
+        order = []
+        refresh = threading.Thread(target=scheduler.run, args=(Priority.REFRESH, order.append, 'refresh'))
+        refresh.start()
+        self._wait_waiting(scheduler, 1)
+        lifecycle = threading.Thread(target=scheduler.run, args=(Priority.LIFECYCLE, order.append, 'lifecycle'))
+        lifecycle.start()
+        self._wait_waiting(scheduler, 2)
+        release.set()
+        for thread in (holder, refresh, lifecycle):
+            thread.join(1)
+        self.assertEqual(order, ['refresh', 'lifecycle'])
+
+    def test_005_async_slot(self):
+        """The async slot is granted and released."""
+        scheduler = self._scheduler()
+
+        async def _work():
+            async with scheduler.async_slot(Priority.REFRESH):
+                return scheduler.stats()['refresh']['running']
+        self.assertEqual(asyncio.run(_work()), 1)
+        self.assertEqual(scheduler.stats()['refresh']['running'], 0)
+
+    def test_006_open_breaker_sheds_the_work(self):
+        """The work is not queued while the breaker sheds it."""
+        breaker = CircuitBreaker('test', min_calls=1, open_duration=60)
+        breaker.record(success=False, duration=0)
+        self.assertEqual(breaker.state, BreakerState.OPEN)
+        scheduler = self._scheduler(breaker=breaker)
+        with self.assertRaises(CircuitOpenError):
+            scheduler.run(Priority.LIFECYCLE, lambda: None)
+        self.assertEqual(scheduler.stats()['lifecycle'], {'running': 0, 'waiting': 0})
+
+    def test_007_handler_wait_is_bounded(self):
+        """A handler gives its thread back when no slot is granted in time."""
+        scheduler = self._scheduler(handler_wait=0.1)
+        release, holder = self._hold(scheduler, Priority.LIFECYCLE)
+        with self.assertRaises(SlotWaitTimeout) as raised:
+            scheduler.run_handler(Priority.LIFECYCLE, lambda: None)
+        self.assertGreaterEqual(raised.exception.delay, 1)
+        self.assertEqual(scheduler.stats()['lifecycle'], {'running': 1, 'waiting': 0})
+        release.set()
+        holder.join(1)
+        self.assertEqual(scheduler.run_handler(Priority.LIFECYCLE, lambda: 'granted'), 'granted')
+        self.assertEqual(scheduler.stats()['lifecycle'], {'running': 0, 'waiting': 0})
+
+    def test_008_probe_outcome_reported(self):
+        """A probe is reported to the breaker once its work is over."""
+        breaker = mock.Mock()
+        breaker.admit.return_value = 7
+        scheduler = self._scheduler(breaker=breaker)
+        scheduler.run(Priority.REFRESH, lambda: None)
+        breaker.probe_done.assert_called_once_with(7, True)
+        breaker.probe_done.reset_mock()
+        with self.assertRaises(ValueError):
+            scheduler.run(Priority.REFRESH, int, 'x')
+        breaker.probe_done.assert_called_once_with(7, False)
+
+
+if __name__ == '__main__':
+    unittest.main()
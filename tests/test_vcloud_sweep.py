@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""Tests for the sweep of the managed vApps."""
+
+
+import os
+import unittest
+from unittest import mock
+
+from lxml import etree
+
+# kvcd.main reads its configuration at import
+for _name, _value in (('KVCD_VCD_HOST', 'vcd.test'), ('KVCD_VCD_ORG', 'test'), ('KVCD_VCD_USERNAME', 'test'),
+                      ('KVCD_VCD_PASSWORD', 'test'), ('KVCD_ENABLED_MODULES', '')):
+    os.environ.setdefault(_name, _value)
+
+from kvcd.vmware.vcloud_sweep import VappSweeper, find_drifts  # noqa: E402
+
+
+def vapp_record(name: str, status: str = 'POWERED_OFF', vapp_id: str = None):
+    return etree.Element('VAppRecord', name=name, href=f'https://vcd/api/vApp/vapp-{vapp_id or name}',
+                         status=status, vdc='https://vcd/api/vdc/1')
+
+
+def vcdvapp_entry(name: str, powered_on: bool = False):
+    return {'name': name, 'namespace': 'default', 'vcd_vapp_href': f'https://vcd/api/vApp/vapp-{name}',
+            'powered_on': powered_on}
+
+
+class TestFindDrifts(unittest.TestCase):
+    """Tests for `find_drifts`."""
+
+    def test_000_drifts(self):
+        """The orphans, the unmanaged, renamed and powered vApps are found."""
+        managed = {record.get('href'): record for record in (
+            vapp_record('a'), vapp_record('b-renamed', vapp_id='b'), vapp_record('c', status='POWERED_ON'),
+            vapp_record('d'))}
+        entries = [vcdvapp_entry('a'), vcdvapp_entry('b'), vcdvapp_entry('c'), vcdvapp_entry('e'),
+                   {'name': 'f', 'namespace': 'default'}]
+        orphans, drifts = find_drifts(entries, managed)
+        self.assertEqual(orphans, {'https://vcd/api/vApp/vapp-d'})
+        self.assertEqual([(entry['name'], kind) for entry, kind, _ in drifts],
+                         [('b', 'name'), ('c', 'power_state'), ('e', 'unmanaged')])
+
+
+class TestVappSweeper(unittest.TestCase):
+    """Tests for `VappSweeper`."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.managed = {}
+        self.deleted = []
+        for name, value in (('get_vcd_session', mock.Mock(return_value=mock.MagicMock())),
+                            ('list_managed_vapps', lambda vcd_session: dict(self.managed)),
+                            ('post_event', mock.Mock())):
+            patcher = mock.patch(f'kvcd.vmware.vcloud_sweep.{name}', value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.sweeper = VappSweeper({}, interval=60, initial_delay=0, cleanup=True)
+        patcher = mock.patch.object(self.sweeper, 'delete_orphan',
+                                    lambda site, vcd_session, href, vdc_href=None: self.deleted.append(href))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _manage(self, *names):
+        self.managed = {record.get('href'): record for record in map(vapp_record, names)}
+
+    def test_000_two_misses_flag_an_orphan(self):
+        """A vApp missing its vcdvapp once is not deleted, twice in a row it is."""
+        self._manage('a', 'b')
+        self.sweeper.sweep_site('default', [vcdvapp_entry('a')])
+        self.assertEqual(self.deleted, [])
+        self.sweeper.sweep_site('default', [vcdvapp_entry('a')])
+        self.assertEqual(self.deleted, ['https://vcd/api/vApp/vapp-b'])
+
+    def test_001_misses_not_consecutive(self):
+        """A vApp found again between two misses is not deleted."""
+        self._manage('a')
+        self.sweeper.sweep_site('default', [])
+        self.sweeper.sweep_site('default', [vcdvapp_entry('a')])
+        self.sweeper.sweep_site('default', [])
+        self.assertEqual(self.deleted, [])
+
+    def test_002_report_only(self):
+        """Without the cleanup, the orphans are only reported."""
+        self.sweeper.cleanup = False
+        self._manage('a')
+        for _ in range(3):
+            self.sweeper.sweep_site('default', [])
+        self.assertEqual(self.deleted, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+"""Tests for the recording and replay of the vCD traffic."""
+
+
+import base64
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import requests
+
+from kvcd.vmware.vcloud_traffic import TrafficRecorder, TrafficReplay
+
+
+SECRETS = ('s3cret', base64.b64encode(b'user@System:s3cret').decode(), 'session-token', 'access-token',
+           'cookie-value', 'p4ssw0rd', 'refresh-me')
+
+
+def vcd_response(request, status: int = 200, body: bytes = b'', headers: dict = None):
+    response = requests.Response()
+    response.request = request
+    response.url = request.url
+    response.status_code = status
+    response.reason = 'OK' if status < 400 else 'Error'
+    response.headers = requests.structures.CaseInsensitiveDict(headers or {})
+    response._content = body
+    return response
+
+
+def fake_vcd(adapter, request, *args, **kwargs):
+    """Answers of a vCloud instance, with credentials in their headers and bodies."""
+    if request.path_url == '/api/sessions':
+        return vcd_response(request, headers={
+            'x-vcloud-authorization': 'session-token', 'X-VMware-vCloud-Access-Token': 'access-token',
+            'Set-Cookie': 'vcloud-token=cookie-value', 'Content-Type': 'application/xml'},
+            body=b'<Session user="user"/>')
+    if request.path_url == '/api/token':
+        return vcd_response(request, body=b'{"access_token": "access-token", "refresh_token": "refresh-me"}',
+                            headers={'Content-Type': 'application/json'})
+    if request.method != 'GET':
+        return vcd_response(request, status=204)
+    count = fake_vcd.calls = fake_vcd.calls + 1
+    return vcd_response(request, body=f'<VApp name="app" count="{count}"/>'.encode(),
+                        headers={'Content-Type': 'application/xml'})
+
+
+class TestTraffic(unittest.TestCase):
+    """Tests for `TrafficRecorder` and `TrafficReplay`."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        fd, self.path = tempfile.mkstemp(suffix='.jsonl')
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+        fake_vcd.calls = 0
+        recorder = TrafficRecorder(self.path)
+        session = requests.Session()
+        session.mount('https://', recorder.transport())
+        with mock.patch('requests.adapters.HTTPAdapter.send', autospec=True, side_effect=fake_vcd):
+            session.post('https://vcd.prod/api/sessions', auth=('user@System', 's3cret'))
+            session.post('https://vcd.prod/api/token', json={'password': 'p4ssw0rd', 'token': 'session-token'},
+                         headers={'Cookie': 'vcloud-token=cookie-value'})
+            session.put('https://vcd.prod/api/admin/user/1', headers={'x-vcloud-authorization': 'session-token'},
+                        data=b'<User><Password>p4ssw0rd</Password></User>')
+            for _ in range(2):
+                session.get('https://vcd.prod/api/vApp/vapp-1?format=records',
+                            headers={'x-vcloud-authorization': 'session-token'})
+
+    def _replay_session(self):
+        self.replay = TrafficReplay(self.path, speed=0)
+        session = requests.Session()
+        session.mount('https://', self.replay.transport())
+        return session
+
+    def test_000_credentials_scrubbed(self):
+        """No credential of the headers or bodies reaches the recording."""
+        with open(self.path) as f:
+            recording = f.read()
+        self.assertEqual(len(recording.splitlines()), 5)
+        for secret in SECRETS:
+            self.assertNotIn(secret, recording)
+        entries = [json.loads(line) for line in recording.splitlines()]
+        self.assertEqual(entries[0]['request_headers']['Authorization'], '***')
+        self.assertEqual(entries[0]['headers']['x-vcloud-authorization'], '***')
+        self.assertIn('<Password>***</Password>', entries[2]['request_body']['text'])
+        self.assertNotIn('vcd.prod', recording)
+
+    def test_001_round_trip(self):
+        """The recorded responses are served in order whatever the host, the last one again once all served."""
+        session = self._replay_session()
+        self.assertEqual(self.replay.remaining(), 5)
+        response = session.post('https://vcd.replay/api/sessions')
+        self.assertEqual((response.status_code, response.text), (200, '<Session user="user"/>'))
+        self.assertEqual(response.headers['content-type'], 'application/xml')
+        counts = [session.get('https://vcd.replay/api/vApp/vapp-1?format=records').text for _ in range(3)]
+        self.assertEqual(counts, ['<VApp name="app" count="1"/>', '<VApp name="app" count="2"/>',
+                                  '<VApp name="app" count="2"/>'])
+        self.assertEqual(self.replay.remaining(), 2)
+
+    def test_002_not_recorded(self):
+        """A request never recorded is answered with a 404, its query included in the match."""
+        session = self._replay_session()
+        self.assertEqual(session.get('https://vcd.replay/api/vApp/vapp-1').status_code, 404)
+        self.assertEqual(session.get('https://vcd.replay/api/vApp/vapp-2?format=records').status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""Tests for the user objects."""
+
+
+import os
+import unittest
+from unittest import mock
+
+from lxml import etree
+
+# kvcd.main reads its configuration at import
+for _name, _value in (('KVCD_VCD_HOST', 'vcd.test'), ('KVCD_VCD_ORG', 'test'), ('KVCD_VCD_USERNAME', 'test'),
+                      ('KVCD_VCD_PASSWORD', 'test'), ('KVCD_ENABLED_MODULES', '')):
+    os.environ.setdefault(_name, _value)
+
+import kopf  # noqa: E402
+from pyvcloud.vcd.exceptions import VcdResponseException  # noqa: E402
+
+from kvcd.vmware.vcloud_breaker import CircuitOpenError  # noqa: E402
+from kvcd.vmware.vcloud_user import VcdUserSync, update_vcduser  # noqa: E402
+
+
+ORG_HREF = 'https://vcd/api/org/1'
+
+
+def user_record(name: str, enabled: bool = True, locked: bool = False):
+    return etree.Element('AdminUserRecord', name=name, href=f'https://vcd/api/admin/user/{name}',
+                         isEnabled=str(enabled).lower(), isLocked=str(locked).lower(), roleName='Viewer')
+
+
+def vcduser_entry(name: str, status: str = 'Enabled'):
+    backing = {'vcd_user_href': f'https://vcd/api/admin/user/{name}', 'status': status, 'role': 'Viewer',
+               'full_name': None, 'email': None} if status else {}
+    return {'name': name, 'namespace': 'default', 'username': name, 'backing': backing}
+
+
+class TestVcdUserSync(unittest.TestCase):
+    """Tests for `VcdUserSync`."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.records = [user_record('alice'), user_record('bob', locked=True)]
+        self.session = mock.MagicMock()
+        self.session.client.get_typed_query.side_effect = lambda *args, **kwargs: mock.Mock(
+            execute=lambda: iter(self.records))
+        self.get_org = mock.Mock(return_value=mock.Mock(href=ORG_HREF))
+        self.status_writer = mock.Mock()
+        for name, value in (('get_vcd_session', mock.Mock(return_value=self.session)),
+                            ('resolve_site', lambda site: site or 'default'),
+                            ('get_org', self.get_org),
+                            ('status_writer', self.status_writer)):
+            patcher = mock.patch(f'kvcd.vmware.vcloud_user.{name}', value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.index = {}
+        self.sync = VcdUserSync(self.index, interval=60, initial_delay=0)
+
+    def test_000_changes_written(self):
+        """Only the changed vcdusers are written, the user-visible transitions first."""
+        self.index[(None, 'org')] = [vcduser_entry('alice'), vcduser_entry('bob'), vcduser_entry('carol'),
+                                     vcduser_entry('dave', status=None)]
+        self.sync.sync()
+        self.assertEqual(self.status_writer.submit.call_args_list, [
+            mock.call('vcdusers', 'default', 'bob', {'backing': {'status': 'Locked'}}, urgent=True),
+            mock.call('vcdusers', 'default', 'carol', {'backing': {'vcd_user_href': None, 'status': 'Missing'}},
+                      urgent=True),
+        ])
+        self.assertEqual(self.session.client.get_typed_query.call_args[1]['qfilter'], f'org=={ORG_HREF}')
+
+    def test_001_one_query_per_org(self):
+        """The users of an organization are read with one query per sync, its href read once."""
+        self.index[(None, 'org')] = [vcduser_entry('alice')]
+        self.sync.sync()
+        self.sync.sync()
+        self.assertEqual(self.session.client.get_typed_query.call_count, 2)
+        self.get_org.assert_called_once()
+
+    def test_002_failed_org_skipped(self):
+        """A failed organization does not stop the sync of the other ones."""
+        self.index[(None, 'open')] = [vcduser_entry('bob')]
+        self.index[(None, 'broken')] = [vcduser_entry('bob')]
+        self.index[(None, 'org')] = [vcduser_entry('bob')]
+        errors = {'open': CircuitOpenError('vCloud unavailable', delay=10), 'broken': RuntimeError('broken')}
+
+        def _get_org(vcd_session, org_name):
+            if org_name in errors:
+                raise errors[org_name]
+            return mock.Mock(href=ORG_HREF)
+
+        self.get_org.side_effect = _get_org
+        self.sync.sync()
+        self.status_writer.submit.assert_called_once_with(
+            'vcdusers', 'default', 'bob', {'backing': {'status': 'Locked'}}, urgent=True)
+
+
+class TestVcdUserHandlers(unittest.TestCase):
+    """Tests for the vcduser handlers."""
+
+    def test_000_retry_policy(self):
+        """A transient vCD error of a handler is retried with the retry policy, and published."""
+        session = mock.Mock()
+        session.scheduler.run_handler.side_effect = VcdResponseException(503, 'req', {})
+        with mock.patch('kvcd.vmware.vcloud_user.get_vcd_session', return_value=session), \
+                mock.patch('kvcd.vmware.vcloud_retry.status_writer') as status_writer:
+            with self.assertRaises(kopf.TemporaryError):
+                update_vcduser(spec={'org': 'org', 'role': 'Viewer'}, status={'backing': {'vcd_user_href': 'h'}},
+                               name='alice', namespace='default', logger=mock.Mock(), retry=0)
+        plural, namespace, name, status = status_writer.submit.call_args[0]
+        self.assertEqual((plural, name, status['retry']['reason']), ('vcdusers', 'alice', 'server_error'))
+
+
+if __name__ == '__main__':
+    unittest.main()
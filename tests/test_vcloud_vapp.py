@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+"""Tests for the vApp handlers."""
+
+
+import os
+import threading
+import time
+import unittest
+from unittest import mock
+
+import kopf
+from lxml import etree, objectify
+
+# kvcd.main reads its configuration at import
+for _name, _value in (('KVCD_VCD_HOST', 'vcd.test'), ('KVCD_VCD_ORG', 'test'), ('KVCD_VCD_USERNAME', 'test'),
+                      ('KVCD_VCD_PASSWORD', 'test'), ('KVCD_ENABLED_MODULES', '')):
+    os.environ.setdefault(_name, _value)
+
+from kvcd.vmware import vcloud_vapp  # noqa: E402
+from kvcd.vmware.vcloud_inventory import VdcCapacity  # noqa: E402
+from kvcd.vmware.vcloud_vapp import (  # noqa: E402
+    CapacityRefresher,
+    delete_vcdvapp,
+    place_vapp,
+    vapp_delete,
+    vapp_entry_signal,
+    vapp_refresh,
+)
+
+
+HREF = 'https://vcd/api/vApp/vapp-1'
+VDC_HREF = 'https://vcd/api/vdc/1'
+VAPP_XML = ('<VApp xmlns="http://www.vmware.com/vcloud/v1.5" name="a" href="{href}" status="4" deployed="true">'
+            '<Owner><User name="alice"/></Owner></VApp>')
+
+
+class TestVappRefresh(unittest.TestCase):
+    """Tests for `vapp_refresh`."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.entry = {'name': 'a', 'href': HREF, 'status': 'POWERED_ON', 'deployed': True, 'owner': 'alice',
+                      'expired': False, 'storage_expiration': None, 'deployment_expiration': None}
+        self.session = mock.Mock()
+        self.session.vapp_index.get_by_href.side_effect = lambda *args, **kwargs: dict(self.entry)
+        self.session.vm_inventory.get.return_value = []
+        self.vapp = mock.Mock()
+        self.vapp.get_resource.return_value = objectify.fromstring(VAPP_XML.format(href=HREF))
+        self.vapp.get_lease.return_value = {'DeploymentLeaseInSeconds': 0, 'StorageLeaseInSeconds': 0}
+        self.submitted = []
+        for name, value in (('VApp', mock.Mock(return_value=self.vapp)),
+                            ('metadata_to_dict', mock.Mock(return_value={'team': 'a'})),
+                            ('status_writer', mock.Mock(submit=self._submit)),
+                            ('_backing_signals', {})):
+            patcher = mock.patch.object(vcloud_vapp, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _submit(self, plural, namespace, name, body, urgent=False):
+        self.submitted.append(body['backing'])
+
+    def _refresh(self, backing: dict):
+        backing = dict(backing, vcd_vapp_href=HREF, vcd_vdc_href=VDC_HREF)
+        vapp_refresh(self.session, spec={}, status={'backing': backing}, name='a', namespace='default',
+                     annotations={'managed-by': 'kvcd'}, logger=mock.Mock(), patch=mock.MagicMock())
+
+    def test_000_first_refresh_reads_the_vapp(self):
+        """The first refresh reads the vApp, its lease and its metadata."""
+        self._refresh({})
+        self.vapp.get_resource.assert_called_once_with()
+        self.vapp.get_lease.assert_called_once_with()
+        self.vapp.get_metadata.assert_called_once_with()
+        self.assertEqual(self.submitted, [{
+            'deploymentLeaseInSeconds': 0, 'storageLeaseInSeconds': 0, 'status': 'Powered on',
+            'metadata': {'team': 'a'}, 'owner': 'alice', 'vms': []}])
+        self.assertEqual(vcloud_vapp._backing_signals[HREF][0], vapp_entry_signal(self.entry))
+
+    def test_001_unchanged_signal_skips_the_reads(self):
+        """An unchanged vApp is refreshed from the index only, without reading the vApp, its lease or metadata."""
+        vcloud_vapp._backing_signals[HREF] = (vapp_entry_signal(self.entry), time.monotonic())
+        self._refresh({'status': 'Powered on', 'owner': 'alice', 'metadata': {'team': 'a'}, 'vms': []})
+        vcloud_vapp.VApp.assert_not_called()
+        self.vapp.get_lease.assert_not_called()
+        self.vapp.get_metadata.assert_not_called()
+        self.assertEqual(self.submitted, [])
+
+    def test_002_changed_signal_reads_the_vapp(self):
+        """A change of the indexed state of the vApp triggers a full read."""
+        vcloud_vapp._backing_signals[HREF] = (vapp_entry_signal(self.entry), time.monotonic())
+        self.entry['owner'] = 'bob'
+        self._refresh({'status': 'Powered on', 'owner': 'alice', 'metadata': {'team': 'a'}, 'vms': []})
+        self.vapp.get_lease.assert_called_once_with()
+        self.vapp.get_metadata.assert_called_once_with()
+        self.session.vapp_index.update.assert_called_once_with(HREF, status='POWERED_ON', deployed=True,
+                                                               owner='alice')
+
+    def test_003_expired_from_the_index(self):
+        """An expired storage lease is detected from the index, without reading the vApp."""
+        self.entry['storage_expiration'] = '2020-01-01T00:00:00.000Z'
+        vcloud_vapp._backing_signals[HREF] = (vapp_entry_signal(self.entry), time.monotonic())
+        self._refresh({'status': 'Powered on', 'owner': 'alice', 'metadata': {'team': 'a'}})
+        vcloud_vapp.VApp.assert_not_called()
+        self.assertEqual(self.submitted, [{'status': 'Expired'}])
+
+
+class TestDeleteWindow(unittest.TestCase):
+    """Tests for the window of the vApp deletions."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.window = threading.BoundedSemaphore(1)
+        self.deleted = []
+        session = mock.Mock()
+        session.scheduler.run_handler.side_effect = lambda priority, func, *args, **kwargs: func(*args, **kwargs)
+        for target, value in (('kvcd.vmware.vcloud_vapp._delete_window', self.window),
+                              ('kvcd.vmware.vcloud_vapp.get_vcd_session', mock.Mock(return_value=session)),
+                              ('kvcd.vmware.vcloud_vapp.vapp_delete', self._delete),
+                              ('kvcd.vmware.vcloud_retry.status_writer', mock.Mock())):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _delete(self, vcd_session, vapp_href, force, logger, vdc_href=None):
+        self.deleted.append(vapp_href)
+        if vapp_href.endswith('broken'):
+            raise RuntimeError('broken')
+
+    def _handle(self, href: str):
+        return delete_vcdvapp(spec={}, status={'backing': {'vcd_vapp_href': href}}, name='a',
+                              namespace='default', logger=mock.Mock(), patch=mock.MagicMock(), retry=0)
+
+    def test_000_out_of_the_window(self):
+        """A deletion out of the window is retried later, without running."""
+        self.window.acquire()
+        try:
+            with self.assertRaises(kopf.TemporaryError) as cm:
+                self._handle(HREF)
+        finally:
+            self.window.release()
+        self.assertGreater(cm.exception.delay, 0)
+        self.assertEqual(self.deleted, [])
+
+    def test_001_window_released(self):
+        """The window is released after a deletion, failed or not."""
+        self._handle(HREF)
+        with self.assertRaises(RuntimeError):
+            self._handle(HREF + '-broken')
+        self._handle(HREF)
+        self.assertEqual(self.deleted, [HREF, HREF + '-broken', HREF])
+
+
+class TestVappDelete(unittest.TestCase):
+    """Tests for `vapp_delete`."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.session = mock.Mock()
+        self.calls = []
+        self.vapp = mock.Mock()
+        self.vapp.reload.side_effect = lambda: self.calls.append('reload')
+        self.vapp.undeploy.side_effect = lambda action: self.calls.append(f'undeploy {action}')
+        self.session.client.delete_resource.side_effect = lambda href, force: self.calls.append('delete')
+        for name, value in (('VApp', mock.Mock(return_value=self.vapp)),
+                            ('wait_for_task', mock.Mock(return_value={'status': 'success'})),
+                            ('_backing_signals', {})):
+            patcher = mock.patch.object(vcloud_vapp, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _index(self, deployed: bool):
+        self.session.vapp_index.get_by_href.return_value = {'name': 'a', 'href': HREF, 'deployed': deployed}
+        self.vapp.resource = objectify.fromstring(VAPP_XML.format(href=HREF)) if deployed else None
+
+    def test_000_powered_off_then_deleted(self):
+        """A deployed vApp is powered off, then deleted, in the same operation."""
+        self._index(deployed=True)
+        vapp_delete(self.session, HREF, force=False, logger=mock.Mock(), vdc_href=VDC_HREF)
+        self.assertEqual(self.calls, ['reload', 'undeploy powerOff', 'delete'])
+        self.session.vapp_index.remove.assert_called_once_with(HREF)
+
+    def test_001_undeployed_not_downloaded(self):
+        """An undeployed vApp is deleted from its href, without downloading it."""
+        self._index(deployed=False)
+        vapp_delete(self.session, HREF, force=True, logger=mock.Mock(), vdc_href=VDC_HREF)
+        self.assertEqual(self.calls, ['delete'])
+
+    def test_002_missing_skipped(self):
+        """A vApp missing from the index is not deleted."""
+        self.session.vapp_index.get_by_href.return_value = None
+        vapp_delete(self.session, HREF, force=False, logger=mock.Mock(), vdc_href=VDC_HREF)
+        self.assertEqual(self.calls, [])
+
+
+def vdc_record(name: str, cpu_used: int, enabled: bool = True):
+    return etree.Element('OrgVdcRecord', name=name, orgName='org', href=f'https://vcd/api/vdc/{name}',
+                         isEnabled=str(enabled).lower(), cpuUsedMhz=str(cpu_used), cpuLimitMhz='1000',
+                         memoryUsedMB='0', memoryLimitMB='0', storageUsedMB='0', storageLimitMB='0')
+
+
+class TestPlacement(unittest.TestCase):
+    """Tests for the placement of the vApps in an Org VDC."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.records = [vdc_record('full', 950), vdc_record('busy', 600), vdc_record('empty', 100),
+                        vdc_record('disabled', 0, enabled=False)]
+        self.client = mock.Mock(is_sysadmin=mock.Mock(return_value=False))
+        self.client.get_typed_query.side_effect = self._query
+        self.session = mock.MagicMock(vdc_capacity=VdcCapacity(self.client))
+
+    def _query(self, *args, **kwargs):
+        if isinstance(self.records, Exception):
+            raise self.records
+        return mock.Mock(execute=lambda: iter(self.records))
+
+    def _place(self, placement: dict, status: dict = None):
+        patch = mock.MagicMock(status={})
+        vdc_name = place_vapp(self.session, spec={'org': 'org', 'placement': placement}, status=status or {},
+                              name='a', logger=mock.Mock(), patch=patch)
+        return vdc_name, patch.status.get('placement')
+
+    def test_000_most_free_first(self):
+        """The Org VDC with the most free capacity is picked, and kept in the status."""
+        self.session.vdc_capacity.refresh()
+        self.assertEqual(self._place({'vdc_pattern': '*'}), ('empty', {'vdc': 'empty'}))
+
+    def test_001_spread_until_the_next_snapshot(self):
+        """The placements are spread over the eligible Org VDCs until the usage is read again."""
+        self.session.vdc_capacity.refresh()
+        picked = [self._place({'vdcs': ['full', 'busy', 'empty', 'disabled']})[0] for _ in range(4)]
+        self.assertEqual(picked, ['empty', 'busy', 'empty', 'busy'])
+
+    def test_002_full_vdcs_excluded(self):
+        """Without any Org VDC with enough free capacity, the placement waits for the next snapshot."""
+        self.session.vdc_capacity.refresh()
+        with self.assertRaises(kopf.TemporaryError) as cm:
+            self._place({'vdcs': ['full', 'disabled']})
+        self.assertEqual(cm.exception.delay, vcloud_vapp.kvcd_config.refresh_interval)
+
+    def test_003_no_snapshot_yet(self):
+        """Before the first snapshot, the placement is retried soon."""
+        with self.assertRaises(kopf.TemporaryError) as cm:
+            self._place({'vdc_pattern': '*'})
+        self.assertEqual(cm.exception.delay, CapacityRefresher.FIRST_SNAPSHOT_RETRY)
+        self.client.get_typed_query.assert_not_called()
+
+    def test_004_placed_once(self):
+        """A placed vApp keeps its Org VDC, without reading the snapshot."""
+        self.assertEqual(self._place({'vdc_pattern': '*'}, status={'placement': {'vdc': 'busy'}}), ('busy', None))
+
+    def test_005_refresher(self):
+        """The refresher retries the first snapshot soon, then takes one per interval."""
+        self.records = ConnectionError('vCD unreachable')
+        delays = []
+        refresher = CapacityRefresher(interval=60)
+
+        def _wait(delay):
+            delays.append(delay)
+            self.records = [vdc_record('empty', 100)]
+            return len(delays) >= 2
+
+        refresher._stopping = mock.Mock(is_set=lambda: len(delays) >= 2, wait=_wait)
+        with mock.patch.object(vcloud_vapp, 'vcd_sessions', {'default': self.session}), \
+                mock.patch.object(vcloud_vapp, 'wait_for_leadership', return_value=True):
+            refresher._run()
+        self.assertEqual(delays, [CapacityRefresher.FIRST_SNAPSHOT_RETRY, 60])
+        self.assertEqual(self._place({'vdc_pattern': '*'})[0], 'empty')
+
+
+if __name__ == '__main__':
+    unittest.main()